@@ -0,0 +1,395 @@
+###############################################################################
+# Benchmarks for the hot paths of the other scripts. Everything runs against  #
+# synthetic data: palette tiles, a data.db with realistic round counts, and   #
+# local stub servers standing in for the duels, Overpass and coverage apis.   #
+# Results are written as JSON, so that runs can be compared with --compare.   #
+###############################################################################
+
+import numpy as np
+from PIL import Image
+
+import argparse
+import asyncio
+import contextlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+from calculate_coverage_density import ScoreCalculator, calculate_all_scores
+from coverage_count import get_all_coverage
+from get_games import BulkWriter, get_games_concurrently, insert_dictionary, parse_game
+from nearby_intersections import OverpassScheduler
+from setup_database import create_tables, migrate_locations
+
+# all benchmarks, in the order they are run
+BENCHMARKS = [
+	"tile_score_cold",
+	"tile_score_warm",
+	"coordinate_score",
+	"coordinate_scores",
+	"density_pass",
+	"insert_dictionary",
+	"bulk_ingest",
+	"fetch_games",
+	"intersections",
+	"coverage"
+]
+
+# the synthetic tiles are centred here, so that they are on land and away from the antimeridian
+CENTRE = {"lat": 48.85, "lng": 2.35}
+
+# builds a palette for the synthetic tiles: index 0 is the empty background, and only some of the others count as coverage
+# see ScoreCalculator.score_image for which colours count
+def make_palette():
+	palette = [255, 255, 255]
+	for i in range(1, 256):
+		palette.extend([1 + i % 99, 80, 200] if i < 128 else [200 + i % 56, 200, 200])
+	return palette
+
+# writes palette tiles in a square of |dx|, |dy| <= tile_radius around the centre, returning their (x, y)
+# every tile gets its own coverage density, a few of them being empty like the sea
+def make_tiles(tile_path, tile_radius, zoom = 12, size = 256, seed = 0):
+	rng = np.random.default_rng(seed)
+	os.makedirs(tile_path, exist_ok = True)
+	centre = ScoreCalculator(zoom = zoom).get_tile_from_coords(CENTRE)
+	palette = make_palette()
+	tiles = []
+	for dx in range(-tile_radius, tile_radius + 1):
+		for dy in range(-tile_radius, tile_radius + 1):
+			x = centre["x"] + dx
+			y = centre["y"] + dy
+			density = rng.choice([0, rng.uniform(0.001, 0.2)], p = [0.1, 0.9])
+			pixels = np.where(rng.random((size, size)) < density, rng.integers(1, 256, (size, size)), 0).astype(np.uint8)
+			image = Image.fromarray(pixels, "P")
+			image.putpalette(palette)
+			image.save(f"{tile_path}/z{zoom}x{x}y{y}.png")
+			tiles.append((x, y))
+	return tiles
+
+# gets location_count random locations within the inner half of the synthetic tiles
+def make_locations(location_count, tile_radius, zoom = 12, seed = 0):
+	rng = random.Random(seed)
+	calculator = ScoreCalculator(zoom = zoom)
+	centre = calculator.get_tile_from_coords(CENTRE)
+	inner_radius = max(tile_radius // 2, 1)
+	northwest = calculator.get_corner_from_tile({"x": centre["x"] - inner_radius, "y": centre["y"] - inner_radius})
+	southeast = calculator.get_corner_from_tile({"x": centre["x"] + inner_radius + 1, "y": centre["y"] + inner_radius + 1})
+	return [
+		(round(rng.uniform(southeast["lat"], northwest["lat"]), 6), round(rng.uniform(northwest["lng"], southeast["lng"]), 6))
+		for i in range(location_count)
+	]
+
+# builds a raw api response for a finished team duel, in the format that get_games.parse_game reads
+# the last generated round is usually left unplayed, same as in real games
+def make_duel(game_id, locations, player_count = 2000):
+	rng = random.Random(game_id)
+	round_count = rng.randint(4, 9)
+	rounds = []
+	round_results = [[], []]
+	started_at = 1672531200 + rng.randint(0, 365 * 86400)
+	for round_number in range(1, round_count + 1):
+		lat, lng = rng.choice(locations)
+		# the last round is generated in advance but never played, so it has no times
+		played = round_number < round_count
+		round_start = started_at + 60 * (round_number - 1)
+		rounds.append({
+			"roundNumber": round_number,
+			"startTime": time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime(round_start)) if played else None,
+			"endTime": time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime(round_start + 45)) if played else None,
+			"panorama": {
+				"lat": lat,
+				"lng": lng,
+				"heading": rng.uniform(0, 360),
+				"pitch": 0,
+				"zoom": 0,
+				"countryCode": "fr",
+				"panoId": "".join(f"{ord(x):02x}" for x in "".join(rng.choices("abcdefghijklmnopqrstuv", k = 22)))
+			}
+		})
+		if round_number == round_count:
+			continue
+		for team in range(2):
+			round_results[team].append({
+				"roundNumber": round_number,
+				"score": rng.randint(0, 5000),
+				"bestGuess": {"lat": lat + rng.uniform(-1, 1), "lng": lng + rng.uniform(-1, 1), "distance": rng.uniform(0, 1e6)}
+			})
+	players = rng.sample(range(player_count), 4)
+	teams = [
+		{
+			"id": f"team{team}",
+			"players": [
+				{"playerId": f"player{x}", "rating": rng.randint(500, 1500), "guesses": [{}]}
+				for x in players[2 * team : 2 * team + 2]
+			],
+			"roundResults": round_results[team]
+		}
+		for team in range(2)
+	]
+	return {
+		"gameId": game_id,
+		"status": "Finished",
+		"result": {"isDraw": False, "winningTeamId": f"team{rng.randint(0, 1)}"},
+		"movementOptions": {"forbidRotating": rng.random() < 0.3},
+		"options": {"map": {"slug": f"map{rng.randint(0, 50)}", "name": "Synthetic map", "maxErrorDistance": 2e7}},
+		"currentRoundNumber": round_count - 1,
+		"teams": teams,
+		"rounds": rounds
+	}
+
+# creates an empty database with the current schema
+def make_database(db_path):
+	con = sqlite3.connect(db_path)
+	create_tables(con)
+	migrate_locations(con)
+	return con
+
+# one http server that stands in for all three apis, answering after latency seconds
+# duels are at /duels/<game_id>, overpass at /overpass and SingleImageSearch at /coverage
+# error_rate of the requests fail with a 503 instead, and anything under /dead always does, for testing retries and mirror scheduling
+def start_stub_server(locations, latency = 0.05, error_rate = 0):
+	class StubHandler(BaseHTTPRequestHandler):
+		def log_message(self, *args):
+			pass
+
+		def respond(self, contents):
+			body = json.dumps(contents).encode()
+			time.sleep(latency)
+			self.send_response(200)
+			self.send_header("Content-Type", "application/json")
+			self.send_header("Content-Length", str(len(body)))
+			self.end_headers()
+			self.wfile.write(body)
+
+		# answers with a server error if this request is one of the ones that fail, returning whether it did
+		def fail(self):
+			if not self.path.startswith("/dead") and random.random() >= error_rate:
+				return False
+			time.sleep(latency)
+			self.send_response(503)
+			self.send_header("Content-Length", "0")
+			self.end_headers()
+			return True
+
+		def do_GET(self):
+			if self.fail():
+				return
+			self.respond(make_duel(self.path.rsplit("/", 1)[1], locations))
+
+		def do_POST(self):
+			query = self.rfile.read(int(self.headers["Content-Length"])).decode()
+			if self.fail():
+				return
+			if self.path.startswith("/overpass"):
+				# a marker for every location, followed by a few nodes that depend on where it is
+				elements = []
+				for match in re.finditer(r"index=(\d+);.*?around:\d+,([-\d.]+),([-\d.]+)", query, re.S):
+					elements.append({"type": "location_marker", "id": 0, "tags": {"index": match.group(1)}})
+					elements.extend({"type": "node", "id": i} for i in range(int(float(match.group(2)) * 1000) % 7))
+				self.respond({"elements": elements})
+			else:
+				lat = float(re.search(r"\[null,null,([-\d.e]+),", query).group(1))
+				pano_count = int(lat * 1000) % 4
+				panos = [[[None, "A" * 22]] for i in range(pano_count)]
+				dates = [[i, [2015 + i, 3]] for i in range(pano_count)]
+				self.respond([None, [None, None, None, None, None, [[None, None, None, [panos], None, None, None, None, dates]], [None] * 7 + [[2020, 1]]]])
+
+	server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+	server.daemon_threads = True
+	threading.Thread(target = server.serve_forever, daemon = True).start()
+	return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+# runs fn once and times it, items is how many things it processed
+def timed(name, items, fn):
+	cpu_start = time.process_time()
+	start = time.perf_counter()
+	# the scripts print their own progress, which would only get in the way here
+	with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+		fn()
+	seconds = time.perf_counter() - start
+	result = {
+		"name": name,
+		"items": items,
+		"seconds": round(seconds, 4),
+		"items_per_second": round(items / seconds, 2) if seconds > 0 else None,
+		"cpu_seconds": round(time.process_time() - cpu_start, 4)
+	}
+	print(f"{name}: {items} items in {result['seconds']}s ({result['items_per_second']}/s)")
+	return result
+
+# runs the selected benchmarks in work_dir, which gets the synthetic tiles and databases
+def run_benchmarks(
+	work_dir,
+	only = BENCHMARKS,
+	tile_radius = 12,
+	game_count = 10000,
+	scalar_locations = 200,
+	network_items = 500,
+	latency = 0.05,
+	concurrency = 16,
+	workers = None,
+	error_rate = 0
+):
+	# the scripts read tiles from ./tiles and write to ./data.db, so everything happens in the work directory
+	os.chdir(work_dir)
+	results = []
+	print(f"Generating synthetic tiles and locations in {work_dir}")
+	tiles = make_tiles("./tiles", tile_radius)
+	# most locations get played in several rounds, same as on real maps
+	locations = make_locations(max(game_count, 100), tile_radius)
+	games = [parse_game(make_duel(f"game{i}", locations), f"game{i}") for i in range(game_count)]
+	round_count = sum(len(x[2]) for x in games)
+
+	calculator = ScoreCalculator()
+	if "tile_score_cold" in only:
+		results.append(timed("tile_score_cold", len(tiles), lambda: [calculator.tile_score({"x": x, "y": y}) for x, y in tiles]))
+	if "tile_score_warm" in only:
+		results.append(timed("tile_score_warm", len(tiles), lambda: [calculator.tile_score({"x": x, "y": y}) for x, y in tiles]))
+	# both of these use the warm calculator, so that they measure the scoring itself rather than decoding
+	scalar = locations[: scalar_locations]
+	if "coordinate_score" in only:
+		results.append(timed("coordinate_score", len(scalar), lambda: [calculator.coordinate_score({"lat": x[0], "lng": x[1]}) for x in scalar]))
+	if "coordinate_scores" in only:
+		lats = np.array([x[0] for x in locations])
+		lngs = np.array([x[1] for x in locations])
+		results.append(timed("coordinate_scores", len(locations), lambda: calculator.coordinate_scores(lats, lngs)))
+
+	if "insert_dictionary" in only:
+		con = make_database("insert_dictionary.db")
+		insert_games = games[: max(game_count // 10, 1)]
+
+		def insert_all():
+			for game_info, player_info, round_info in insert_games:
+				insert_dictionary(con, "games", game_info)
+				for player in player_info:
+					insert_dictionary(con, "player_ratings", player)
+				for current_round in round_info:
+					insert_dictionary(con, "rounds", current_round)
+
+		results.append(timed("insert_dictionary", len(insert_games), insert_all))
+		con.close()
+
+	# the bulk ingest is also what builds the database for the density pass
+	con = make_database("data.db")
+
+	def bulk_ingest():
+		writer = BulkWriter(con, batch_games = 1000, flush_seconds = float("inf"))
+		for game in games:
+			writer.add_game(*game)
+		writer.close()
+
+	result = timed("bulk_ingest", game_count, bulk_ingest)
+	if "bulk_ingest" in only:
+		results.append(result)
+	location_count = con.execute("SELECT COUNT(*) FROM locations").fetchone()[0]
+	con.close()
+	print(f"Synthetic database has {game_count} games, {round_count} rounds and {location_count} locations")
+	if "density_pass" in only:
+		results.append(timed("density_pass", location_count, lambda: calculate_all_scores(workers = workers)))
+
+	network = [x for x in ["fetch_games", "intersections", "coverage"] if x in only]
+	if len(network) > 0:
+		server, url = start_stub_server(locations, latency, error_rate)
+		if "fetch_games" in only:
+			game_ids = [f"fetched{i}" for i in range(network_items)]
+			results.append(timed(
+				"fetch_games",
+				network_items,
+				lambda: list(get_games_concurrently(game_ids, {}, concurrency, 1e6, base_url = url + "/duels/"))
+			))
+		rows = [(i, lat, lng) for i, (lat, lng) in enumerate(locations[: network_items])]
+		if "intersections" in only:
+			endpoints = [{"url": url + "/overpass", "weight": 1, "max_in_flight": concurrency}]
+			# with failures, there is also a mirror that never works, which should hardly get any traffic
+			if error_rate > 0:
+				endpoints.append({"url": url + "/dead/overpass", "weight": 1, "max_in_flight": concurrency})
+			scheduler = OverpassScheduler(endpoints)
+			results.append(timed("intersections", len(rows), lambda: scheduler.run(rows, lambda x: None)))
+			scheduler.close()
+		if "coverage" in only:
+			con = make_database("coverage.db")
+			con.executemany("INSERT INTO locations(lat, lng) VALUES (?, ?)", [(x[1], x[2]) for x in rows])
+			con.commit()
+			con.close()
+			results.append(timed(
+				"coverage",
+				len(rows),
+				lambda: asyncio.run(get_all_coverage(concurrency, url = url + "/coverage", db_path = "coverage.db"))
+			))
+		server.shutdown()
+	return results
+
+# compares results against an earlier run, returning the benchmarks that got slower by more than tolerance
+def compare_results(old_results, new_results, tolerance = 0.2):
+	old_by_name = {x["name"]: x for x in old_results}
+	regressions = []
+	for result in new_results:
+		old = old_by_name.get(result["name"])
+		if old is None or not old["items_per_second"] or not result["items_per_second"]:
+			continue
+		ratio = result["items_per_second"] / old["items_per_second"]
+		print(f"{result['name']}: {ratio:.2f}x the speed of the earlier run")
+		if ratio < 1 - tolerance:
+			regressions.append(result["name"])
+	return regressions
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description = "Benchmarks the hot paths against synthetic data and local stub servers")
+	parser.add_argument("--only", nargs = "+", choices = BENCHMARKS, default = BENCHMARKS, help = "benchmarks to run")
+	parser.add_argument("--tile-radius", type = int, default = 12, help = "synthetic tiles are generated this many tiles around the centre")
+	parser.add_argument("--games", type = int, default = 10000, help = "number of synthetic games in the database")
+	parser.add_argument("--scalar-locations", type = int, default = 200, help = "locations scored with the slow coordinate_score")
+	parser.add_argument("--network-items", type = int, default = 500, help = "requests sent to each stub server")
+	parser.add_argument("--latency", type = float, default = 0.05, help = "seconds the stub servers take to respond")
+	parser.add_argument("--concurrency", type = int, default = 16, help = "requests in flight at once for the network benchmarks")
+	parser.add_argument("--error-rate", type = float, default = 0, help = "share of stub server requests that fail, which also adds a dead overpass mirror")
+	parser.add_argument("--workers", type = int, default = None, help = "processes used for the density pass")
+	parser.add_argument("--work-dir", default = None, help = "where synthetic data is generated, defaults to a temporary directory")
+	parser.add_argument("--output", default = "benchmark.json", help = "where the results are written")
+	parser.add_argument("--compare", default = None, help = "earlier results to compare against, exits with 1 on regressions")
+	parser.add_argument("--tolerance", type = float, default = 0.2, help = "slowdown that counts as a regression")
+	args = parser.parse_args()
+	output_path = os.path.abspath(args.output)
+	compare_path = os.path.abspath(args.compare) if args.compare else None
+	work_dir = args.work_dir or tempfile.mkdtemp(prefix = "benchmark")
+	os.makedirs(work_dir, exist_ok = True)
+	parameters = {
+		"tile_radius": args.tile_radius,
+		"game_count": args.games,
+		"scalar_locations": args.scalar_locations,
+		"network_items": args.network_items,
+		"latency": args.latency,
+		"concurrency": args.concurrency,
+		"workers": args.workers or os.cpu_count(),
+		"error_rate": args.error_rate
+	}
+	try:
+		results = run_benchmarks(work_dir, args.only, **parameters)
+	finally:
+		if args.work_dir is None:
+			shutil.rmtree(work_dir)
+	with open(output_path, "w") as f:
+		json.dump({
+			"created_at": int(time.time()),
+			"python": platform.python_version(),
+			"platform": platform.platform(),
+			"cpu_count": os.cpu_count(),
+			"parameters": parameters,
+			"results": results
+		}, f, indent = 2)
+	print(f"Results written to {output_path}")
+	if compare_path:
+		with open(compare_path) as f:
+			regressions = compare_results(json.load(f)["results"], results, args.tolerance)
+		if len(regressions) > 0:
+			print(f"Regressions: {', '.join(regressions)}")
+			sys.exit(1)
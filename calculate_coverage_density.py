@@ -1,16 +1,77 @@
 import numpy as np
 from PIL import Image
 
+import argparse
+from collections import OrderedDict
 import math
+import multiprocessing
+import os
 import os.path
+import re
 import sys
 import sqlite3
+import time
+
+from locations import get_locations_without, update_locations
+from metrics import add_metrics_arguments, metrics, start_metrics
+
+# persistent tile score storage, so that reruns and parallel workers don't have to decode the same tiles again
+# a stored score is only reused if the tile file still has the same modification time and size, otherwise it gets recalculated
+class TileScoreStore:
+	def __init__(self, path = "./tile_scores.db", flush_every = 1000):
+		# the timeout lets several workers share the same store without running into locking errors
+		self.con = sqlite3.connect(path, timeout = 60)
+		self.con.execute("PRAGMA journal_mode = WAL")
+		self.con.execute("""CREATE TABLE IF NOT EXISTS tile_scores(
+			zoom INTEGER,
+			x INTEGER,
+			y INTEGER,
+			mtime INTEGER,
+			size INTEGER,
+			score INTEGER,
+			PRIMARY KEY (zoom, x, y)
+		)""")
+		self.flush_every = flush_every
+		self.pending = []
+
+	# gets a stored score, or None if there is none or it is stale
+	def get(self, zoom, x, y, mtime, size):
+		row = self.con.execute(
+			"SELECT score FROM tile_scores WHERE zoom = ? AND x = ? AND y = ? AND mtime = ? AND size = ?",
+			(zoom, x, y, mtime, size)
+		).fetchone()
+		return None if row is None else row[0]
+
+	# stores a score, writes are buffered and committed in batches
+	def put(self, zoom, x, y, mtime, size, score):
+		self.pending.append((zoom, x, y, mtime, size, score))
+		if len(self.pending) >= self.flush_every:
+			self.flush()
+
+	def flush(self):
+		if len(self.pending) == 0:
+			return
+		with self.con:
+			self.con.executemany("INSERT OR REPLACE INTO tile_scores VALUES (?, ?, ?, ?, ?, ?)", self.pending)
+		self.pending = []
+
+	def close(self):
+		self.flush()
+		self.con.close()
 
 class ScoreCalculator:
-	def __init__(self, cache_tile_scores = True, zoom = 12):
+	# max_cached_tiles limits the in-memory cache (least recently used tiles get dropped first), None means no limit
+	# tile_store is an optional TileScoreStore that keeps scores between runs
+	# tile_pack is an optional TilePack (see tile_pack.py) that replaces reading individual tiles
+	def __init__(self, cache_tile_scores = True, zoom = 12, max_cached_tiles = None, tile_store = None, tile_pack = None):
 		self.cache_tile_scores = cache_tile_scores
-		self.tile_scores = {}
+		self.tile_scores = OrderedDict()
+		self.max_cached_tiles = max_cached_tiles
+		self.tile_store = tile_store
+		self.tile_pack = tile_pack
 		self.zoom = zoom
+		# dense [y, x] array of every tile score at this zoom level, see build_score_raster
+		self.score_raster = None
 
 	# gets a tile from coordinates
 	# adapted from here: https://developers.google.com/maps/documentation/javascript/examples/map-coordinates
@@ -68,14 +129,40 @@ class ScoreCalculator:
 		# caching to save computation time in exchange for memory
 		x = tile["x"]
 		y = tile["y"]
-		if self.cache_tile_scores:
-			tile_tuple = (x, y)
-			if tile_tuple in self.tile_scores:
-				return self.tile_scores[tile_tuple]
-		tile_name = f"{tile_path}/z{self.zoom}x{x}y{y}.png"
-		if not os.path.isfile(tile_name):
+		if self.score_raster is not None:
+			scale = 1 << self.zoom
+			if 0 <= x < scale and 0 <= y < scale:
+				return int(self.score_raster[y, x])
 			return 0
-		image = Image.open(tile_name)
+		if self.tile_pack is not None:
+			raw_score = self.tile_pack.tile_score(self.zoom, x, y)
+			return 0 if raw_score is None else raw_score
+		tile_tuple = (x, y)
+		if self.cache_tile_scores and tile_tuple in self.tile_scores:
+			self.tile_scores.move_to_end(tile_tuple)
+			return self.tile_scores[tile_tuple]
+		tile_name = f"{tile_path}/z{self.zoom}x{x}y{y}.png"
+		try:
+			tile_stat = os.stat(tile_name)
+		except FileNotFoundError:
+			tile_stat = None
+		if tile_stat is None:
+			raw_score = 0
+		elif self.tile_store is None:
+			raw_score = self.score_image(Image.open(tile_name))
+		else:
+			raw_score = self.tile_store.get(self.zoom, x, y, tile_stat.st_mtime_ns, tile_stat.st_size)
+			if raw_score is None:
+				raw_score = self.score_image(Image.open(tile_name))
+				self.tile_store.put(self.zoom, x, y, tile_stat.st_mtime_ns, tile_stat.st_size, raw_score)
+		if self.cache_tile_scores:
+			self.tile_scores[tile_tuple] = raw_score
+			if self.max_cached_tiles is not None and len(self.tile_scores) > self.max_cached_tiles:
+				self.tile_scores.popitem(last = False)
+		return raw_score
+
+	# gets the raw score of an opened palette tile image
+	def score_image(self, image):
 		palette_raw = image.getpalette()
 		colours = [palette_raw[i:i+3] for i in range(0, len(palette_raw), 3)]
 		# these roughly correspond to most of the non-bright colours. can be imperfect (too lenient), but usually fine enough
@@ -84,10 +171,7 @@ class ScoreCalculator:
 		acceptable_indices_np = np.array(acceptable_indices)
 		image_np = np.array(image)
 		# fastest way i could find to the number of elements that are in a different array
-		raw_score = np.count_nonzero(np.searchsorted(acceptable_indices_np, image_np))
-		if self.cache_tile_scores:
-			self.tile_scores[tile_tuple] = raw_score
-		return raw_score
+		return int(np.count_nonzero(np.searchsorted(acceptable_indices_np, image_np)))
 
 	# gets a distance from a coordinate to a tile
 	# it has some imperfections, such as assuming a spherical earth, and using slightly simplified heuristics for finding nearest point
@@ -152,25 +236,292 @@ class ScoreCalculator:
 		scores = scores[ : math.ceil(len(scores) / 3)]
 		return round(sum(x["score"] for x in scores) / sum(x["weight"] for x in scores) * 10000 / (1 << 16))
 
-if __name__ == "__main__":
-	score_calculator = ScoreCalculator()
-	con = sqlite3.connect("data.db")
-	cur = con.cursor()
-	cur.execute("SELECT lat, lng FROM rounds GROUP BY lat, lng")
-	locations = cur.fetchall()
+	# gets the tile offsets that coordinate_score visits, in the same order that it visits them
+	# the order matters since ties in the top third trimming are resolved by it
+	def neighbourhood_offsets(self):
+		offsets = []
+		for total_distance in range(self.zoom):
+			for i in range(-total_distance, total_distance + 1):
+				j = total_distance - abs(i)
+				if j == 0:
+					offsets.append((i, 0))
+				else:
+					offsets.extend([(i, -j), (i, j)])
+		return np.array(offsets, dtype = np.int64)
+
+	# vectorised version of get_tile_from_coords, takes arrays of lats and lngs and returns arrays of x and y
+	def get_tiles_from_coords(self, lats, lngs):
+		scale = 1 << self.zoom
+		sin_y = np.clip(np.sin(lats * math.pi / 180), -0.9999, 0.9999)
+		x = np.floor(scale * (0.5 + lngs / 360)).astype(np.int64)
+		y = np.floor(scale * (0.5 - np.log((1 + sin_y) / (1 - sin_y)) / (4 * math.pi))).astype(np.int64)
+		return x, y
+
+	# vectorised version of get_corner_from_tile, returns arrays of lats and lngs
+	def get_corners_from_tiles(self, x, y):
+		scale = 1 << self.zoom
+		temp_exp = np.exp((0.5 - y / scale) * 4 * math.pi)
+		sin_y = (temp_exp - 1) / (temp_exp + 1)
+		return 180 / math.pi * np.arcsin(sin_y), 360 * (x / scale - 0.5)
+
+	# vectorised version of distance_to_tile, with the same simplifications (and the same quirks, so that the scores match)
+	def distances_to_tiles(self, lats, lngs, x, y):
+		lat_max, lng_min = self.get_corners_from_tiles(x, y)
+		lat_min, lng_max = self.get_corners_from_tiles(x + 1, y + 1)
+		selected_lat = np.clip(lats, lat_min, lat_max)
+		selected_lng = np.clip(lngs, lng_min, lng_max)
+		d_lat = np.radians(lats - selected_lat)
+		d_lng = np.radians(lngs - selected_lng)
+		a = np.sin(d_lat / 2) ** 2 + np.cos(lats) * np.cos(selected_lat) * np.sin(d_lng / 2) ** 2
+		return 2 * np.arcsin(np.sqrt(a)) * 6371
+
+	# gets the scores of a set of tiles given as arrays of x and y
+	# every distinct tile is only scored once, no matter how many locations share it
+	def tile_scores_for(self, x, y):
+		if self.score_raster is not None:
+			# straight array reads, tiles outside of the world have no coverage
+			scale = 1 << self.zoom
+			valid = (x >= 0) & (x < scale) & (y >= 0) & (y < scale)
+			scores = np.zeros(x.shape, dtype = np.float64)
+			scores[valid] = self.score_raster[y[valid], x[valid]]
+			return scores
+		if self.tile_pack is not None:
+			return self.tile_pack.tile_scores(self.zoom, x, y).astype(np.float64)
+		tiles, inverse = np.unique(np.stack([x.ravel(), y.ravel()], axis = 1), axis = 0, return_inverse = True)
+		scores = np.array([self.tile_score({"x": int(tile[0]), "y": int(tile[1])}) for tile in tiles], dtype = np.float64)
+		return scores[inverse.ravel()].reshape(x.shape)
+
+	# gets the scores of many coordinates at once, matching coordinate_score for each of them
+	# lats and lngs are arrays of the same length, and locations are scored batch_size at a time to keep memory usage reasonable
+	def coordinate_scores(self, lats, lngs, batch_size = 10000):
+		lats = np.asarray(lats, dtype = np.float64).ravel()
+		lngs = np.asarray(lngs, dtype = np.float64).ravel()
+		offsets = self.neighbourhood_offsets()
+		kept_count = math.ceil(len(offsets) / 3)
+		results = np.zeros(len(lats), dtype = np.int64)
+		for start in range(0, len(lats), batch_size):
+			batch_lats = lats[start : start + batch_size, None]
+			batch_lngs = lngs[start : start + batch_size, None]
+			base_x, base_y = self.get_tiles_from_coords(batch_lats, batch_lngs)
+			x = base_x + offsets[:, 0]
+			y = base_y + offsets[:, 1]
+			distances = self.distances_to_tiles(batch_lats, batch_lngs, x, y)
+			weights = (10 / (10 + distances)) ** 2
+			scores = self.tile_scores_for(x, y) * weights
+			# same trimming as coordinate_score, a stable sort keeps ties in visiting order
+			order = np.argsort(-scores, axis = 1, kind = "stable")[:, : kept_count]
+			kept_scores = np.take_along_axis(scores, order, axis = 1)
+			kept_weights = np.take_along_axis(weights, order, axis = 1)
+			# cumulative sums add up left to right like sum() does, so rounding matches the scalar path
+			score_sums = np.cumsum(kept_scores, axis = 1)[:, -1]
+			weight_sums = np.cumsum(kept_weights, axis = 1)[:, -1]
+			results[start : start + batch_size] = np.round(score_sums / weight_sums * 10000 / (1 << 16))
+		return results
+
+	# turns all downloaded tiles into one dense (1 << zoom) x (1 << zoom) raster of tile scores, saved as a .npy file
+	# at zoom 12, this is 4096 x 4096 x 4 bytes = 64MB, which is small enough to memory map and keep around
+	# only files that actually exist are read, missing tiles are just left as 0
+	def build_score_raster(self, raster_path = "./coverage_raster.npy", tile_path = "./tiles"):
+		scale = 1 << self.zoom
+		# scores have to come from the tiles themselves, not from an older raster
+		self.score_raster = None
+		raster = np.lib.format.open_memmap(raster_path, mode = "w+", dtype = np.uint32, shape = (scale, scale))
+		tile_name = re.compile(rf"z{self.zoom}x(\d+)y(\d+)\.png")
+		for file_name in os.listdir(tile_path):
+			match = tile_name.fullmatch(file_name)
+			if not match:
+				continue
+			x = int(match.group(1))
+			y = int(match.group(2))
+			if x < scale and y < scale:
+				raster[y, x] = self.tile_score({"x": x, "y": y}, tile_path)
+		raster.flush()
+		self.score_raster = raster
+		return raster
+
+	# loads a raster made by build_score_raster, after which scores are looked up from it instead of from the tiles
+	# the top third trimming depends on each coordinate, so the neighbourhood still has to be gathered per coordinate
+	# but it becomes a handful of array reads instead of opening tiles
+	def load_score_raster(self, raster_path = "./coverage_raster.npy"):
+		raster = np.load(raster_path, mmap_mode = "r")
+		scale = 1 << self.zoom
+		if raster.shape != (scale, scale):
+			raise ValueError(f"raster has shape {raster.shape}, expected ({scale}, {scale}) for zoom {self.zoom}")
+		self.score_raster = raster
+		return raster
+
+# creates a score calculator, with all of its optional lookups
+def make_score_calculator(raster_path = None, pack_path = None, tile_store_path = None, max_cached_tiles = None):
+	tile_store = TileScoreStore(tile_store_path) if tile_store_path else None
+	tile_pack = None
+	if pack_path:
+		# imported here since tile_pack itself depends on this module
+		from tile_pack import TilePack
+		tile_pack = TilePack(pack_path)
+	score_calculator = ScoreCalculator(max_cached_tiles = max_cached_tiles, tile_store = tile_store, tile_pack = tile_pack)
+	if raster_path:
+		score_calculator.load_score_raster(raster_path)
+	return score_calculator
+
+# every worker process keeps its own calculator, so that its tile cache stays warm between chunks
+worker_calculator = None
+
+def init_worker(calculator_options):
+	global worker_calculator
+	worker_calculator = make_score_calculator(**calculator_options)
+
+# scores a chunk of (location_id, lat, lng) rows, getting (location_id, score) rows that are ready to be written
+# returns the rows together with the wall and cpu time spent, since those can't be recorded in the metrics of another process
+def score_chunk(chunk):
+	start = time.perf_counter()
+	cpu_start = time.thread_time()
+	lats = np.array([x[1] for x in chunk])
+	lngs = np.array([x[2] for x in chunk])
+	scores = worker_calculator.coordinate_scores(lats, lngs)
+	if worker_calculator.tile_store is not None:
+		worker_calculator.tile_store.flush()
+	rows = [(location[0], score) for (location, score) in zip(chunk, scores.tolist())]
+	return rows, time.perf_counter() - start, time.thread_time() - cpu_start
+
+# splits locations into chunks of nearby locations, so that each chunk only needs a small set of tiles
+# locations are ordered by 16x16 blocks of tiles first, and then by the tiles themselves
+def spatial_chunks(locations, chunk_size, zoom = 12):
+	if len(locations) == 0:
+		return []
+	lats = np.array([x[1] for x in locations])
+	lngs = np.array([x[2] for x in locations])
+	x, y = ScoreCalculator(zoom = zoom).get_tiles_from_coords(lats, lngs)
+	order = np.lexsort((y, x, y >> 4, x >> 4))
+	return [[locations[i] for i in order[j : j + chunk_size]] for j in range(0, len(order), chunk_size)]
+
+# finds the tiles that changed since the scores were calculated, by comparing a tile manifest (see download_tiles.TileManifest)
+# with the tile hashes that were current at the last run, and clears the scores of every location whose neighbourhood touches one of them
+# the cleared locations are then picked up like new ones, by anything that scores locations without streetview_coverage
+# the first run has nothing to compare with, so it takes the current tiles as what the existing scores were calculated from
+# a score raster or tile pack has to be rebuilt from the new tiles before rescoring, since they are only read from the tiles once
+# returns the number of changed tiles and the number of locations that need to be scored again
+def invalidate_changed_tiles(con, manifest_path = "./tiles_manifest.db", zoom = 12):
+	con.execute("""CREATE TABLE IF NOT EXISTS density_tiles(
+		zoom INTEGER,
+		x INTEGER,
+		y INTEGER,
+		hash TEXT,
+		PRIMARY KEY (zoom, x, y)
+	)""")
+	con.execute("ATTACH DATABASE ? AS manifest", (manifest_path,))
+	try:
+		first_run = con.execute("SELECT COUNT(*) FROM density_tiles WHERE zoom = ?", (zoom,)).fetchone()[0] == 0
+		# tiles that are new, different or gone
+		changed = con.execute("""SELECT m.x, m.y FROM manifest.tile_hashes AS m
+			LEFT JOIN density_tiles AS d ON d.zoom = m.zoom AND d.x = m.x AND d.y = m.y
+			WHERE m.zoom = :zoom AND d.hash IS NOT m.hash
+			UNION SELECT d.x, d.y FROM density_tiles AS d
+			WHERE d.zoom = :zoom AND NOT EXISTS (SELECT 1 FROM manifest.tile_hashes AS m WHERE m.zoom = d.zoom AND m.x = d.x AND m.y = d.y)""",
+			{"zoom": zoom}
+		).fetchall()
+		invalidated = []
+		if len(changed) > 0 and not first_run:
+			# every tile within the ring that coordinate_score looks at, keyed as x << 32 + y
+			changed = np.array(changed, dtype = np.int64)
+			offsets = ScoreCalculator(zoom = zoom).neighbourhood_offsets()
+			affected = np.unique((changed[:, None, 0] - offsets[None, :, 0]) * (1 << 32) + (changed[:, None, 1] - offsets[None, :, 1]))
+			locations = con.execute("SELECT location_id, lat, lng FROM locations WHERE streetview_coverage IS NOT NULL").fetchall()
+			if len(locations) > 0:
+				location_ids = np.array([x[0] for x in locations], dtype = np.int64)
+				x, y = ScoreCalculator(zoom = zoom).get_tiles_from_coords(np.array([x[1] for x in locations]), np.array([x[2] for x in locations]))
+				invalidated = location_ids[np.isin(x * (1 << 32) + y, affected)].tolist()
+		# the scores are cleared before the hashes are moved on, so that an interruption in between only means doing the same again
+		update_locations(con, ["streetview_coverage"], [(x, None) for x in invalidated])
+		with con:
+			con.execute("DROP TABLE IF EXISTS temp.changed_tiles")
+			con.execute("CREATE TEMP TABLE changed_tiles(x INTEGER, y INTEGER, PRIMARY KEY (x, y))")
+			con.executemany("INSERT INTO changed_tiles VALUES (?, ?)", [(int(x[0]), int(x[1])) for x in changed])
+			con.execute("DELETE FROM density_tiles WHERE zoom = ? AND (x, y) IN (SELECT x, y FROM changed_tiles)", (zoom,))
+			con.execute("""INSERT INTO density_tiles SELECT m.zoom, m.x, m.y, m.hash
+				FROM manifest.tile_hashes AS m JOIN changed_tiles USING (x, y) WHERE m.zoom = ?""", (zoom,))
+			con.execute("DROP TABLE temp.changed_tiles")
+	finally:
+		con.execute("DETACH DATABASE manifest")
+	return 0 if first_run else len(changed), len(invalidated)
+
+# calculates the coverage density of all locations across several processes
+# workers only calculate, the results are streamed back to this process which writes them in large transactions
+# with a tile manifest, only new locations and the ones near tiles that changed are calculated, see invalidate_changed_tiles
+def calculate_all_scores(workers = None, chunk_size = 2000, write_batch_size = 50000, db_path = "data.db", manifest_path = None, **calculator_options):
+	workers = workers or os.cpu_count()
+	con = sqlite3.connect(db_path)
+	if manifest_path:
+		changed_count, invalidated_count = invalidate_changed_tiles(con, manifest_path)
+		print(f"{changed_count} tiles changed, affecting {invalidated_count} locations")
+		locations = get_locations_without(con, "streetview_coverage")
+	else:
+		locations = con.execute("SELECT location_id, lat, lng FROM locations").fetchall()
 	location_count = len(locations)
 	calculated_count = 0
-	print(f"Getting coverage density for {location_count} locations")
-	for location in locations:
-		calculated_count += 1
-		(lat, lng) = location
-		score = score_calculator.coordinate_score({"lat": lat, "lng": lng})
-		cur.execute("UPDATE rounds SET streetview_coverage = ? WHERE lat = ? AND lng = ?", (score, lat, lng))
-		if calculated_count % 10000 == 0:
-			con.commit()
-		print(
-			f"Calculated {calculated_count} scores out of {location_count}",
-			sep = "",
-			end = "\r",
-			flush = True
-		)
\ No newline at end of file
+	print(f"Getting coverage density for {location_count} locations using {workers} processes")
+	chunks = spatial_chunks(locations, chunk_size)
+	pending = []
+
+	def write_pending():
+		update_locations(con, ["streetview_coverage"], pending)
+		pending.clear()
+
+	if workers == 1:
+		init_worker(calculator_options)
+		results = map(score_chunk, chunks)
+	else:
+		pool = multiprocessing.Pool(workers, initializer = init_worker, initargs = (calculator_options,))
+		results = pool.imap_unordered(score_chunk, chunks)
+	try:
+		with metrics.profiled("density"):
+			for rows, wall_seconds, cpu_seconds in results:
+				metrics.add_time("density.score", wall_seconds, cpu_seconds)
+				metrics.count("density.score", len(rows))
+				pending.extend(rows)
+				calculated_count += len(rows)
+				if len(pending) >= write_batch_size:
+					write_pending()
+				print(
+					f"Calculated {calculated_count} scores out of {location_count}",
+					sep = "",
+					end = "\r",
+					flush = True
+				)
+			write_pending()
+	except BaseException:
+		# the chunks that are still outstanding aren't needed anymore, so the workers are stopped instead of waited for
+		if workers != 1:
+			pool.terminate()
+			pool.join()
+		raise
+	if workers != 1:
+		pool.close()
+		pool.join()
+	con.close()
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description = "Calculates the street view coverage density of every location")
+	parser.add_argument("--workers", type = int, default = None, help = "number of processes, defaults to the number of cpus")
+	parser.add_argument("--chunk-size", type = int, default = 2000, help = "number of locations sent to a process at once")
+	parser.add_argument("--write-batch-size", type = int, default = 50000, help = "number of scores written per transaction")
+	parser.add_argument("--raster", default = None, help = "score raster made by build_score_raster")
+	parser.add_argument("--pack", default = None, help = "tile pack made by tile_pack.py")
+	parser.add_argument("--tile-store", default = None, help = "persistent tile score store")
+	parser.add_argument("--max-cached-tiles", type = int, default = None, help = "per-process tile cache size")
+	parser.add_argument("--manifest", default = None, help = "tile manifest from download_tiles.py, to only rescore locations near changed tiles")
+	add_metrics_arguments(parser)
+	args = parser.parse_args()
+	start_metrics("calculate_coverage_density", args)
+	try:
+		calculate_all_scores(
+			workers = args.workers,
+			chunk_size = args.chunk_size,
+			write_batch_size = args.write_batch_size,
+			manifest_path = args.manifest,
+			raster_path = args.raster,
+			pack_path = args.pack,
+			tile_store_path = args.tile_store,
+			max_cached_tiles = args.max_cached_tiles
+		)
+	finally:
+		metrics.stop()
\ No newline at end of file
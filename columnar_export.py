@@ -0,0 +1,228 @@
+###############################################################################
+# Exports rounds, games, player_ratings and locations to one raw file per     #
+# column, so that analysis can memory-map them with numpy instead of reading  #
+# rows through sqlite3. Text columns are dictionary encoded, and new rows are #
+# appended based on rowid instead of exporting everything again. Rows are     #
+# assumed to never change once exported, except in the tables listed in       #
+# TABLE_GENERATIONS and PENDING_ROWS, which say how their updates are found.  #
+###############################################################################
+
+import numpy as np
+
+try:
+	import pandas as pd
+except ImportError:
+	pd = None
+
+import argparse
+import json
+import os
+import sqlite3
+
+from setup_database import create_tables, get_watermark
+
+TABLES = ["rounds", "games", "player_ratings", "locations"]
+
+# tables that are updated in place, and the watermark that is bumped with every such update
+# appending new rows would miss those updates, so the table is exported from scratch whenever its generation moved
+# the enrichment columns of locations are filled in long after their rows were inserted
+TABLE_GENERATIONS = {
+	"player_ratings": "ratings.generation",
+	"locations": "locations.generation"
+}
+
+# tables with rows that are still going to be updated, and the condition that such rows match
+# the export stops before the first of them, and only gets to it once it no longer matches
+# rounds get their location_id from locations.link_locations, in a separate commit after they were inserted
+PENDING_ROWS = {
+	"rounds": "location_id IS NULL"
+}
+
+# text columns with the same values share a dictionary, so that their codes can be compared and joined directly
+# any other text column gets a dictionary of its own
+SHARED_DICTIONARIES = {
+	"player_id": "player_id",
+	"team1_player1": "player_id",
+	"team1_player2": "player_id",
+	"team2_player1": "player_id",
+	"team2_player2": "player_id"
+}
+
+# codes of text columns, -1 being NULL
+CODE_DTYPE = np.dtype("<i4")
+# everything else is stored as float64, with NULL as NaN, which is exact for all integers in the database
+VALUE_DTYPE = np.dtype("<f8")
+
+# writes json to a temporary file first, so that an interruption can't leave a broken file
+def write_json(path, contents):
+	with open(path + ".tmp", "w") as f:
+		json.dump(contents, f)
+	os.replace(path + ".tmp", path)
+
+def read_json(path, default = None):
+	if not os.path.isfile(path):
+		return default
+	with open(path) as f:
+		return json.load(f)
+
+# the dictionaries of an export, every one being a list of values where the index is the code
+class Dictionaries:
+	def __init__(self, export_path):
+		self.path = os.path.join(export_path, "dictionaries")
+		os.makedirs(self.path, exist_ok = True)
+		self.values = {}
+		self.codes = {}
+
+	def get(self, name):
+		if name not in self.values:
+			self.values[name] = read_json(os.path.join(self.path, f"{name}.json"), [])
+			self.codes[name] = {x: i for i, x in enumerate(self.values[name])}
+		return self.values[name]
+
+	# gets the codes of a list of values, adding the values that aren't in the dictionary yet
+	def encode(self, name, column):
+		self.get(name)
+		values = self.values[name]
+		codes = self.codes[name]
+		encoded = np.empty(len(column), dtype = CODE_DTYPE)
+		for i, x in enumerate(column):
+			if x is None:
+				encoded[i] = -1
+				continue
+			code = codes.get(x)
+			if code is None:
+				code = codes[x] = len(values)
+				values.append(x)
+			encoded[i] = code
+		return encoded
+
+	# dictionaries are only ever appended to, so codes that were already exported stay valid
+	def save(self):
+		for name, values in self.values.items():
+			write_json(os.path.join(self.path, f"{name}.json"), values)
+
+# gets the export format of every column of a table: (column, dictionary name or None)
+def get_columns(con, table):
+	columns = [("rowid", None)]
+	for (_, name, column_type, _, _, _) in con.execute(f"PRAGMA table_info({table})"):
+		columns.append((name, SHARED_DICTIONARIES.get(name, name) if column_type.upper() == "TEXT" else None))
+	return columns
+
+# appends all rows of a table that are past the last export, batch_size rows at a time
+# rows that were deleted or replaced (see BulkWriter) can't be taken out of the files, so if any are found the table is exported from scratch
+# the same goes for tables in TABLE_GENERATIONS whose generation moved since the last export
+# every other column of a table is treated as append-only, the manifest says which of these applies under "updates"
+# everything is read in a single transaction, so that the generation and the rows belong together
+# returns the number of rows that were added
+def export_table(con, export_path, table, dictionaries, batch_size = 100000, rebuild = False):
+	table_path = os.path.join(export_path, table)
+	os.makedirs(table_path, exist_ok = True)
+	manifest_path = os.path.join(table_path, "manifest.json")
+	manifest = read_json(manifest_path)
+	con.execute("BEGIN")
+	columns = get_columns(con, table)
+	generation = get_watermark(con, TABLE_GENERATIONS[table]) if table in TABLE_GENERATIONS else 0
+	if manifest is not None and not rebuild:
+		exported_count = con.execute(f"SELECT COUNT(*) FROM {table} WHERE rowid <= ?", (manifest["watermark"],)).fetchone()[0]
+		if exported_count != manifest["rows"] or list(manifest["columns"]) != [x[0] for x in columns] or manifest.get("generation", 0) != generation:
+			rebuild = True
+	if manifest is None or rebuild:
+		manifest = {
+			"rows": 0,
+			"watermark": 0,
+			"generation": generation,
+			"updates": {"generation": TABLE_GENERATIONS.get(table), "pending_rows": PENDING_ROWS.get(table)},
+			"columns": {name: {"dtype": (CODE_DTYPE if dictionary else VALUE_DTYPE).str, "dictionary": dictionary} for name, dictionary in columns}
+		}
+	files = {}
+	for name, info in manifest["columns"].items():
+		column_path = os.path.join(table_path, f"{name}.bin")
+		if not os.path.isfile(column_path):
+			open(column_path, "wb").close()
+		files[name] = open(column_path, "r+b")
+		# anything past the rows in the manifest is from an export that was interrupted, so it is thrown away
+		files[name].truncate(manifest["rows"] * np.dtype(info["dtype"]).itemsize)
+		files[name].seek(0, os.SEEK_END)
+	end = None
+	if table in PENDING_ROWS:
+		end = con.execute(f"SELECT MIN(rowid) FROM {table} WHERE {PENDING_ROWS[table]}").fetchone()[0]
+	cursor = con.execute(
+		f"SELECT rowid, * FROM {table} WHERE rowid > ? AND rowid < ? ORDER BY rowid",
+		(manifest["watermark"], float("inf") if end is None else end)
+	)
+	added_count = 0
+	while True:
+		rows = cursor.fetchmany(batch_size)
+		if len(rows) == 0:
+			break
+		for (name, dictionary), values in zip(columns, zip(*rows)):
+			if dictionary is None:
+				files[name].write(np.array(values, dtype = VALUE_DTYPE).tobytes())
+			else:
+				files[name].write(dictionaries.encode(dictionary, values).tobytes())
+		manifest["watermark"] = rows[-1][0]
+		added_count += len(rows)
+	con.commit()
+	for f in files.values():
+		f.close()
+	manifest["rows"] += added_count
+	# the dictionaries have to be saved before the manifest, or the manifest could point at codes that don't exist yet
+	dictionaries.save()
+	write_json(manifest_path, manifest)
+	return added_count
+
+# exports all tables, see export_table
+def export_all(db_path = "data.db", export_path = "./columnar", tables = TABLES, batch_size = 100000, rebuild = False):
+	con = sqlite3.connect(db_path)
+	# older databases don't have the watermarks table yet
+	create_tables(con)
+	dictionaries = Dictionaries(export_path)
+	for table in tables:
+		added_count = export_table(con, export_path, table, dictionaries, batch_size, rebuild)
+		print(f"Exported {added_count} new rows of {table}")
+	con.close()
+
+# loads the columns of an exported table as read-only memory-mapped arrays, without copying them
+# text columns are returned as codes, see load_dictionary for their values
+def load_table(export_path, table, columns = None):
+	table_path = os.path.join(export_path, table)
+	manifest = read_json(os.path.join(table_path, "manifest.json"))
+	if manifest is None:
+		raise FileNotFoundError(f"{table} has not been exported to {export_path}")
+	arrays = {}
+	for name, info in manifest["columns"].items():
+		if columns is not None and name not in columns:
+			continue
+		if manifest["rows"] == 0:
+			arrays[name] = np.zeros(0, dtype = info["dtype"])
+		else:
+			arrays[name] = np.memmap(os.path.join(table_path, f"{name}.bin"), dtype = info["dtype"], mode = "r", shape = (manifest["rows"],))
+	return arrays
+
+# gets the values of a dictionary as an array, so that values[codes] decodes a column
+def load_dictionary(export_path, name):
+	return np.array(read_json(os.path.join(export_path, "dictionaries", f"{name}.json"), []), dtype = object)
+
+# same as load_table, but as a pandas dataframe with text columns as categoricals
+def load_dataframe(export_path, table, columns = None):
+	if pd is None:
+		raise ImportError("load_dataframe requires pandas, use load_table for plain numpy arrays")
+	table_path = os.path.join(export_path, table)
+	manifest = read_json(os.path.join(table_path, "manifest.json"))
+	data = {}
+	for name, array in load_table(export_path, table, columns).items():
+		dictionary = manifest["columns"][name]["dictionary"]
+		if dictionary is None:
+			data[name] = array
+		else:
+			data[name] = pd.Categorical.from_codes(array, categories = load_dictionary(export_path, dictionary))
+	return pd.DataFrame(data, copy = False)
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description = "Exports games, rounds, player ratings and locations to memory-mappable column files")
+	parser.add_argument("--export-path", default = "./columnar", help = "directory that the columns are written to")
+	parser.add_argument("--tables", nargs = "+", choices = TABLES, default = TABLES, help = "tables to export")
+	parser.add_argument("--batch-size", type = int, default = 100000, help = "rows converted at once")
+	parser.add_argument("--rebuild", action = "store_true", help = "export everything again instead of only new rows")
+	args = parser.parse_args()
+	export_all(export_path = args.export_path, tables = args.tables, batch_size = args.batch_size, rebuild = args.rebuild)
@@ -1,16 +1,33 @@
 import aiohttp
 
+import argparse
 import asyncio
 import sqlite3
 
+from locations import get_locations_without, reuse_nearby_results, update_locations
+from metrics import add_metrics_arguments, error_kind, host, metrics, start_metrics
+from response_archive import ResponseArchive
+
+COVERAGE_URL = "https://maps.googleapis.com/$rpc/google.internal.maps.mapsjs.v1.MapsJsInternalService/SingleImageSearch"
+
 # gets the number of panos for a single location
-async def coverage_count(session, location, radius = 10):
-	url = "https://maps.googleapis.com/$rpc/google.internal.maps.mapsjs.v1.MapsJsInternalService/SingleImageSearch"
+# if an archive is given, the raw response is stored in it, see replay_coverage
+async def coverage_count(session, location, radius = 10, url = COVERAGE_URL, archive = None):
 	# this is complicated protobuf data. since there is only one field that i need to change, i will not write ful protobuf definitions, and instead, just adjust the data as necessary
 	request_data = f'[["apiv3",null,null,null,"US",null,null,null,null,null,[[false]]],[[null,null,{location["lat"]},{location["lng"]}],{radius}],[null,["en","GB"],null,null,null,null,null,null,[2],null,[[[2,true,2],[3,true,2],[10,true,2]]]],[[1,2,3,4,8,6]]]'
 	headers = {"content-type": "application/json+protobuf; charset=UTF-8"}
-	response = await session.post(url, data = request_data, headers = headers)
-	contents = await response.json()
+	with metrics.timed("coverage.request"):
+		response = await session.post(url, data = request_data, headers = headers)
+		response.raise_for_status()
+		contents = await response.json()
+	if archive is not None:
+		archive.put("coverage", [location["lat"], location["lng"], radius], contents)
+	with metrics.stage("coverage.parse"):
+		count, date_range = parse_coverage(contents)
+	return {"location_id": location["location_id"], "count": count, "date_range": date_range}
+
+# gets the number of panos and the range of their dates from a SingleImageSearch response
+def parse_coverage(contents):
 	# only one field == error
 	if(len(contents) <= 1):
 		count = 0
@@ -36,50 +53,162 @@ async def coverage_count(session, location, radius = 10):
 			# it will fail iff linked_dates is undefined, in which case the total number of panos is 1
 			count = 1
 			date_range = 0
-	return {"lat": location["lat"], "lng": location["lng"], "count": count, "date_range": date_range}
+	return count, date_range
 
 # gets the number of months since 0 for a date
 date_score = lambda date: date[0] * 12 + date[1]
 
-# counts the number of locations in a list of locations
-async def coverage_count_chunk(session, locations, radius = 20):
-	tasks = []
-	for location in locations:
-		tasks.append(coverage_count(session, location))
-	responses = await asyncio.gather(*tasks)
-	return responses
-
-# chunks an array into pieces
-def chunk(locations, chunk_size = 500):
-	for i in range(0, len(locations), chunk_size):
-		yield locations[i : i + chunk_size]
+# same as coverage_count, but retries failed or timed out requests with exponential backoff
+# returns None if all attempts failed, so that one bad location can't stop everything else
+# any other error, such as a response that doesn't parse, won't go away by asking again, so it returns None straight away
+async def coverage_count_with_retries(
+	session,
+	location,
+	radius = 10,
+	url = COVERAGE_URL,
+	retries = 3,
+	timeout = 30,
+	backoff = 1,
+	archive = None
+):
+	for attempt in range(retries + 1):
+		try:
+			return await asyncio.wait_for(coverage_count(session, location, radius, url, archive), timeout)
+		except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+			metrics.error(host(url), error_kind(e))
+			if attempt == retries:
+				return None
+			await asyncio.sleep(min(backoff * 2 ** attempt, 60))
+		except Exception as e:
+			metrics.error(host(url), error_kind(e))
+			return None
 
-# gets coverage counts for all locations
-async def get_all_coverage(chunk_size = 500, radius = 20):
-	con = sqlite3.connect("data.db")
-	cur = con.cursor()
-	cur.execute("SELECT lat, lng FROM rounds WHERE date_range IS NULL GROUP BY lat, lng")
-	coords = cur.fetchall()
-	coords = [{"lat": x[0], "lng": x[1]} for x in coords]
+# gets coverage counts for all locations as a stream
+# up to concurrency requests are in flight at once, each worker taking the next location from a queue as soon as it is done
+# results go through another queue to a single writer, which writes them write_batch_size at a time
+# locations that failed every retry are left empty, so that the next run picks them up again
+# archive_path is an optional ResponseArchive that all raw responses are kept in
+# with reuse_radius, locations that close to one that already has counts are given its counts instead, see locations.reuse_nearby_results
+async def get_all_coverage(
+	concurrency = 100,
+	radius = 10,
+	retries = 3,
+	timeout = 30,
+	backoff = 1,
+	write_batch_size = 1000,
+	url = COVERAGE_URL,
+	db_path = "data.db",
+	archive_path = None,
+	reuse_radius = None
+):
+	con = sqlite3.connect(db_path)
+	archive = ResponseArchive(archive_path) if archive_path else None
+	coords = get_locations_without(con, "date_range")
+	if reuse_radius is not None:
+		coords, reused = reuse_nearby_results(con, ["coverage_dates", "date_range"], coords, reuse_radius)
+		update_locations(con, ["coverage_dates", "date_range"], reused)
+		print(f"Reused counts of nearby locations for {len(reused)} locations")
+	coords = [{"location_id": x[0], "lat": x[1], "lng": x[2]} for x in coords]
 	total_coords = len(coords)
-	i = 0
-	async with aiohttp.ClientSession() as session:
-		for locations in chunk(coords, chunk_size):
-			i += chunk_size
-			results = await coverage_count_chunk(session, locations, radius)
-			for result in results:
-				cur.execute(
-					"UPDATE rounds SET coverage_dates = ?, date_range = ? WHERE lat = ? AND lng = ?",
-					(result["count"], result["date_range"], result["lat"], result["lng"])
+	location_queue = asyncio.Queue(maxsize = 2 * concurrency)
+	result_queue = asyncio.Queue()
+	counts = {"done": 0, "failed": 0}
+
+	async def produce():
+		for location in coords:
+			await location_queue.put(location)
+		for i in range(concurrency):
+			await location_queue.put(None)
+
+	async def work(session):
+		while True:
+			location = await location_queue.get()
+			if location is None:
+				return
+			result = await coverage_count_with_retries(session, location, radius, url, retries, timeout, backoff, archive)
+			await result_queue.put(result)
+
+	async def write():
+		pending = []
+		# whatever was already counted is kept, even if the run is cut short
+		try:
+			for i in range(total_coords):
+				result = await result_queue.get()
+				counts["done"] += 1
+				metrics.count("coverage.count")
+				if result is None:
+					counts["failed"] += 1
+					metrics.count("coverage.failed")
+				else:
+					pending.append((result["location_id"], result["count"], result["date_range"]))
+				if len(pending) >= write_batch_size:
+					update_locations(con, ["coverage_dates", "date_range"], pending)
+					pending = []
+				print(
+					f"Got counts for {counts['done']} out of {total_coords} ({counts['failed']} failed)",
+					sep = "",
+					end = "\r",
+					flush = True
 				)
-			con.commit()
-			print(
-			f"Got counts for {i} out of {total_coords}",
-			sep = "",
-			end = "\r",
-			flush = True
-		)
+		finally:
+			update_locations(con, ["coverage_dates", "date_range"], pending)
+
+	connector = aiohttp.TCPConnector(limit = concurrency)
+	async with aiohttp.ClientSession(connector = connector) as session:
+		await asyncio.gather(produce(), write(), *[work(session) for i in range(concurrency)])
+	if archive is not None:
+		archive.close()
+	con.close()
 
+# re-derives the coverage columns of all archived locations, without using the network
+# every archived location is rewritten, so that fixes to parse_coverage apply to everything
+def replay_coverage(archive_path = "responses.db", radius = 10, db_path = "data.db", write_batch_size = 10000):
+	archive = ResponseArchive(archive_path)
+	con = sqlite3.connect(db_path)
+	location_ids = {(x[1], x[2]): x[0] for x in con.execute("SELECT location_id, lat, lng FROM locations")}
+	pending = []
+	replayed_count = 0
+	for (lat, lng, response_radius), contents in archive.iterate("coverage"):
+		location_id = location_ids.get((lat, lng))
+		if response_radius != radius or location_id is None:
+			continue
+		pending.append((location_id, *parse_coverage(contents)))
+		replayed_count += 1
+		if len(pending) >= write_batch_size:
+			update_locations(con, ["coverage_dates", "date_range"], pending)
+			pending = []
+	update_locations(con, ["coverage_dates", "date_range"], pending)
+	print(f"Replayed counts for {replayed_count} locations")
+	archive.close()
+	con.close()
 
 if __name__ == "__main__":
-	asyncio.run(get_all_coverage())
\ No newline at end of file
+	parser = argparse.ArgumentParser(description = "Counts the street view panos near every location")
+	parser.add_argument("--concurrency", type = int, default = 100, help = "most requests in flight at once")
+	parser.add_argument("--retries", type = int, default = 3, help = "retries per location")
+	parser.add_argument("--timeout", type = float, default = 30, help = "seconds before a request is given up on")
+	parser.add_argument("--backoff", type = float, default = 1, help = "seconds before the first retry, doubling after that")
+	parser.add_argument("--url", default = COVERAGE_URL, help = "SingleImageSearch endpoint")
+	parser.add_argument("--archive", default = None, help = "response archive to keep raw responses in, or to replay from")
+	parser.add_argument("--replay", action = "store_true", help = "re-derive all counts from the archive instead of fetching")
+	parser.add_argument("--reuse-radius", type = float, default = None, help = "copy the counts of a location at most this many metres away instead of fetching")
+	add_metrics_arguments(parser)
+	args = parser.parse_args()
+	start_metrics("coverage_count", args)
+	try:
+		if args.replay:
+			replay_coverage(args.archive or "responses.db")
+		else:
+			# everything runs in this thread, so the profile sees all of it
+			with metrics.profiled("coverage"):
+				asyncio.run(get_all_coverage(
+					concurrency = args.concurrency,
+					retries = args.retries,
+					timeout = args.timeout,
+					backoff = args.backoff,
+					url = args.url,
+					archive_path = args.archive,
+					reuse_radius = args.reuse_radius
+				))
+	finally:
+		metrics.stop()
\ No newline at end of file
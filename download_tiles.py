@@ -1,17 +1,135 @@
 import requests
 from PIL import Image
 
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
 from io import BytesIO
+import itertools
+import json
+import os
+import queue
+import re
+import sqlite3
+import threading
 import time
 
+from calculate_coverage_density import ScoreCalculator, TileScoreStore
+from http_utils import TokenBucket, make_session, request_with_retries
+from metrics import add_metrics_arguments, error_kind, host, metrics, start_metrics
+
+# this long url is all official coverage, including trekkers and everything else
+TILE_URL = "https://www.google.com/maps/vt?pb=!1m7!8m6!1m3!1i{z}!2i{x}!3i{y}!2i9!3x1!2m8!1e2!2ssvv!4m2!1scc!2s*211m3*211e2*212b1*213e2*212b1*214b1!4m2!1ssvl!2s*211b0*212b1!3m8!2sen!3sus!5e1105!12m4!1e68!2m2!1sset!2sRoadmap!4e0!5m4!1e0!8m2!1e1!1e1!6m6!1e12!2i2!11e0!39b0!44e0!50e0"
+
 # downloads a single tile
-def get_tile(z, x, y):
-	# this long url is all official coverage, including trekkers and everything else
-	url = f"https://www.google.com/maps/vt?pb=!1m7!8m6!1m3!1i{z}!2i{x}!3i{y}!2i9!3x1!2m8!1e2!2ssvv!4m2!1scc!2s*211m3*211e2*212b1*213e2*212b1*214b1!4m2!1ssvl!2s*211b0*212b1!3m8!2sen!3sus!5e1105!12m4!1e68!2m2!1sset!2sRoadmap!4e0!5m4!1e0!8m2!1e1!1e1!6m6!1e12!2i2!11e0!39b0!44e0!50e0"
-	r = requests.get(url)
-	r.raise_for_status()
+# with a rate limiter, rate limits and server errors are retried, see request_with_retries
+def get_tile(z, x, y, session = requests, url_template = TILE_URL, rate_limiter = None):
+	url = url_template.format(z = z, x = x, y = y)
+	try:
+		with metrics.timed("tiles.request"):
+			if rate_limiter is None:
+				r = session.get(url)
+				r.raise_for_status()
+			else:
+				r = request_with_retries(session, "GET", url, rate_limiter)
+	except Exception as e:
+		metrics.error(host(url), error_kind(e))
+		raise
 	return r.content
 
+# content hash of a tile, which is what changes are detected by
+tile_hash = lambda content: hashlib.blake2b(content, digest_size = 16).hexdigest()
+
+# the content hash of every saved tile, so that anything derived from the tiles can find out which tiles changed
+# see calculate_coverage_density.invalidate_changed_tiles, which reads the tile_hashes table directly
+class TileManifest:
+	def __init__(self, path = "./tiles_manifest.db"):
+		self.con = sqlite3.connect(path)
+		self.con.execute("""CREATE TABLE IF NOT EXISTS tile_hashes(
+			zoom INTEGER,
+			x INTEGER,
+			y INTEGER,
+			hash TEXT,
+			size INTEGER,
+			saved_at INTEGER,
+			PRIMARY KEY (zoom, x, y)
+		)""")
+		self.pending = []
+		self.pending_removals = []
+
+	# records a saved tile, writes are buffered until the next flush
+	def put(self, zoom, x, y, content):
+		self.pending.append((zoom, x, y, tile_hash(content), len(content), int(time.time())))
+
+	# forgets a tile that was deleted, which is a change from something to nothing, buffered the same way as put
+	def remove(self, zoom, x, y):
+		self.pending_removals.append((zoom, x, y))
+
+	def flush(self):
+		if len(self.pending) == 0 and len(self.pending_removals) == 0:
+			return
+		with self.con:
+			self.con.executemany("INSERT OR REPLACE INTO tile_hashes VALUES (?, ?, ?, ?, ?, ?)", self.pending)
+			self.con.executemany("DELETE FROM tile_hashes WHERE zoom = ? AND x = ? AND y = ?", self.pending_removals)
+		self.pending = []
+		self.pending_removals = []
+
+	def close(self):
+		self.flush()
+		self.con.close()
+
+	# records all tiles that are already saved, for tiles that were downloaded before there was a manifest or changed outside of it
+	# tiles that are recorded with the same size and haven't been modified since are skipped, unless rehash is set
+	def add_directory(self, save_path, rehash = False):
+		tile_name = re.compile(r"z(\d+)x(\d+)y(\d+)\.png")
+		recorded = {(x[0], x[1], x[2]): (x[3], x[4]) for x in self.con.execute("SELECT zoom, x, y, size, saved_at FROM tile_hashes")}
+		added_count = 0
+		seen = set()
+		for file_name in os.listdir(save_path):
+			match = tile_name.fullmatch(file_name)
+			if not match:
+				continue
+			key = tuple(int(x) for x in match.groups())
+			seen.add(key)
+			tile_stat = os.stat(f"{save_path}/{file_name}")
+			size, saved_at = recorded.get(key, (None, None))
+			if not rehash and size == tile_stat.st_size and tile_stat.st_mtime < saved_at:
+				continue
+			with open(f"{save_path}/{file_name}", "rb") as f:
+				self.put(*key, f.read())
+			added_count += 1
+			if len(self.pending) >= 10000:
+				self.flush()
+		self.flush()
+		# tiles that aren't saved anymore have changed too, from something to nothing
+		for key in set(recorded) - seen:
+			self.remove(*key)
+		self.flush()
+		return added_count
+
+# tells empty tiles apart from ones with coverage, without decoding the blank tiles that most of every level is made of
+# every empty tile that does get decoded is remembered by its size and hash, so that the same bytes are recognised straight away afterwards
+# blank tiles are byte for byte the same, so after the first few, decoding is only needed for tiles that actually have coverage
+class TileClassifier:
+	def __init__(self):
+		self.blank_sizes = set()
+		self.blank_hashes = set()
+		self.score_calculator = ScoreCalculator(cache_tile_scores = False)
+
+	# gets the number of pixels with coverage (the tile score, see ScoreCalculator.score_image), or None if the tile is empty
+	def classify(self, content):
+		# the size check is free, and keeps the hashing away from tiles that can't be blank
+		if len(content) in self.blank_sizes and tile_hash(content) in self.blank_hashes:
+			metrics.count("tiles.blank")
+			return None
+		image = Image.open(BytesIO(content))
+		# same check as is_empty
+		if image.getextrema()[1] == 0:
+			self.blank_sizes.add(len(content))
+			self.blank_hashes.add(tile_hash(content))
+			return None
+		return self.score_calculator.score_image(image)
+
 # checks whether an image is empty
 def is_empty(image_string):
 	buff = BytesIO()
@@ -56,14 +174,284 @@ def get_next_zoom(zoom_level, prev_coords, save_path = None):
 		retry_coords = new_retry_coords
 	return nonempty_coords
 
-if __name__ == "__main__":
+# the four tiles of the next zoom level that cover a tile
+get_children = lambda coords: [[2 * coords[0] + i, 2 * coords[1] + j] for i in range(2) for j in range(2)]
+
+# gets the (x, y) of all saved tiles, by zoom level
+def get_saved_tiles(save_path):
+	tile_name = re.compile(r"z(\d+)x(\d+)y(\d+)\.png")
+	levels = {}
+	for file_name in os.listdir(save_path):
+		match = tile_name.fullmatch(file_name)
+		if match:
+			levels.setdefault(int(match.group(1)), set()).add((int(match.group(2)), int(match.group(3))))
+	return levels
+
+# deletes the saved tiles whose parent isn't saved, going down one level at a time
+# a parent that has become empty since the last download doesn't have its children checked again, so they are left over from before
+# returns (zoom, x, y) of the deleted tiles
+def remove_orphaned_tiles(save_path):
+	levels = get_saved_tiles(save_path)
+	removed = []
+	# level 1 is the first level that is downloaded, so its parent is never saved
+	for level in sorted(x for x in levels if x > 1):
+		for x, y in sorted(levels[level]):
+			if (x // 2, y // 2) not in levels.get(level - 1, set()):
+				os.remove(f"{save_path}/z{level}x{x}y{y}.png")
+				levels[level].discard((x, y))
+				removed.append((level, x, y))
+	metrics.count("tiles.orphaned", len(removed))
+	return removed
+
+# the state of a download, which is all that is needed to continue it
+# level is the zoom level being downloaded, parents are the non-empty tiles of the level above it
+# done holds the indices of parents whose children have all been checked, and nonempty the non-empty tiles found so far
+new_download_state = lambda level, parents: {"level": level, "parents": parents, "done": [], "nonempty": []}
+
+# saves the download state, written to a temporary file first so that an interruption can't leave a broken checkpoint
+def save_checkpoint(state, checkpoint_path):
+	with open(checkpoint_path + ".tmp", "w") as f:
+		json.dump(state, f)
+	os.replace(checkpoint_path + ".tmp", checkpoint_path)
+
+def load_checkpoint(checkpoint_path):
+	with open(checkpoint_path) as f:
+		return json.load(f)
+
+# rebuilds the download state from tiles that are already saved, for when there is no checkpoint
+# the deepest level on disk is continued: its saved tiles count as found, and parents with all four children saved count as done
+# empty tiles are never saved, so the other parents have to be checked again
+def frontier_from_disk(save_path):
+	levels = get_saved_tiles(save_path)
+	if len(levels) == 0:
+		return new_download_state(1, [[0, 0]])
+	level = max(levels)
+	parents = sorted(levels.get(level - 1, set())) if level > 1 else [(0, 0)]
+	found = levels[level]
+	state = new_download_state(level, [list(x) for x in parents])
+	state["nonempty"] = [list(x) for x in sorted(found)]
+	state["done"] = [i for i, parent in enumerate(parents) if all(tuple(x) in found for x in get_children(parent))]
+	return state
+
+# downloads one level of a download state, and returns the state for the next level
+# fetching, classifying and writing are separate stages joined by bounded queues, so that the network never waits on decoding or the disk:
+# several threads fetch the four children of a parent, one thread classifies them, and one thread writes the non-empty ones
+# a tile that was saved before but is empty now has its file deleted by the writing thread, and is taken out of the manifest
+# a parent only counts as done once its non-empty children are written, which is what the checkpoint (saved every checkpoint_seconds) relies on
+# parents that failed at any stage are retried with a backoff until they succeed
+# with a tile_store_path, the score of every written tile goes into that TileScoreStore, so that the density scorer doesn't decode it again
+def download_level(
+	state,
+	save_path,
+	session,
+	rate_limiter,
+	workers = 4,
+	checkpoint_path = None,
+	checkpoint_seconds = 30,
+	url_template = TILE_URL,
+	manifest = None,
+	classifier = None,
+	tile_store_path = None
+):
+	zoom_level = state["level"]
+	parents = state["parents"]
+	done = set(state["done"])
+	nonempty = {tuple(x) for x in state["nonempty"]}
+	classifier = classifier or TileClassifier()
+	classify_queue = queue.Queue(maxsize = 2 * workers)
+	write_queue = queue.Queue(maxsize = 2 * workers)
+	# (parent index, non-empty children, (x, y, content) of the saved children, (x, y) of the deleted children)
+	# with None instead of the lists if the parent failed
+	results = queue.Queue()
+
+	# fetches the children of a parent, leaving out the ones that were found before an interruption
+	def fetch_parent(i):
+		try:
+			tiles = []
+			for coords in get_children(parents[i]):
+				content = None if tuple(coords) in nonempty else get_tile(zoom_level, coords[0], coords[1], session, url_template, rate_limiter)
+				tiles.append((coords, content))
+		except Exception:
+			results.put((i, None, None, None))
+			return
+		classify_queue.put((i, tiles))
+
+	def classify():
+		while (item := classify_queue.get()) is not None:
+			i, tiles = item
+			try:
+				found = []
+				to_write = []
+				empty = []
+				for coords, content in tiles:
+					if content is None:
+						found.append(coords)
+						continue
+					with metrics.stage("tiles.classify"):
+						score = classifier.classify(content)
+					metrics.count("tiles.classify")
+					if score is None:
+						empty.append(coords)
+					else:
+						found.append(coords)
+						to_write.append((coords, content, score))
+			except Exception:
+				results.put((i, None, None, None))
+				continue
+			write_queue.put((i, found, to_write, empty))
+		write_queue.put(None)
+
+	def write():
+		# sqlite connections belong to the thread that made them
+		tile_store = TileScoreStore(tile_store_path) if tile_store_path else None
+		while (item := write_queue.get()) is not None:
+			i, found, to_write, empty = item
+			try:
+				removed = []
+				for coords in empty:
+					tile_name = f"{save_path}/z{zoom_level}x{coords[0]}y{coords[1]}.png"
+					if os.path.isfile(tile_name):
+						os.remove(tile_name)
+						removed.append(coords)
+				metrics.count("tiles.removed", len(removed))
+				for coords, content, score in to_write:
+					tile_name = f"{save_path}/z{zoom_level}x{coords[0]}y{coords[1]}.png"
+					with metrics.stage("tiles.write"), open(tile_name, "wb") as f:
+						f.write(content)
+					metrics.count("tiles.write")
+					if tile_store is not None:
+						tile_stat = os.stat(tile_name)
+						tile_store.put(zoom_level, coords[0], coords[1], tile_stat.st_mtime_ns, tile_stat.st_size, score)
+			except Exception:
+				results.put((i, None, None, None))
+				continue
+			results.put((i, found, [(x[0][0], x[0][1], x[1]) for x in to_write], removed))
+		if tile_store is not None:
+			tile_store.close()
+
+	def checkpoint():
+		# the manifest goes first, so that a tile in the checkpoint is always in the manifest too
+		if manifest is not None:
+			manifest.flush()
+		if checkpoint_path:
+			state["done"] = sorted(done)
+			state["nonempty"] = [list(x) for x in sorted(nonempty)]
+			with metrics.stage("tiles.checkpoint"):
+				save_checkpoint(state, checkpoint_path)
+
+	stages = [threading.Thread(target = classify), threading.Thread(target = write)]
+	for thread in stages:
+		thread.start()
+	retry_count = 0
+	checkpointed_at = time.monotonic()
+	try:
+		with ThreadPoolExecutor(workers) as executor:
+			while len(done) < len(parents):
+				pending = iter([i for i in range(len(parents)) if i not in done])
+				# parents that have been handed to the fetchers but haven't come out of the last stage yet
+				in_flight = 0
+				for i in itertools.islice(pending, 4 * workers):
+					executor.submit(fetch_parent, i)
+					in_flight += 1
+				while in_flight > 0:
+					try:
+						i, found, saved, removed = results.get(timeout = checkpoint_seconds)
+					except queue.Empty:
+						i = None
+					if i is not None:
+						in_flight -= 1
+						# failed parents are tried again in the next pass
+						if found is not None:
+							nonempty.update(tuple(x) for x in found)
+							done.add(i)
+							if manifest is not None:
+								for x, y, content in saved:
+									manifest.put(zoom_level, x, y, content)
+								for x, y in removed:
+									manifest.remove(zoom_level, x, y)
+						next_i = next(pending, None)
+						if next_i is not None:
+							executor.submit(fetch_parent, next_i)
+							in_flight += 1
+					if time.monotonic() - checkpointed_at >= checkpoint_seconds:
+						checkpoint()
+						checkpointed_at = time.monotonic()
+					print(
+						f"Zoom level {zoom_level}: checked {len(done)} out of {len(parents)} tiles, found {len(nonempty)} non-empty tiles",
+						sep = "",
+						end = "\r",
+						flush = True
+					)
+				if len(done) < len(parents):
+					time.sleep(min(2 ** retry_count, 60))
+					retry_count += 1
+	finally:
+		classify_queue.put(None)
+		for thread in stages:
+			thread.join()
+	checkpoint()
+	return new_download_state(zoom_level + 1, [list(x) for x in sorted(nonempty)])
+
+# downloads all levels up to max_level, continuing from the checkpoint if there is one
+# with rebuild_frontier, the checkpoint is ignored and the state is rebuilt from the tiles in save_path instead
+# once every level is done, tiles under parents that turned out empty are deleted, see remove_orphaned_tiles
+def download_all_levels(
+	max_level = 12,
+	save_path = "./tiles",
+	workers = 4,
+	requests_per_second = 5,
+	checkpoint_path = "./tiles_checkpoint.json",
+	rebuild_frontier = False,
+	url_template = TILE_URL,
+	manifest_path = "./tiles_manifest.db",
+	tile_store_path = None
+):
+	if rebuild_frontier:
+		state = frontier_from_disk(save_path)
+	elif checkpoint_path and os.path.isfile(checkpoint_path):
+		state = load_checkpoint(checkpoint_path)
+	else:
+		state = new_download_state(1, [[0, 0]])
+	session = make_session(workers)
+	rate_limiter = TokenBucket(requests_per_second)
+	manifest = TileManifest(manifest_path) if manifest_path else None
+	# kept for all levels, so that the blank tiles it has learned carry over
+	classifier = TileClassifier()
+	start_time = time.time()
+	while state["level"] <= max_level:
+		current_level = state["level"]
+		with metrics.profiled(f"level{current_level}"):
+			state = download_level(
+				state,
+				save_path,
+				session,
+				rate_limiter,
+				workers,
+				checkpoint_path,
+				url_template = url_template,
+				manifest = manifest,
+				classifier = classifier,
+				tile_store_path = tile_store_path
+			)
+		if checkpoint_path:
+			save_checkpoint(state, checkpoint_path)
+		time_diff = round(time.time() - start_time, 2)
+		print(f"\nDownloaded zoom level {current_level} out of {max_level} in {time_diff} seconds")
+	session.close()
+	for zoom, x, y in remove_orphaned_tiles(save_path):
+		if manifest is not None:
+			manifest.remove(zoom, x, y)
+	if manifest is not None:
+		manifest.close()
+
+# the original downloader, one tile at a time and without any way to continue after an interruption
+def download_sequentially(max_level = 12, save_path = "./tiles"):
 	start_time = time.time()
-	max_level = 12
 	valid_coords = [[0, 0]]
 	current_level = 0
 	for i in range(1, max_level + 1):
 		current_level += 1
-		valid_coords = get_next_zoom(current_level, valid_coords, "./tiles")
+		valid_coords = get_next_zoom(current_level, valid_coords, save_path)
 		current_time = time.time()
 		time_diff = round(current_time - start_time, 2)
 		print(
@@ -71,4 +459,42 @@ if __name__ == "__main__":
 			sep = "",
 			end = "\r",
 			flush = True
-		)
\ No newline at end of file
+		)
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description = "Downloads all non-empty street view coverage tiles")
+	parser.add_argument("--max-level", type = int, default = 12, help = "deepest zoom level to download")
+	parser.add_argument("--save-path", default = "./tiles", help = "directory that the tiles are saved to")
+	parser.add_argument("--workers", type = int, default = 4, help = "number of tiles downloaded at once")
+	parser.add_argument("--requests-per-second", type = float, default = 5, help = "overall request rate limit")
+	parser.add_argument("--checkpoint", default = "./tiles_checkpoint.json", help = "file that the download progress is kept in")
+	parser.add_argument("--rebuild-frontier", action = "store_true", help = "rebuild the progress from the saved tiles")
+	parser.add_argument("--tile-url", default = TILE_URL, help = "tile url with {z}, {x} and {y} placeholders")
+	parser.add_argument("--sequential", action = "store_true", help = "use the original one tile at a time downloader")
+	parser.add_argument("--manifest", default = "./tiles_manifest.db", help = "file that the content hash of every saved tile is kept in")
+	parser.add_argument("--hash-existing", action = "store_true", help = "only add the tiles that are already saved to the manifest")
+	parser.add_argument("--tile-store", default = None, help = "persistent tile score store that the score of every saved tile is added to")
+	add_metrics_arguments(parser)
+	args = parser.parse_args()
+	start_metrics("download_tiles", args)
+	try:
+		if args.hash_existing:
+			manifest = TileManifest(args.manifest)
+			print(f"Added {manifest.add_directory(args.save_path)} tiles to the manifest")
+			manifest.close()
+		elif args.sequential:
+			download_sequentially(args.max_level, args.save_path)
+		else:
+			download_all_levels(
+				args.max_level,
+				args.save_path,
+				args.workers,
+				args.requests_per_second,
+				args.checkpoint,
+				args.rebuild_frontier,
+				args.tile_url,
+				args.manifest,
+				args.tile_store
+			)
+	finally:
+		metrics.stop()
\ No newline at end of file
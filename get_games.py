@@ -9,8 +9,42 @@
 
 import requests
 
+import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime, timezone
+import gzip
 import json
+import os
 import sqlite3
+import time
+
+from http_utils import RETRY_STATUSES, TokenBucket, make_session, request_with_retries
+from locations import link_locations
+from metrics import add_metrics_arguments, error_kind, host, metrics, start_metrics
+from response_archive import ResponseArchive
+
+DUELS_URL = "https://game-server.geoguessr.com/api/duels/"
+
+# failure reasons that can go away on their own, so they are worth retrying later
+TRANSIENT_REASONS = {"http_transient", "unfinished"}
+
+# a game that can't be used, reason is one of "unfinished", "draw" or "bot_team"
+class GameError(Exception):
+	def __init__(self, reason, message):
+		super().__init__(message)
+		self.reason = reason
+
+# gets a (reason, detail) pair for why a game failed
+def classify_failure(e):
+	if isinstance(e, GameError):
+		return (e.reason, str(e))
+	if isinstance(e, requests.HTTPError):
+		status = e.response.status_code
+		return ("http_transient" if status in RETRY_STATUSES else "http", f"HTTP {status}")
+	if isinstance(e, requests.RequestException):
+		return ("http_transient", repr(e))
+	# anything else means the response didn't look like we expected
+	return ("parse", repr(e))
 
 # stringified percent for the progress bar
 percent = lambda done, total: str(round(done / total * 100)).rjust(3) + "%"
@@ -22,19 +56,49 @@ flatten = lambda l: [x for l2 in l for x in l2]
 convert_pano_id = lambda pano: None if not pano else convert_pano_id_raw(pano)
 convert_pano_id_raw = lambda pano: "".join(chr(int(pano[i:i+2], 16)) for i in range(0, len(pano), 2))
 
-# get a round by round number
-get_round = lambda round_number, rounds: [x for x in rounds if x["roundNumber"] == round_number]
+# converts one of the api's utc timestamps (like "2023-01-01T12:34:56.789Z") to unix seconds, None if it is missing
+# fractions of a second are cut off, since started_at and ended_at are stored as whole seconds
+parse_time = lambda text: None if not text else int(datetime.strptime(text[:19], "%Y-%m-%dT%H:%M:%S").replace(tzinfo = timezone.utc).timestamp())
+
+# indexes a team's round results by round number
+# a round number that shows up more than once can't be trusted, so it is left out, same as a round that is missing
+def index_rounds(rounds):
+	indexed = {}
+	for x in rounds:
+		indexed[x["roundNumber"]] = None if x["roundNumber"] in indexed else x
+	return {k: v for k, v in indexed.items() if v is not None}
+
+# gets the raw api response for a single game
+# the session can be a pooled session from make_session, and retries and rate limiting are only done if a rate limiter is given
+# if an archive is given, the raw response is stored in it, see replay_games
+def fetch_game(game_id, cookies, session = requests, base_url = DUELS_URL, rate_limiter = None, retries = 5, archive = None):
+	try:
+		with metrics.timed("games.request"):
+			if rate_limiter is None:
+				results = session.get(base_url + game_id, cookies = cookies)
+				results.raise_for_status()
+			else:
+				results = request_with_retries(session, "GET", base_url + game_id, rate_limiter, retries, cookies = cookies)
+			game = results.json()
+	except Exception as e:
+		metrics.error(host(base_url), error_kind(e))
+		raise
+	if archive is not None:
+		archive.put("duel", game_id, game)
+	return game
 
 # get data from a single game
-def get_game(game_id, cookies):
-	base_url = "https://game-server.geoguessr.com/api/duels/"
-	url = base_url + game_id
-	# get api response
-	results = requests.get(url, cookies = cookies)
-	results.raise_for_status()
-	game = results.json()
-	if game["status"] != "Finished" or game["result"]["isDraw"]:
-		raise Exception("game has no conclusive results")
+def get_game(game_id, cookies, session = requests, base_url = DUELS_URL, rate_limiter = None, retries = 5, archive = None):
+	game = fetch_game(game_id, cookies, session, base_url, rate_limiter, retries, archive)
+	with metrics.stage("games.parse"):
+		return parse_game(game, game_id)
+
+# gets game, player and round info from a raw api response
+def parse_game(game, game_id):
+	if game["status"] != "Finished":
+		raise GameError("unfinished", "game has not finished yet")
+	if game["result"]["isDraw"]:
+		raise GameError("draw", "game has no conclusive results")
 	# first, get the game info
 	game_info = {}
 	# only nm and nmpz exist, so safe to assume that no panning == nmpz
@@ -46,6 +110,11 @@ def get_game(game_id, cookies):
 	# miscellaneous stuff
 	game_info["game_id"] = game_id
 	game_info["round_count"] = game["currentRoundNumber"]
+	# the game itself has no timestamps, so they are taken from its rounds, where rounds that were never played have none
+	start_times = [parse_time(x.get("startTime")) for x in game["rounds"] if x.get("startTime")]
+	end_times = [parse_time(x.get("endTime")) for x in game["rounds"] if x.get("endTime")]
+	game_info["started_at"] = min(start_times, default = None)
+	game_info["ended_at"] = max(end_times, default = None)
 	# get the relevant players, will be used to reconstruct elo later
 	game_info["winning_team"] = int(game["teams"][0]["id"] == game["result"]["winningTeamId"]) + 1
 	players = [
@@ -62,7 +131,7 @@ def get_game(game_id, cookies):
 	]
 	# can't clearly identify bot
 	if len(players[0]) != 2 or len(players[1]) != 2:
-		raise Exception("team has incorrect amount of players")
+		raise GameError("bot_team", "team has incorrect amount of players")
 	game_info["team1_player1"] = players[0][0]["player_id"]
 	game_info["team1_player2"] = players[0][1]["player_id"]
 	game_info["team2_player1"] = players[1][0]["player_id"]
@@ -70,6 +139,7 @@ def get_game(game_id, cookies):
 	player_info = flatten(players)
 	# now, get the round info
 	round_info = []
+	team_results = [index_rounds(game["teams"][i]["roundResults"]) for i in range(2)]
 	for current_round in game["rounds"]:
 		current_pano = current_round["panorama"]
 		this_round = {}
@@ -82,15 +152,15 @@ def get_game(game_id, cookies):
 		this_round["zoom"] = current_pano["zoom"]
 		this_round["country_code"] = current_pano["countryCode"]
 		this_round["pano_id"] = convert_pano_id(current_pano["panoId"])
-		team_rounds = [get_round(current_round["roundNumber"], game["teams"][i]["roundResults"]) for i in range(2)]
+		team_rounds = [team_results[i].get(current_round["roundNumber"]) for i in range(2)]
 		for i in range(2):
-			if(len(team_rounds[i]) != 1):
+			if team_rounds[i] is None:
 				this_round[f"team{i+1}_lat"] = None
 				this_round[f"team{i+1}_lng"] = None
 				this_round[f"team{i+1}_distance"] = None
 				this_round[f"team{i+1}_score"] = 0
 			else:
-				team_round = team_rounds[i][0]
+				team_round = team_rounds[i]
 				best_guess = team_round["bestGuess"]
 				this_round[f"team{i+1}_lat"] = best_guess["lat"]
 				this_round[f"team{i+1}_lng"] = best_guess["lng"]
@@ -102,46 +172,394 @@ def get_game(game_id, cookies):
 			round_info.append(this_round)
 	return [game_info, player_info, round_info]
 
-# inserts a dictionary into an sqlite table, see https://stackoverflow.com/a/36678361
+# the insert statement for a table only depends on its columns, so it is only built once
+insert_statements = {}
+
+# gets the (cached) insert statement for a table and a tuple of columns, see https://stackoverflow.com/a/36678361
+def get_insert_statement(table, columns):
+	key = (table, columns)
+	if key not in insert_statements:
+		cols = ', '.join('"{}"'.format(col) for col in columns)
+		vals = ', '.join(':{}'.format(col) for col in columns)
+		insert_statements[key] = 'INSERT INTO "{0}" ({1}) VALUES ({2})'.format(table, cols, vals)
+	return insert_statements[key]
+
+# inserts a dictionary into an sqlite table
 # does not validate anything!
 def insert_dictionary(con, table, row):
-	cols = ', '.join('"{}"'.format(col) for col in row.keys())
-	vals = ', '.join(':{}'.format(col) for col in row.keys())
-	sql = 'INSERT INTO "{0}" ({1}) VALUES ({2})'.format(table, cols, vals)
-	con.cursor().execute(sql, row)
+	con.cursor().execute(get_insert_statement(table, tuple(row.keys())), row)
 	con.commit()
 
-def get_all_games():
+# opt-in ingest profile: with wal journaling and synchronous = normal, commits no longer wait for an fsync each
+# a power loss can lose the last few commits, but never corrupts the database
+def use_ingest_profile(con):
+	con.execute("PRAGMA journal_mode = WAL")
+	con.execute("PRAGMA synchronous = NORMAL")
+
+# buffers games, and writes them with one executemany per table in a single transaction
+# a flush happens every batch_games games or every flush_seconds seconds, whichever comes first
+# with replace, any rows that are already stored for a game are replaced instead of the game being skipped
+class BulkWriter:
+	def __init__(self, con, batch_games = 100, flush_seconds = 5, replace = False):
+		self.con = con
+		self.replace = replace
+		self.batch_games = batch_games
+		self.flush_seconds = flush_seconds
+		self.games = []
+		self.failures = []
+		self.flushed_at = time.monotonic()
+
+	# checks whether enough has been buffered to write it
+	def flush_if_due(self):
+		if len(self.games) + len(self.failures) >= self.batch_games or time.monotonic() - self.flushed_at >= self.flush_seconds:
+			self.flush()
+
+	# adds a game as returned by get_game
+	def add_game(self, game_info, player_info, round_info):
+		rows = [("games", game_info)]
+		rows.extend(("player_ratings", player) for player in player_info)
+		rows.extend(("rounds", current_round) for current_round in round_info)
+		self.games.append(rows)
+		self.flush_if_due()
+
+	# records why a game couldn't be ingested, see classify_failure
+	def add_failure(self, game_id, reason, detail):
+		self.failures.append((game_id, reason, detail, int(time.time())))
+		self.flush_if_due()
+
+	# writes the given games and failures in a single transaction
+	def write_games(self, games, failures = []):
+		grouped_rows = {}
+		for rows in games:
+			for (table, row) in rows:
+				grouped_rows.setdefault((table, tuple(row.keys())), []).append(row)
+		game_ids = [(rows[0][1]["game_id"],) for rows in games]
+		with self.con:
+			if self.replace:
+				for table in ["rounds", "player_ratings", "games"]:
+					self.con.executemany(f"DELETE FROM {table} WHERE game_id = ?", game_ids)
+			for (table, columns), rows in grouped_rows.items():
+				self.con.executemany(get_insert_statement(table, columns), rows)
+			# games that failed before but worked now are no longer failures
+			self.con.executemany("DELETE FROM failed_games WHERE game_id = ?", game_ids)
+			self.con.executemany("INSERT OR REPLACE INTO failed_games VALUES (?, ?, ?, ?)", failures)
+
+	def flush(self):
+		with metrics.stage("games.write"):
+			try:
+				self.write_games(self.games, self.failures)
+			except sqlite3.IntegrityError:
+				# a single bad game (such as one that is already in the database) shouldn't lose the whole batch
+				# so fall back to writing games one by one, skipping the ones that fail
+				for rows in self.games:
+					try:
+						self.write_games([rows])
+					except sqlite3.IntegrityError:
+						pass
+				self.write_games([], self.failures)
+			if len(self.games) > 0:
+				link_locations(self.con)
+		metrics.count("games.write", len(self.games))
+		self.games = []
+		self.failures = []
+		self.flushed_at = time.monotonic()
+
+	def close(self):
+		self.flush()
+
+# gets many games at once, yielding (game_id, [game_info, player_info, round_info]) as soon as each one is done
+# if a game fails, the exception is yielded in place of its data
+# up to max_concurrency games are fetched and parsed in other threads, so the caller can insert while they wait on the network
+def get_games_concurrently(
+	game_ids,
+	cookies,
+	max_concurrency = 8,
+	requests_per_second = 10,
+	retries = 5,
+	base_url = DUELS_URL,
+	archive = None
+):
+	session = make_session(max_concurrency)
+	rate_limiter = TokenBucket(requests_per_second)
+
+	def get_game_safely(game_id):
+		try:
+			return get_game(game_id, cookies, session, base_url, rate_limiter, retries, archive)
+		except Exception as e:
+			return e
+
+	game_ids = iter(game_ids)
+	with ThreadPoolExecutor(max_concurrency) as executor:
+		# only keep a limited amount of games queued, so that the whole id list isn't turned into futures at once
+		in_flight = {}
+		for game_id in game_ids:
+			in_flight[executor.submit(get_game_safely, game_id)] = game_id
+			if len(in_flight) >= 2 * max_concurrency:
+				break
+		while len(in_flight) > 0:
+			done, _ = wait(in_flight, return_when = FIRST_COMPLETED)
+			for future in done:
+				yield in_flight.pop(future), future.result()
+				next_id = next(game_ids, None)
+				if next_id is not None:
+					in_flight[executor.submit(get_game_safely, next_id)] = next_id
+	session.close()
+
+# picks the game ids that still need to be fetched
+# games that are already in the database are always skipped, and failed games are only retried if retry_failures says so:
+# "none" skips all of them, "transient" retries the ones that failed for reasons that might go away, and "all" retries everything
+def get_pending_game_ids(con, game_ids, retry_failures = "none"):
+	done_ids = {x[0] for x in con.execute("SELECT game_id FROM games")}
+	failures = dict(con.execute("SELECT game_id, reason FROM failed_games"))
+	pending_ids = []
+	for game_id in game_ids:
+		if game_id in done_ids:
+			continue
+		if game_id in failures:
+			if retry_failures == "none" or (retry_failures == "transient" and failures[game_id] not in TRANSIENT_REASONS):
+				continue
+		pending_ids.append(game_id)
+	# ids can show up more than once in the list, but only need to be fetched once
+	return list(dict.fromkeys(pending_ids))
+
+# games are written batch_games at a time, see BulkWriter
+# ingest_profile switches the database to wal mode with synchronous = normal
+# with resume, games that are already in the database or have failed before are skipped, see get_pending_game_ids
+# archive_path is an optional ResponseArchive that all raw responses are kept in
+def get_all_games(
+	max_concurrency = 8,
+	requests_per_second = 10,
+	retries = 5,
+	base_url = DUELS_URL,
+	cookies_path = "cookies.json",
+	game_ids_path = "game_ids.txt",
+	db_path = "data.db",
+	batch_games = 100,
+	flush_seconds = 5,
+	ingest_profile = False,
+	resume = True,
+	retry_failures = "none",
+	archive_path = None
+):
 	# the api doesn't work while logged out
-	with open("cookies.json") as f:
+	with open(cookies_path) as f:
 		cookies = json.load(f)
-	with open("game_ids.txt") as f:
-		game_ids = f.read().split(", ")
-	con = sqlite3.connect("data.db")
+	with open(game_ids_path) as f:
+		game_ids = [x.strip() for x in f.read().split(", ") if x.strip()]
+	con = sqlite3.connect(db_path)
+	if ingest_profile:
+		use_ingest_profile(con)
+	writer = BulkWriter(con, batch_games, flush_seconds)
+	if resume:
+		all_count = len(game_ids)
+		game_ids = get_pending_game_ids(con, game_ids, retry_failures)
+		print(f"Skipping {all_count - len(game_ids)} games that were already collected or failed")
 	game_count = len(game_ids)
 	print(f"Collecting data from {game_count} games")
 	parsed_count = 0
 	success_count = 0
-	for game_id in game_ids:
-		parsed_count += 1
+	archive = ResponseArchive(archive_path) if archive_path else None
+	games = get_games_concurrently(game_ids, cookies, max_concurrency, requests_per_second, retries, base_url, archive)
+	with metrics.profiled("ingest"):
+		for game_id, result in games:
+			parsed_count += 1
+			if isinstance(result, Exception):
+				# a few missing data points are fine, but keep track of why so that they can be retried if it makes sense
+				writer.add_failure(game_id, *classify_failure(result))
+				metrics.count("games.failed")
+			else:
+				writer.add_game(*result)
+				success_count += 1
+			metrics.count("games.fetched")
+			# keep a progress indicator in the terminal
+			print(
+				f"({percent(parsed_count, game_count)}) Parsed {parsed_count} games ({success_count} successful)",
+				sep = "",
+				end = "\r",
+				flush = True
+			)
+	writer.close()
+	if archive is not None:
+		archive.close()
+
+# re-derives all games from the raw responses in an archive, without using the network
+# games that are already stored are replaced, so that fixes to parse_game apply to everything
+def replay_games(archive_path = "responses.db", db_path = "data.db", batch_games = 1000):
+	archive = ResponseArchive(archive_path)
+	con = sqlite3.connect(db_path)
+	writer = BulkWriter(con, batch_games, flush_seconds = float("inf"), replace = True)
+	game_count = archive.count("duel")
+	print(f"Replaying {game_count} archived games")
+	parsed_count = 0
+	success_count = 0
+	with metrics.profiled("replay"):
+		for game_id, game in archive.iterate("duel"):
+			parsed_count += 1
+			try:
+				with metrics.stage("games.parse"):
+					parsed = parse_game(game, game_id)
+				writer.add_game(*parsed)
+				success_count += 1
+			except Exception as e:
+				writer.add_failure(game_id, *classify_failure(e))
+			metrics.count("games.parse")
+			print(
+				f"({percent(parsed_count, game_count)}) Parsed {parsed_count} games ({success_count} successful)",
+				sep = "",
+				end = "\r",
+				flush = True
+			)
+	writer.close()
+	archive.close()
+
+# parses a list of raw json lines, each being a single api response, see ingest_jsonl
+# gets (game_id, [game_info, player_info, round_info], None) for every game, or (game_id, None, (reason, detail)) if it failed
+# runs in a separate process, so exceptions are turned into plain tuples here instead of being sent back
+# returns the results together with the wall and cpu time spent, since those can't be recorded in the metrics of another process
+def parse_lines(lines):
+	start = time.perf_counter()
+	cpu_start = time.thread_time()
+	results = []
+	for line in lines:
+		if not line.strip():
+			continue
 		try:
-			game_info, player_info, round_info = get_game(game_id, cookies)
-			insert_dictionary(con, "games", game_info)
-			for player in player_info:
-				insert_dictionary(con, "player_ratings", player)
-			for current_round in round_info:
-				insert_dictionary(con, "rounds", current_round)
-			success_count += 1
-		except:
-			# if we failed to decode, we can just skip, a few missing data points are fine
-			pass
-		# keep a progress indicator in the terminal
+			game = json.loads(line)
+			game_id = game["gameId"]
+		except (ValueError, TypeError, KeyError) as e:
+			results.append((None, None, ("parse", repr(e))))
+			continue
+		try:
+			results.append((game_id, parse_game(game, game_id), None))
+		except Exception as e:
+			results.append((game_id, None, classify_failure(e)))
+	return results, time.perf_counter() - start, time.thread_time() - cpu_start
+
+# reads a jsonl file (optionally gzipped) chunk_size lines at a time, without loading all of it into memory
+def read_line_chunks(paths, chunk_size):
+	for path in paths:
+		with (gzip.open(path) if path.endswith(".gz") else open(path, "rb")) as f:
+			chunk = []
+			for line in f:
+				chunk.append(line)
+				if len(chunk) >= chunk_size:
+					yield chunk
+					chunk = []
+			if len(chunk) > 0:
+				yield chunk
+
+# ingests raw api responses from jsonl files, one game per line, without using the network
+# lines are parsed by worker processes, chunk_size lines at a time, while this process writes them, see BulkWriter
+# only a few chunks are in flight at once, so that files of any size can be streamed
+# games that are already in the database are skipped, unless replace is set, in which case they are re-parsed and replaced
+def ingest_jsonl(
+	paths,
+	workers = None,
+	chunk_size = 500,
+	db_path = "data.db",
+	batch_games = 1000,
+	ingest_profile = False,
+	replace = False
+):
+	workers = workers or os.cpu_count()
+	con = sqlite3.connect(db_path)
+	if ingest_profile:
+		use_ingest_profile(con)
+	writer = BulkWriter(con, batch_games, flush_seconds = float("inf"), replace = replace)
+	done_ids = set() if replace else {x[0] for x in con.execute("SELECT game_id FROM games")}
+	counts = {"parsed": 0, "successful": 0, "skipped": 0, "invalid": 0}
+	print(f"Ingesting games from {len(paths)} files using {workers} processes")
+
+	def add_results(results, wall_seconds, cpu_seconds):
+		metrics.add_time("games.parse", wall_seconds, cpu_seconds)
+		metrics.count("games.parse", len(results))
+		for game_id, result, failure in results:
+			counts["parsed"] += 1
+			if game_id is None:
+				# without an id, there is nothing to record the failure under
+				counts["invalid"] += 1
+			elif game_id in done_ids:
+				counts["skipped"] += 1
+			elif failure is not None:
+				writer.add_failure(game_id, *failure)
+			else:
+				# the same game can be in a file more than once, but is only written once
+				done_ids.add(game_id)
+				writer.add_game(*result)
+				counts["successful"] += 1
 		print(
-			f"({percent(parsed_count, game_count)}) Parsed {parsed_count} games ({success_count} successful)",
+			f"Parsed {counts['parsed']} games ({counts['successful']} successful, {counts['skipped']} skipped, {counts['invalid']} invalid)",
 			sep = "",
 			end = "\r",
 			flush = True
 		)
 
+	chunks = read_line_chunks(paths, chunk_size)
+	with metrics.profiled("ingest_jsonl"):
+		if workers == 1:
+			for chunk in chunks:
+				add_results(*parse_lines(chunk))
+		else:
+			with ProcessPoolExecutor(workers) as executor:
+				in_flight = set()
+				for chunk in chunks:
+					in_flight.add(executor.submit(parse_lines, chunk))
+					if len(in_flight) >= 2 * workers:
+						done, in_flight = wait(in_flight, return_when = FIRST_COMPLETED)
+						for future in done:
+							add_results(*future.result())
+				for future in in_flight:
+					add_results(*future.result())
+	writer.close()
+	con.close()
+
 if __name__ == "__main__":
-	get_all_games()
\ No newline at end of file
+	parser = argparse.ArgumentParser(description = "Collects team duels games into the database")
+	parser.add_argument("--max-concurrency", type = int, default = 8, help = "number of games fetched at once")
+	parser.add_argument("--requests-per-second", type = float, default = 10, help = "overall request rate limit")
+	parser.add_argument("--retries", type = int, default = 5, help = "retries for rate limited or failed requests")
+	parser.add_argument("--base-url", default = DUELS_URL, help = "duels api url, game ids are appended to it")
+	parser.add_argument("--batch-games", type = int, default = 100, help = "number of games written per transaction")
+	parser.add_argument("--flush-seconds", type = float, default = 5, help = "longest time between two writes")
+	parser.add_argument("--ingest-profile", action = "store_true", help = "use wal mode with synchronous = normal")
+	parser.add_argument("--no-resume", action = "store_true", help = "fetch every game id, even ones that were already collected")
+	parser.add_argument(
+		"--retry-failures",
+		choices = ["none", "transient", "all"],
+		default = "none",
+		help = "which previously failed games to try again"
+	)
+	parser.add_argument("--archive", default = None, help = "response archive to keep raw responses in, or to replay from")
+	parser.add_argument("--replay", action = "store_true", help = "re-derive all games from the archive instead of fetching")
+	parser.add_argument("--ingest", nargs = "+", default = None, help = "jsonl files of raw api responses to ingest instead of fetching")
+	parser.add_argument("--workers", type = int, default = None, help = "number of processes used with --ingest")
+	parser.add_argument("--replace", action = "store_true", help = "with --ingest, replace games that are already stored")
+	add_metrics_arguments(parser)
+	args = parser.parse_args()
+	start_metrics("get_games", args)
+	try:
+		if args.replay:
+			replay_games(args.archive or "responses.db", batch_games = args.batch_games)
+		elif args.ingest:
+			ingest_jsonl(
+				args.ingest,
+				workers = args.workers,
+				batch_games = args.batch_games,
+				ingest_profile = args.ingest_profile,
+				replace = args.replace
+			)
+		else:
+			get_all_games(
+				max_concurrency = args.max_concurrency,
+				requests_per_second = args.requests_per_second,
+				retries = args.retries,
+				base_url = args.base_url,
+				batch_games = args.batch_games,
+				flush_seconds = args.flush_seconds,
+				ingest_profile = args.ingest_profile,
+				resume = not args.no_resume,
+				retry_failures = args.retry_failures,
+				archive_path = args.archive
+			)
+	finally:
+		metrics.stop()
\ No newline at end of file
@@ -0,0 +1,64 @@
+import requests
+
+import threading
+import time
+
+from metrics import host, metrics
+
+# responses that are worth retrying, everything else is either fine or a permanent error
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# token bucket rate limiter that can be shared between threads
+# allows bursts of up to capacity requests, and rate requests per second on average
+class TokenBucket:
+	def __init__(self, rate, capacity = None):
+		self.rate = rate
+		self.capacity = capacity or max(1, rate)
+		self.tokens = self.capacity
+		self.updated_at = time.monotonic()
+		self.lock = threading.Lock()
+
+	# blocks until a request is allowed
+	def acquire(self):
+		while True:
+			with self.lock:
+				now = time.monotonic()
+				self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+				self.updated_at = now
+				if self.tokens >= 1:
+					self.tokens -= 1
+					return
+				wait = (1 - self.tokens) / self.rate
+			time.sleep(wait)
+
+# creates a session that keeps up to pool_size connections open, so that requests don't each pay for a new tls handshake
+def make_session(pool_size = 10):
+	session = requests.Session()
+	adapter = requests.adapters.HTTPAdapter(pool_connections = pool_size, pool_maxsize = pool_size)
+	session.mount("http://", adapter)
+	session.mount("https://", adapter)
+	return session
+
+# sends a request, retrying connection errors, 429s and 5xxs with exponential backoff
+# a numeric Retry-After header is respected if the server sends one
+def request_with_retries(session, method, url, rate_limiter = None, retries = 5, backoff = 1, **kwargs):
+	for attempt in range(retries + 1):
+		if rate_limiter:
+			rate_limiter.acquire()
+		delay = min(backoff * 2 ** attempt, 60)
+		try:
+			response = session.request(method, url, **kwargs)
+		except (requests.ConnectionError, requests.Timeout) as e:
+			if attempt == retries:
+				raise
+			# the last attempt's error is left to the caller, so that it isn't counted twice
+			metrics.error(host(url), f"{type(e).__name__} (retried)")
+			time.sleep(delay)
+			continue
+		if response.status_code in RETRY_STATUSES and attempt < retries:
+			metrics.error(host(url), f"HTTP {response.status_code} (retried)")
+			retry_after = response.headers.get("Retry-After", "")
+			time.sleep(min(int(retry_after), 60) if retry_after.isdigit() else delay)
+			continue
+		response.raise_for_status()
+		return response
\ No newline at end of file
@@ -0,0 +1,115 @@
+###############################################################################
+# Helpers for the locations table, which holds everything that only depends   #
+# on where a round was played. Rounds reference it through location_id.       #
+###############################################################################
+
+import math
+
+from metrics import metrics
+
+# zoom level of the tile (tile_x, tile_y) that every location is indexed by, the same tiles as calculate_coverage_density.py uses
+# a tile is about 10 km wide at the equator, and less towards the poles
+SPATIAL_ZOOM = 12
+
+# radius of the earth in metres, as used for distances between locations
+EARTH_RADIUS = 6371000
+
+# gets the tile that a location is in, see ScoreCalculator.get_tile_from_coords
+def get_tile(lat, lng, zoom = SPATIAL_ZOOM):
+	# imported here since calculate_coverage_density imports this module
+	from calculate_coverage_density import ScoreCalculator
+
+	return ScoreCalculator(zoom = zoom).get_tile_from_coords({"lat": lat, "lng": lng})
+
+# great circle distance between two coordinates in metres
+def haversine(lat1, lng1, lat2, lng2):
+	lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+	a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+	return 2 * EARTH_RADIUS * math.asin(min(1, math.sqrt(a)))
+
+# creates the locations of newly inserted rounds and links the rounds to them
+# only touches rounds that aren't linked yet, so it is cheap to run after every batch of inserts
+def link_locations(con):
+	con.create_function("tile_x_of", 2, lambda lat, lng: get_tile(lat, lng)["x"], deterministic = True)
+	con.create_function("tile_y_of", 2, lambda lat, lng: get_tile(lat, lng)["y"], deterministic = True)
+	con.execute("INSERT OR IGNORE INTO locations(lat, lng) SELECT DISTINCT lat, lng FROM rounds WHERE location_id IS NULL")
+	con.execute("UPDATE locations SET tile_x = tile_x_of(lat, lng), tile_y = tile_y_of(lat, lng) WHERE tile_x IS NULL")
+	con.execute("""UPDATE rounds SET location_id = locations.location_id
+		FROM locations
+		WHERE rounds.location_id IS NULL AND locations.lat = rounds.lat AND locations.lng = rounds.lng""")
+	con.commit()
+
+# gets (location_id, lat, lng, distance in metres) for all locations within radius metres of a coordinate, nearest first
+# only the tiles that overlap a box around the radius are looked at, through the location_tile index
+# with where, only locations matching that condition (such as "date_range IS NOT NULL") are included
+def get_nearby_locations(con, lat, lng, radius, where = "1"):
+	scale = 1 << SPATIAL_ZOOM
+	lat_offset = math.degrees(radius / EARTH_RADIUS)
+	# the box gets wider towards the poles, and near them simply covers all longitudes
+	lng_offset = math.degrees(radius / (EARTH_RADIUS * max(math.cos(math.radians(lat)), 1e-6)))
+	northwest = get_tile(min(lat + lat_offset, 90), lng - min(lng_offset, 180))
+	southeast = get_tile(max(lat - lat_offset, -90), lng + min(lng_offset, 180))
+	# tiles past the antimeridian wrap around to the other side of the map
+	if southeast["x"] - northwest["x"] + 1 >= scale:
+		xs = range(scale)
+	else:
+		xs = sorted({x % scale for x in range(northwest["x"], southeast["x"] + 1)})
+	candidates = con.execute(
+		f"""SELECT location_id, lat, lng FROM locations
+		WHERE tile_x IN ({", ".join(str(x) for x in xs)}) AND tile_y BETWEEN ? AND ? AND ({where})""",
+		(northwest["y"], southeast["y"])
+	).fetchall()
+	nearby = [(x[0], x[1], x[2], haversine(lat, lng, x[1], x[2])) for x in candidates]
+	return sorted([x for x in nearby if x[3] <= radius], key = lambda x: x[3])
+
+# copies columns from the nearest location within radius metres that already has them, for locations that don't
+# meant for near-identical coordinates, where a network request would give the same answer again
+# locations are (location_id, lat, lng) tuples, as returned by get_locations_without
+# returns the locations that still need to be looked up, and (location_id, value1, value2, ...) rows for the ones that don't
+def reuse_nearby_results(con, columns, locations, radius):
+	remaining = []
+	reused = []
+	where = " AND ".join(f"{x} IS NOT NULL" for x in columns)
+	for location in locations:
+		nearby = get_nearby_locations(con, location[1], location[2], radius, where)
+		if len(nearby) == 0:
+			remaining.append(location)
+		else:
+			values = con.execute(f"SELECT {', '.join(columns)} FROM locations WHERE location_id = ?", (nearby[0][0],)).fetchone()
+			reused.append((location[0], *values))
+	metrics.count("locations.reused", len(reused))
+	return remaining, reused
+
+# gets (location_id, lat, lng) for all locations where a column has no value yet, in order of location_id
+# with after_id, only locations after it are included, so that new locations can be picked up without going over old ones again
+def get_locations_without(con, column, after_id = 0):
+	return con.execute(
+		f"SELECT location_id, lat, lng FROM locations WHERE {column} IS NULL AND location_id > ? ORDER BY location_id",
+		(after_id,)
+	).fetchall()
+
+# writes enrichment results for many locations at once
+# rows are (location_id, value1, value2, ...) tuples in the same order as columns
+# they are staged in a temporary table with a single executemany, and then merged with a single update
+# bumps locations.generation, so that columnar_export.py knows that rows it already exported have changed
+# the written locations get the new generation too, so that map_stats.py can find the ones that changed since it last looked
+def update_locations(con, columns, rows):
+	# imported here since setup_database imports this module
+	from setup_database import bump_watermark, get_watermark
+
+	if len(rows) == 0:
+		return
+	with metrics.stage("locations.write"):
+		con.execute("DROP TABLE IF EXISTS temp.staged_locations")
+		con.execute(f"CREATE TEMP TABLE staged_locations(location_id INTEGER PRIMARY KEY, {', '.join(columns)})")
+		with con:
+			con.executemany(
+				f"INSERT OR REPLACE INTO staged_locations VALUES ({', '.join('?' * (len(columns) + 1))})",
+				rows
+			)
+			bump_watermark(con, "locations.generation")
+			con.execute(f"""UPDATE locations SET {", ".join(f"{x} = staged_locations.{x}" for x in columns)}, generation = ?
+				FROM staged_locations
+				WHERE locations.location_id = staged_locations.location_id""", (get_watermark(con, "locations.generation"),))
+		con.execute("DROP TABLE temp.staged_locations")
+	metrics.count("locations.write", len(rows))
\ No newline at end of file
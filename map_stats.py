@@ -0,0 +1,183 @@
+###############################################################################
+# Per map (and per map and nmpz) summaries of rounds, for ranking maps by     #
+# difficulty without going over every round again. Everything is stored as   #
+# sums, counts and histograms, so new games are simply added on top.          #
+###############################################################################
+
+import argparse
+import sqlite3
+
+from setup_database import LOCATION_COLUMNS, create_tables, get_watermark, set_watermark
+
+# histogram buckets: scores and damage in steps of 250 points, distances by these upper bounds in metres
+SCORE_BUCKET_SIZE = 250
+DISTANCE_BUCKETS = [1000, 5000, 25000, 100000, 500000, 1000000, 2500000, 5000000]
+
+# the distance bucket of a column, which is the number of bounds that it is above
+distance_bucket = lambda column: " + ".join(f"({column} >= {x})" for x in DISTANCE_BUCKETS)
+
+# the mean of a summed column, as an sql expression
+mean = lambda total, count: f"SUM({total}) * 1.0 / NULLIF(SUM({count}), 0)"
+
+# the variance of a summed column with summed squares, as an sql expression
+variance = lambda total, squares, count: f"{mean(squares, count)} - ({mean(total, count)}) * ({mean(total, count)})"
+
+# the summary columns of map_stats, which are all added up when new rounds come in
+STAT_COLUMNS = [
+	"game_count",
+	"round_count",
+	"score_count",
+	"score_sum",
+	"score_squares",
+	"distance_count",
+	"distance_sum",
+	"distance_squares",
+	"damage_sum",
+	"damage_squares",
+	*[f"{x}_{y}" for x in LOCATION_COLUMNS for y in ["count", "sum"]]
+]
+
+def create_map_stats_tables(con):
+	con.execute(f"""CREATE TABLE IF NOT EXISTS map_stats(
+		map_id TEXT NOT NULL,
+		nmpz INTEGER NOT NULL,
+		map_name TEXT,
+		{", ".join(f"{x} {'INTEGER' if x.endswith('count') else 'REAL'} DEFAULT 0" for x in STAT_COLUMNS)},
+		PRIMARY KEY (map_id, nmpz)
+	)""")
+	# metric is "score", "damage" or "distance", see SCORE_BUCKET_SIZE and DISTANCE_BUCKETS for the buckets
+	con.execute("""CREATE TABLE IF NOT EXISTS map_histograms(
+		map_id TEXT NOT NULL,
+		nmpz INTEGER NOT NULL,
+		metric TEXT NOT NULL,
+		bucket INTEGER NOT NULL,
+		count INTEGER,
+		PRIMARY KEY (map_id, nmpz, metric, bucket)
+	)""")
+	# rounds that were counted without some location features used to be kept here, see refresh_location_features for what replaced it
+	con.execute("DROP TABLE IF EXISTS map_stats_pending")
+	# the same means and variances, once per map and nmpz, and once per map
+	for view, group in [("map_difficulty", ["map_id", "nmpz"]), ("map_difficulty_by_map", ["map_id"])]:
+		con.execute(f"""CREATE VIEW IF NOT EXISTS {view} AS SELECT
+			{", ".join(group)},
+			MAX(map_name) AS map_name,
+			SUM(game_count) AS game_count,
+			SUM(round_count) AS round_count,
+			{mean("score_sum", "score_count")} AS mean_score,
+			{variance("score_sum", "score_squares", "score_count")} AS score_variance,
+			{mean("distance_sum", "distance_count")} AS mean_distance,
+			{variance("distance_sum", "distance_squares", "distance_count")} AS distance_variance,
+			{mean("damage_sum", "round_count")} AS mean_damage,
+			{variance("damage_sum", "damage_squares", "round_count")} AS damage_variance,
+			{", ".join(f"{mean(x + '_sum', x + '_count')} AS mean_{x}" for x in LOCATION_COLUMNS)}
+			FROM map_stats GROUP BY {", ".join(group)}""")
+
+# adds rows to map_stats, adding the values onto the existing row if the map is already there
+def upsert_stats(con, columns, select, params):
+	con.execute(f"""INSERT INTO map_stats(map_id, nmpz, {", ".join(columns)}) {select}
+		ON CONFLICT (map_id, nmpz) DO UPDATE SET {", ".join(f"{x} = {x} + excluded.{x}" for x in columns)}""", params)
+
+# adds the games and rounds with rowids in (low, high]
+def add_games(con, low, high):
+	con.execute("""INSERT INTO map_stats(map_id, nmpz, map_name, game_count)
+		SELECT map_id, nmpz, MAX(map_name), COUNT(*) FROM games WHERE rowid > ? AND rowid <= ? GROUP BY map_id, nmpz
+		ON CONFLICT (map_id, nmpz) DO UPDATE SET game_count = game_count + excluded.game_count, map_name = excluded.map_name""", (low, high))
+
+def add_rounds(con, low, high):
+	params = {"low": low, "high": high}
+	new_rounds = "FROM rounds JOIN games USING (game_id) WHERE rounds.rowid > :low AND rounds.rowid <= :high"
+	upsert_stats(con, STAT_COLUMNS[1:], f"""SELECT games.map_id, games.nmpz,
+		COUNT(*),
+		2 * COUNT(*),
+		TOTAL(team1_score + team2_score),
+		TOTAL(team1_score * team1_score + team2_score * team2_score),
+		COUNT(team1_distance) + COUNT(team2_distance),
+		TOTAL(team1_distance) + TOTAL(team2_distance),
+		TOTAL(team1_distance * team1_distance) + TOTAL(team2_distance * team2_distance),
+		TOTAL(damage),
+		TOTAL(damage * damage),
+		{", ".join(f"COUNT(locations.{x}), TOTAL(locations.{x})" for x in LOCATION_COLUMNS)}
+		FROM rounds JOIN games USING (game_id) LEFT JOIN locations USING (location_id)
+		WHERE rounds.rowid > :low AND rounds.rowid <= :high
+		GROUP BY games.map_id, games.nmpz""", params)
+	con.execute(f"""INSERT INTO map_histograms(map_id, nmpz, metric, bucket, count)
+		SELECT map_id, nmpz, metric, bucket, COUNT(*) FROM (
+			SELECT map_id, nmpz, 'score' AS metric, team1_score / {SCORE_BUCKET_SIZE} AS bucket {new_rounds}
+			UNION ALL SELECT map_id, nmpz, 'score', team2_score / {SCORE_BUCKET_SIZE} {new_rounds}
+			UNION ALL SELECT map_id, nmpz, 'damage', damage / {SCORE_BUCKET_SIZE} {new_rounds}
+			UNION ALL SELECT map_id, nmpz, 'distance', {distance_bucket("team1_distance")} {new_rounds} AND team1_distance IS NOT NULL
+			UNION ALL SELECT map_id, nmpz, 'distance', {distance_bucket("team2_distance")} {new_rounds} AND team2_distance IS NOT NULL
+		) WHERE true GROUP BY map_id, nmpz, metric, bucket
+		ON CONFLICT (map_id, nmpz, metric, bucket) DO UPDATE SET count = count + excluded.count""", params)
+
+# location features are usually filled in long after a round is ingested, and can be changed again later (such as by re-scored tiles)
+# every location that update_locations writes is stamped with a new generation, so the maps with rounds at locations written after generation are found
+# and their location feature sums are computed again from all of their counted rounds, the ones up to rounds_high
+def refresh_location_features(con, generation, rounds_high):
+	columns = [f"{x}_{y}" for x in LOCATION_COLUMNS for y in ["count", "sum"]]
+	con.execute(f"""UPDATE map_stats SET ({", ".join(columns)}) = (
+			SELECT {", ".join(f"COUNT(locations.{x}), TOTAL(locations.{x})" for x in LOCATION_COLUMNS)}
+			FROM games JOIN rounds USING (game_id) LEFT JOIN locations USING (location_id)
+			WHERE games.map_id = map_stats.map_id AND games.nmpz = map_stats.nmpz AND rounds.rowid <= :high
+		)
+		WHERE (map_id, nmpz) IN (
+			SELECT games.map_id, games.nmpz FROM locations JOIN rounds USING (location_id) JOIN games USING (game_id)
+			WHERE locations.generation > :generation AND rounds.rowid <= :high
+		)""", {"generation": generation, "high": rounds_high})
+
+# throws away all summaries, so that the next refresh starts from the first game
+def clear_map_stats(con):
+	for table in ["map_stats", "map_histograms"]:
+		con.execute(f"DELETE FROM {table}")
+	con.execute("DELETE FROM watermarks WHERE name LIKE 'map_stats.%'")
+
+# adds everything that was ingested or enriched since the last refresh, in a single transaction
+# games that were replaced (see BulkWriter) can't be taken out of the sums, so if any are found everything is rebuilt instead
+# summaries from before map_stats.locations was kept are rebuilt once as well, since they can't tell which features they are missing
+def refresh_map_stats(con, rebuild = False):
+	create_map_stats_tables(con)
+	with con:
+		games_watermark = get_watermark(con, "map_stats.games")
+		rounds_watermark = get_watermark(con, "map_stats.rounds")
+		locations_watermark = get_watermark(con, "map_stats.locations")
+		generation = get_watermark(con, "locations.generation")
+		has_locations_watermark = con.execute("SELECT COUNT(*) FROM watermarks WHERE name = 'map_stats.locations'").fetchone()[0] > 0
+		counted = con.execute(
+			"SELECT (SELECT COUNT(*) FROM games WHERE rowid <= ?), (SELECT COUNT(*) FROM rounds WHERE rowid <= ?)",
+			(games_watermark, rounds_watermark)
+		).fetchone()
+		stored = con.execute("SELECT TOTAL(game_count), TOTAL(round_count) FROM map_stats").fetchone()
+		if rebuild or counted != tuple(int(x) for x in stored) or not has_locations_watermark:
+			clear_map_stats(con)
+			games_watermark = rounds_watermark = 0
+			# all rounds are added with the features as they are now
+			locations_watermark = generation
+		games_high = con.execute("SELECT IFNULL(MAX(rowid), 0) FROM games").fetchone()[0]
+		rounds_high = con.execute("SELECT IFNULL(MAX(rowid), 0) FROM rounds").fetchone()[0]
+		add_games(con, games_watermark, games_high)
+		add_rounds(con, rounds_watermark, rounds_high)
+		if generation != locations_watermark:
+			refresh_location_features(con, locations_watermark, rounds_high)
+		set_watermark(con, "map_stats.games", games_high)
+		set_watermark(con, "map_stats.rounds", rounds_high)
+		set_watermark(con, "map_stats.locations", generation)
+	return games_high - games_watermark, rounds_high - rounds_watermark
+
+# gets the histogram of a metric for a map as {bucket: count}, for one nmpz setting or both together
+def get_histogram(con, map_id, metric, nmpz = None):
+	rows = con.execute(
+		"SELECT bucket, SUM(count) FROM map_histograms WHERE map_id = ? AND metric = ? AND nmpz = IFNULL(?, nmpz) GROUP BY bucket",
+		(map_id, metric, nmpz)
+	).fetchall()
+	return dict(rows)
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description = "Updates the per map summaries with everything since the last run")
+	parser.add_argument("--rebuild", action = "store_true", help = "throw the summaries away and build them from scratch")
+	args = parser.parse_args()
+	con = sqlite3.connect("data.db")
+	# older databases don't have the watermarks table yet
+	create_tables(con)
+	game_count, round_count = refresh_map_stats(con, args.rebuild)
+	print(f"Added {game_count} games and {round_count} rounds to the map summaries")
+	con.close()
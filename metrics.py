@@ -0,0 +1,245 @@
+import bisect
+import contextlib
+import cProfile
+from collections import Counter
+import json
+import os
+import sys
+import threading
+import time
+from urllib.parse import urlsplit
+
+# upper bounds of the latency histogram buckets in seconds, anything slower goes into a last bucket
+LATENCY_BUCKETS = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 60]
+
+# gets the host of a url, which is what errors are grouped by
+host = lambda url: urlsplit(url).netloc or url
+
+# gets a short description of an error, such as "HTTP 429" or "ConnectionError"
+# works for both requests errors (e.response.status_code) and aiohttp errors (e.status)
+def error_kind(e):
+	response = getattr(e, "response", None)
+	status = getattr(response, "status_code", None) or getattr(e, "status", None)
+	return f"HTTP {status}" if status else type(e).__name__
+
+# latency histogram with fixed buckets, so that it stays small no matter how many requests are recorded
+class Histogram:
+	def __init__(self):
+		self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+		self.count = 0
+		self.total = 0
+		self.max = 0
+
+	def observe(self, seconds):
+		self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+		self.count += 1
+		self.total += seconds
+		self.max = max(self.max, seconds)
+
+	# gets the upper bound of the bucket that the given fraction of observations falls into
+	def quantile(self, fraction):
+		target = fraction * self.count
+		seen = 0
+		for i, count in enumerate(self.counts):
+			seen += count
+			if seen >= target and count > 0:
+				return LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else self.max
+		return None
+
+	def summary(self):
+		return {
+			"count": self.count,
+			"mean": round(self.total / self.count, 4) if self.count > 0 else None,
+			"p50": self.quantile(0.5),
+			"p90": self.quantile(0.9),
+			"p99": self.quantile(0.99),
+			"max": round(self.max, 4),
+			"buckets": dict(zip([str(x) for x in LATENCY_BUCKETS] + ["inf"], self.counts))
+		}
+
+# throughput, latency, errors and time spent per stage, shared by all threads of a script
+# recording is always on since it is cheap, but nothing is reported until start is called
+# stages are named like "games.write" or "tiles.classify", and every stage can have items, time and a latency histogram
+class Metrics:
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.script = None
+		self.started_at = time.monotonic()
+		self.stages = {}
+		self.histograms = {}
+		self.errors = Counter()
+		self.samples = Counter()
+		self.dump_path = None
+		self.dump_seconds = 30
+		self.profile_path = None
+		self.sample_interval = None
+		self.stopped = threading.Event()
+		self.threads = []
+
+	def get_stage(self, name):
+		if name not in self.stages:
+			self.stages[name] = {"items": 0, "calls": 0, "wall_seconds": 0, "cpu_seconds": 0}
+		return self.stages[name]
+
+	# counts items that went through a stage
+	def count(self, name, items = 1):
+		with self.lock:
+			self.get_stage(name)["items"] += items
+
+	# records an error of some kind, source is usually the endpoint or host that caused it
+	def error(self, source, kind):
+		with self.lock:
+			self.errors[(source, kind)] += 1
+
+	# adds a latency to a stage's histogram
+	def observe(self, name, seconds):
+		with self.lock:
+			if name not in self.histograms:
+				self.histograms[name] = Histogram()
+			self.histograms[name].observe(seconds)
+
+	# times a single request, adding it to the histogram of name
+	@contextlib.contextmanager
+	def timed(self, name):
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.observe(name, time.perf_counter() - start)
+
+	# measures the wall time and cpu time of a piece of work
+	# the cpu time is the calling thread's own, so that threads working on other stages don't get counted
+	@contextlib.contextmanager
+	def stage(self, name):
+		start = time.perf_counter()
+		cpu_start = time.thread_time()
+		try:
+			yield
+		finally:
+			self.add_time(name, time.perf_counter() - start, time.thread_time() - cpu_start)
+
+	# adds time that was measured elsewhere, such as in a worker process, to a stage
+	def add_time(self, name, wall_seconds, cpu_seconds, calls = 1):
+		with self.lock:
+			stage = self.get_stage(name)
+			stage["calls"] += calls
+			stage["wall_seconds"] += wall_seconds
+			stage["cpu_seconds"] += cpu_seconds
+
+	# runs a hot loop under cProfile if a profile path was given, writing the stats to <profile_path>.<name>.prof
+	# only the calling thread is profiled, for worker threads use the sampler instead
+	@contextlib.contextmanager
+	def profiled(self, name):
+		if self.profile_path is None:
+			yield
+			return
+		profiler = cProfile.Profile()
+		profiler.enable()
+		try:
+			yield
+		finally:
+			profiler.disable()
+			profiler.dump_stats(f"{self.profile_path}.{name}.prof")
+
+	# counts where every thread currently is, every sample_interval seconds
+	# cheaper than cProfile, and sees all threads, which is what the network scripts spend their time in
+	def sample(self):
+		while not self.stopped.wait(self.sample_interval):
+			# the threads of this class are only ever waiting, so they would just get in the way
+			own_ids = {x.ident for x in self.threads}
+			frames = sys._current_frames()
+			with self.lock:
+				for thread_id, frame in frames.items():
+					if thread_id not in own_ids:
+						code = frame.f_code
+						self.samples[f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}"] += 1
+
+	def dump_periodically(self):
+		while not self.stopped.wait(self.dump_seconds):
+			self.dump()
+
+	# gets all metrics as a json serialisable dict
+	def snapshot(self):
+		elapsed = time.monotonic() - self.started_at
+		times = os.times()
+		with self.lock:
+			return {
+				"script": self.script,
+				"elapsed_seconds": round(elapsed, 3),
+				# worker processes only show up in the children times once they have exited
+				"cpu_seconds": {
+					"user": times.user,
+					"system": times.system,
+					"children_user": times.children_user,
+					"children_system": times.children_system
+				},
+				"stages": {
+					name: {
+						**{k: round(v, 4) for k, v in stage.items()},
+						"items_per_second": round(stage["items"] / elapsed, 2) if elapsed > 0 else None
+					}
+					for name, stage in self.stages.items()
+				},
+				"latency": {name: x.summary() for name, x in self.histograms.items()},
+				"errors": [{"source": source, "kind": kind, "count": count} for (source, kind), count in self.errors.most_common()],
+				"samples": dict(self.samples.most_common(25))
+			}
+
+	# writes a snapshot to the dump path, atomically so that readers never see half a file
+	def dump(self):
+		if self.dump_path is None:
+			return
+		with open(self.dump_path + ".tmp", "w") as f:
+			json.dump(self.snapshot(), f, indent = 2)
+		os.replace(self.dump_path + ".tmp", self.dump_path)
+
+	# starts reporting: a json dump every dump_seconds if dump_path is given, and sampling if sample_interval is given
+	def start(self, script, dump_path = None, dump_seconds = 30, profile_path = None, sample_interval = None):
+		self.script = script
+		self.started_at = time.monotonic()
+		self.dump_path = dump_path
+		self.dump_seconds = dump_seconds
+		self.profile_path = profile_path
+		self.sample_interval = sample_interval
+		self.stopped.clear()
+		if dump_path is not None:
+			self.threads.append(threading.Thread(target = self.dump_periodically, daemon = True))
+		if sample_interval is not None:
+			self.threads.append(threading.Thread(target = self.sample, daemon = True))
+		for thread in self.threads:
+			thread.start()
+
+	# stops the background threads, writes a last dump and prints a short summary
+	def stop(self):
+		self.stopped.set()
+		for thread in self.threads:
+			thread.join()
+		self.threads = []
+		self.dump()
+		snapshot = self.snapshot()
+		print()
+		for name, stage in snapshot["stages"].items():
+			parts = []
+			if stage["items"] > 0:
+				parts.append(f"{stage['items']} items ({stage['items_per_second']}/s)")
+			if stage["calls"] > 0:
+				parts.append(f"{stage['wall_seconds']}s wall, {stage['cpu_seconds']}s cpu")
+			print(f"{name}: {', '.join(parts)}")
+		for name, histogram in snapshot["latency"].items():
+			print(f"{name}: {histogram['count']} requests, mean {histogram['mean']}s, p50 <= {histogram['p50']}s, p99 <= {histogram['p99']}s")
+		for x in snapshot["errors"]:
+			print(f"{x['source']}: {x['count']} x {x['kind']}")
+
+# the metrics of this process, see Metrics
+metrics = Metrics()
+
+# adds the shared reporting options to a script's argument parser
+def add_metrics_arguments(parser):
+	parser.add_argument("--metrics", default = None, help = "file that metrics are periodically written to as json")
+	parser.add_argument("--metrics-seconds", type = float, default = 30, help = "seconds between two metrics dumps")
+	parser.add_argument("--profile", default = None, help = "cProfile the hot loops, writing <profile>.<stage>.prof files")
+	parser.add_argument("--sample-interval", type = float, default = None, help = "sample all threads every this many seconds")
+
+# starts reporting based on the options added by add_metrics_arguments
+def start_metrics(script, args):
+	metrics.start(script, args.metrics, args.metrics_seconds, args.profile, args.sample_interval)
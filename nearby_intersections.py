@@ -1,14 +1,25 @@
 import requests
 
+import argparse
+import math
+import queue
 import sqlite3
 import random
 import sys
+import threading
+import time
+
+from http_utils import make_session
+from locations import get_locations_without, reuse_nearby_results, update_locations
+from metrics import add_metrics_arguments, error_kind, host, metrics, start_metrics
+from response_archive import ResponseArchive
 
 # stringified percent for the progress bar
 percent = lambda done, total: str(round(done / total * 100)).rjust(3) + "%"
 
 # gets the number of intersections in osm for a singular location
-def get_intersection_count(lat, lng, distance = 500, endpoint = "https://overpass.kumi.systems/api/interpreter"):
+# if an archive is given, the raw response is stored in it, see replay_intersection_counts
+def get_intersection_count(lat, lng, distance = 500, endpoint = "https://overpass.kumi.systems/api/interpreter", archive = None):
 	query = f"""
 	[out:json];
 	way(around:{distance},{lat},{lng})[highway~"^(motorway|trunk|primary|secondary|tertiary|residential)$"] -> .nearbyRoads;
@@ -20,59 +31,374 @@ def get_intersection_count(lat, lng, distance = 500, endpoint = "https://overpas
 		out;
  	);
  	"""
-	r = requests.post(endpoint, data = query)
-	r.raise_for_status()
-	response = r.json()
+	with metrics.timed("intersections.request"):
+		r = requests.post(endpoint, data = query)
+		r.raise_for_status()
+		response = r.json()
+	if archive is not None:
+		archive.put("intersections", [lat, lng, distance], response)
 	return len(response["elements"])
 
+# weights determined based on usage policy & server resources
+# max_in_flight is the most requests that are sent to a mirror at once
+OVERPASS_ENDPOINTS = [
+	{"url": "https://overpass-api.de/api/interpreter", "weight": 4, "max_in_flight": 2},
+	{"url": "https://maps.mail.ru/osm/tools/overpass/api/interpreter", "weight": 20, "max_in_flight": 4},
+	{"url": "https://overpass.openstreetmap.ru/api/interpreter", "weight": 1, "max_in_flight": 1},
+	{"url": "https://overpass.kumi.systems/api/interpreter", "weight": 10, "max_in_flight": 3}
+]
+
+# parses mirrors given as url,weight,max_in_flight strings
+def parse_endpoints(values):
+	endpoints = []
+	for value in values:
+		(url, weight, max_in_flight) = value.rsplit(",", 2)
+		endpoints.append({"url": url, "weight": float(weight), "max_in_flight": int(max_in_flight)})
+	return endpoints
+
+# builds a single query for many locations, each location's output is preceded by a marker element holding its index
+# the per-location part is the same as in get_intersection_count
+def build_batch_query(locations, distance = 500, timeout = 180):
+	parts = [f"[out:json][timeout:{timeout}];"]
+	for i, (lat, lng) in enumerate(locations):
+		parts.append(f"""
+	make location_marker index={i};
+	out;
+	way(around:{distance},{lat},{lng})[highway~"^(motorway|trunk|primary|secondary|tertiary|residential)$"] -> .nearbyRoads;
+	foreach.nearbyRoads -> .road(
+		(.nearbyRoads; - .road;) -> .otherRoads;
+		node(w.road) -> .roadNodes;
+		node(w.otherRoads) -> .otherRoadNodes;
+		node.roadNodes.otherRoadNodes;
+		out;
+	);""")
+	return "\n".join(parts)
+
+# splits the elements of a batch response back into one list of elements per location
+# the number of elements of a location is its intersection count, same as in get_intersection_count
+def split_batch_response(response, location_count):
+	elements = [None] * location_count
+	current = None
+	for element in response["elements"]:
+		if element["type"] == "location_marker":
+			current = int(element["tags"]["index"])
+			elements[current] = []
+		elif current is not None:
+			elements[current].append(element)
+	# a missing marker means that the response was cut off, which shouldn't be mistaken for a count
+	if any(x is None for x in elements):
+		raise ValueError("response is missing some locations")
+	return elements
+
+# the lowest score that a mirror can have, see OverpassEndpoint.score
+MIN_ENDPOINT_SCORE = 1e-6
+
+# an overpass mirror, with running averages of how fast and how reliable it has been
+class OverpassEndpoint:
+	def __init__(self, url, weight = 1, max_in_flight = 1):
+		self.url = url
+		self.weight = weight
+		self.max_in_flight = max_in_flight
+		self.in_flight = 0
+		# exponential moving averages, so that recent behaviour counts the most
+		self.latency = None
+		self.error_rate = 0
+		self.consecutive_errors = 0
+		self.blocked_until = 0
+		self.success_count = 0
+		self.error_count = 0
+
+	def available(self, now):
+		return self.in_flight < self.max_in_flight and now >= self.blocked_until
+
+	# how much traffic this mirror should get compared to the others, in locations per second per unit of weight
+	# never quite 0, since random.choices needs at least one positive weight, even if every mirror has weight 0 or keeps failing
+	def score(self, default_latency):
+		latency = self.latency if self.latency is not None else default_latency
+		return max(self.weight * (1 - self.error_rate) ** 2 / max(latency, 0.1), MIN_ENDPOINT_SCORE)
+
+	def record_success(self, latency, smoothing = 0.2):
+		self.latency = latency if self.latency is None else (1 - smoothing) * self.latency + smoothing * latency
+		self.error_rate *= 1 - smoothing
+		self.consecutive_errors = 0
+		self.success_count += 1
+
+	# failing mirrors are left alone for a while, for longer the more often they fail in a row
+	def record_error(self, now, smoothing = 0.2):
+		self.error_rate = (1 - smoothing) * self.error_rate + smoothing
+		self.consecutive_errors += 1
+		self.blocked_until = now + min(2 ** self.consecutive_errors, 300)
+		self.error_count += 1
+
+# sends batches of locations to several overpass mirrors at once
+# every mirror gets up to its own max_in_flight requests, and mirrors that are slow or failing get less of the traffic
+# failed batches are split in half and retried elsewhere, and given up on after max_attempts (so they stay empty until the next run)
+# if an archive is given, every location's part of the responses is stored in it, the same way get_intersection_count stores it
+class OverpassScheduler:
+	def __init__(self, endpoints = OVERPASS_ENDPOINTS, batch_size = 25, distance = 500, max_attempts = 5, timeout = 180, archive = None):
+		self.archive = archive
+		self.endpoints = [OverpassEndpoint(x["url"], x["weight"], x.get("max_in_flight", 1)) for x in endpoints]
+		self.batch_size = batch_size
+		self.distance = distance
+		self.max_attempts = max_attempts
+		self.timeout = timeout
+		self.condition = threading.Condition()
+		self.session = make_session(sum(x.max_in_flight for x in self.endpoints))
+
+	# waits for a mirror with a free slot, picking one at random based on the scores
+	def acquire_endpoint(self):
+		with self.condition:
+			while True:
+				now = time.monotonic()
+				available = [x for x in self.endpoints if x.available(now)]
+				if len(available) > 0:
+					known_latencies = [x.latency for x in self.endpoints if x.latency is not None]
+					default_latency = sum(known_latencies) / len(known_latencies) if len(known_latencies) > 0 else 1
+					endpoint = random.choices(available, [x.score(default_latency) for x in available])[0]
+					endpoint.in_flight += 1
+					return endpoint
+				blocked_until = [x.blocked_until for x in self.endpoints if x.in_flight < x.max_in_flight]
+				self.condition.wait(max(min(blocked_until) - now, 0.05) if len(blocked_until) > 0 else None)
+
+	def release_endpoint(self, endpoint, latency = None):
+		with self.condition:
+			endpoint.in_flight -= 1
+			if latency is None:
+				endpoint.record_error(time.monotonic())
+			else:
+				endpoint.record_success(latency)
+			self.condition.notify_all()
+
+	# sends one batch, returning its counts
+	def send_batch(self, endpoint, batch):
+		query = build_batch_query([(x[1], x[2]) for x in batch], self.distance, self.timeout)
+		# latencies are kept per mirror, since they differ a lot between them
+		with metrics.timed(f"intersections.request {host(endpoint.url)}"):
+			r = self.session.post(endpoint.url, data = query, timeout = self.timeout + 30)
+			r.raise_for_status()
+			response = r.json()
+		elements = split_batch_response(response, len(batch))
+		if self.archive is not None:
+			for location, location_elements in zip(batch, elements):
+				self.archive.put("intersections", [location[1], location[2], self.distance], {"elements": location_elements})
+		return [len(x) for x in elements]
+
+	# gets the counts of all (location_id, lat, lng) locations, calling on_results with (location_id, count) rows as batches finish
+	# on_results is always called from the thread that called run, so it can safely write to the database
+	def run(self, locations, on_results):
+		batches = queue.Queue()
+		for i in range(0, len(locations), self.batch_size):
+			batches.put((locations[i : i + self.batch_size], 1))
+		results = queue.Queue()
+		# batches that are queued or being worked on, the work is done once this reaches 0
+		remaining = [batches.qsize()]
+		remaining_lock = threading.Lock()
+
+		# sends a batch, queueing its retries if it failed
+		def send(batch, attempt):
+			endpoint = self.acquire_endpoint()
+			start_time = time.monotonic()
+			try:
+				counts = self.send_batch(endpoint, batch)
+			except Exception as e:
+				metrics.error(host(endpoint.url), error_kind(e))
+				self.release_endpoint(endpoint)
+				retries = []
+				if attempt < self.max_attempts:
+					# smaller batches are less likely to time out
+					half = math.ceil(len(batch) / 2)
+					retries = [x for x in [batch[:half], batch[half:]] if len(x) > 0]
+				for retry in retries:
+					batches.put((retry, attempt + 1))
+				with remaining_lock:
+					remaining[0] += len(retries) - 1
+				return
+			self.release_endpoint(endpoint, time.monotonic() - start_time)
+			# the results have to be queued before the batch stops counting as remaining, or they could be missed
+			results.put([(x[0], count) for x, count in zip(batch, counts)])
+			with remaining_lock:
+				remaining[0] -= 1
+
+		def work():
+			while True:
+				batch, attempt = batches.get()
+				if batch is None:
+					return
+				try:
+					send(batch, attempt)
+				except Exception as e:
+					# anything that goes wrong outside of the request itself gives the batch up, instead of leaving run waiting for it forever
+					metrics.error("intersections", error_kind(e))
+					with remaining_lock:
+						remaining[0] -= 1
+					with self.condition:
+						self.condition.notify_all()
+
+		workers = [threading.Thread(target = work, daemon = True) for x in range(sum(x.max_in_flight for x in self.endpoints))]
+		for worker in workers:
+			worker.start()
+		while True:
+			with remaining_lock:
+				if remaining[0] == 0 and results.empty():
+					break
+			try:
+				on_results(results.get(timeout = 1))
+			except queue.Empty:
+				continue
+		for worker in workers:
+			batches.put((None, 0))
+		for worker in workers:
+			worker.join()
+
+	# the session is kept between runs, so that a scheduler can be run again for every batch of new locations
+	def close(self):
+		self.session.close()
+
+	# per-mirror statistics, for keeping an eye on error rates
+	def summary(self):
+		return [
+			{
+				"url": x.url,
+				"successes": x.success_count,
+				"errors": x.error_count,
+				"latency": None if x.latency is None else round(x.latency, 2),
+				"error_rate": round(x.error_rate, 3)
+			}
+			for x in self.endpoints
+		]
+
 # gets the number of intersections in osm for all locations (or n locations, for testing)
-def get_all_intersection_counts(limit = sys.maxsize):
-	# weights determined based on usage policy & server resources
-	possible_endpoints = [
-		{"url": "https://overpass-api.de/api/interpreter", "weight": 4},
-		{"url": "https://maps.mail.ru/osm/tools/overpass/api/interpreter", "weight": 20},
-		{"url": "https://overpass.openstreetmap.ru/api/interpreter", "weight": 1},
-		{"url": "https://overpass.kumi.systems/api/interpreter", "weight": 10}
-	]
-	# this is a very ugly solution, but since the weights our small, it works fine
-	weight_indices = []
-	i = 0
-	for endpoint in possible_endpoints:
-		weight_indices.extend([i] * endpoint["weight"])
-		i += 1
-	total_weight = len(weight_indices)
-	con = sqlite3.connect("data.db")
-	cur = con.cursor()
-	cur.execute("SELECT lat, lng FROM rounds WHERE nearby_intersections IS NULL GROUP BY lat, lng")
-	locations = cur.fetchall()
-	intersections_for = min(len(locations), limit)
+# locations are sent batch_size at a time to all mirrors at once, see OverpassScheduler
+# results are written write_batch_size at a time
+# archive_path is an optional ResponseArchive that all raw responses are kept in
+# with reuse_radius, locations that close to one that already has counts are given its counts instead, see locations.reuse_nearby_results
+def get_all_intersection_counts(
+	limit = sys.maxsize,
+	write_batch_size = 100,
+	batch_size = 25,
+	endpoints = OVERPASS_ENDPOINTS,
+	db_path = "data.db",
+	archive_path = None,
+	reuse_radius = None
+):
+	con = sqlite3.connect(db_path)
+	locations = get_locations_without(con, "nearby_intersections")
+	if reuse_radius is not None:
+		locations, reused = reuse_nearby_results(con, ["nearby_intersections"], locations, reuse_radius)
+		update_locations(con, ["nearby_intersections"], reused)
+		print(f"Reused counts of nearby locations for {len(reused)} locations")
+	locations = locations[: limit]
+	intersections_for = len(locations)
 	print(f"Getting intersection counts for {intersections_for} locations")
-	parsed_count = 0
-	success_count = 0
-	for location in locations:
-		parsed_count += 1
-		(lat, lng) = location
-		try:
-			endpoint_index = random.randint(0, total_weight - 1)
-			# randomising endpoints to not get timed out
-			intersection_count = get_intersection_count(lat, lng, endpoint = possible_endpoints[weight_indices[endpoint_index]]["url"])
-			cur.execute("UPDATE rounds SET nearby_intersections = ? WHERE lat = ? AND lng = ?", (intersection_count, lat, lng))
-			con.commit()
-			success_count += 1
-			print(
-				f"({percent(parsed_count, intersections_for)}) Parsed {parsed_count} coordinates ({success_count} successful)",
-				sep = "",
-				end = "\r",
-				flush = True
-			)
-		except:
-			# nothing happened, we can just try again later / at a different endpoint
-			pass
-		if parsed_count >= limit:
-			break
+	if intersections_for == 0:
+		return
+	pending = []
+	success_count = [0]
+
+	def on_results(rows):
+		metrics.count("intersections.count", len(rows))
+		pending.extend(rows)
+		success_count[0] += len(rows)
+		if len(pending) >= write_batch_size:
+			update_locations(con, ["nearby_intersections"], pending)
+			pending.clear()
+		print(
+			f"({percent(success_count[0], intersections_for)}) Got counts for {success_count[0]} coordinates",
+			sep = "",
+			end = "\r",
+			flush = True
+		)
+
+	archive = ResponseArchive(archive_path) if archive_path else None
+	scheduler = OverpassScheduler(endpoints, batch_size, archive = archive)
+	with metrics.profiled("intersections"):
+		scheduler.run(locations, on_results)
+	scheduler.close()
+	update_locations(con, ["nearby_intersections"], pending)
+	if archive is not None:
+		archive.close()
+	print()
+	for endpoint in scheduler.summary():
+		print(endpoint)
+
+# gets the number of intersections for all locations from a local osm extract, see osm_intersections.py
+# no network is involved, so there is no need for a limit
+def get_all_intersection_counts_offline(extract_path, distance = 500, write_batch_size = 10000):
+	# imported here so that the online mode doesn't need numpy
+	from osm_intersections import load_intersection_index
+	print(f"Loading roads from {extract_path}")
+	index = load_intersection_index(extract_path)
+	con = sqlite3.connect("data.db")
+	locations = get_locations_without(con, "nearby_intersections")
+	location_count = len(locations)
+	print(f"Getting intersection counts for {location_count} locations")
+	for i in range(0, location_count, write_batch_size):
+		batch = locations[i : i + write_batch_size]
+		with metrics.stage("intersections.count"):
+			counts = index.get_intersection_counts([x[1] for x in batch], [x[2] for x in batch], distance)
+		metrics.count("intersections.count", len(batch))
+		update_locations(con, ["nearby_intersections"], [(x[0], count) for x, count in zip(batch, counts.tolist())])
+		print(
+			f"({percent(i + len(batch), location_count)}) Parsed {i + len(batch)} coordinates",
+			sep = "",
+			end = "\r",
+			flush = True
+		)
+
+# re-derives the intersection counts of all archived locations, without using the network
+def replay_intersection_counts(archive_path = "responses.db", distance = 500, db_path = "data.db", write_batch_size = 10000):
+	archive = ResponseArchive(archive_path)
+	con = sqlite3.connect(db_path)
+	location_ids = {(x[1], x[2]): x[0] for x in con.execute("SELECT location_id, lat, lng FROM locations")}
+	pending = []
+	replayed_count = 0
+	for (lat, lng, response_distance), response in archive.iterate("intersections"):
+		location_id = location_ids.get((lat, lng))
+		if response_distance != distance or location_id is None:
+			continue
+		pending.append((location_id, len(response["elements"])))
+		replayed_count += 1
+		if len(pending) >= write_batch_size:
+			update_locations(con, ["nearby_intersections"], pending)
+			pending = []
+	update_locations(con, ["nearby_intersections"], pending)
+	print(f"Replayed counts for {replayed_count} locations")
+	archive.close()
+	con.close()
 
 if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description = "Counts the road intersections near every location")
+	parser.add_argument("--offline", metavar = "EXTRACT", default = None, help = "use a local .osm or .osm.pbf extract instead of overpass")
 	# using small limits since many overpass instances don't provide data about their rate limits
 	# could just use a timeout inbetween queries, but that can be over-cautious
 	# so manually running and keeping an eye on error-rates is what i've found to be the most reliable
-	get_all_intersection_counts(10000)
\ No newline at end of file
+	parser.add_argument("--limit", type = int, default = 10000, help = "most locations to query overpass for in one run")
+	parser.add_argument("--batch-size", type = int, default = 25, help = "locations per overpass query")
+	parser.add_argument(
+		"--endpoint",
+		action = "append",
+		default = None,
+		help = "overpass mirror as url,weight,max_in_flight, can be given several times (defaults to the public mirrors)"
+	)
+	parser.add_argument("--archive", default = None, help = "response archive to keep raw responses in, or to replay from")
+	parser.add_argument("--replay", action = "store_true", help = "re-derive all counts from the archive instead of fetching")
+	parser.add_argument("--reuse-radius", type = float, default = None, help = "copy the count of a location at most this many metres away instead of querying")
+	add_metrics_arguments(parser)
+	args = parser.parse_args()
+	start_metrics("nearby_intersections", args)
+	try:
+		if args.replay:
+			replay_intersection_counts(args.archive or "responses.db")
+		elif args.offline:
+			get_all_intersection_counts_offline(args.offline)
+		else:
+			endpoints = parse_endpoints(args.endpoint) if args.endpoint else OVERPASS_ENDPOINTS
+			get_all_intersection_counts(
+				args.limit,
+				batch_size = args.batch_size,
+				endpoints = endpoints,
+				archive_path = args.archive,
+				reuse_radius = args.reuse_radius
+			)
+	finally:
+		metrics.stop()
\ No newline at end of file
@@ -0,0 +1,208 @@
+###############################################################################
+# Offline version of nearby_intersections.get_intersection_count, which uses  #
+# a local OSM extract (.osm xml, or .pbf if pyosmium is installed) instead of #
+# sending one Overpass query per location.                                    #
+###############################################################################
+
+import numpy as np
+
+import math
+import re
+import xml.etree.ElementTree as ElementTree
+
+try:
+	import osmium
+except ImportError:
+	osmium = None
+
+# same road types as the overpass query
+HIGHWAY_TYPES = re.compile("^(motorway|trunk|primary|secondary|tertiary|residential)$")
+
+# metres per degree of latitude, using the same spherical earth as overpass
+METRES_PER_DEGREE = 6371000 * math.pi / 180
+
+# combines grid rows and columns into single sortable keys
+cell_key = lambda rows, cols: (np.asarray(rows, dtype = np.int64) << 32) + (np.asarray(cols, dtype = np.int64) + (1 << 31))
+
+# indices of many ranges at once: starts[i], starts[i] + 1, ..., starts[i] + lengths[i] - 1 for every i, one after another
+def ragged_ranges(starts, lengths):
+	offsets = np.cumsum(lengths) - lengths
+	return np.repeat(starts - offsets, lengths) + np.arange(lengths.sum())
+
+# reads all matching highways from an osm xml file, returning a list of node id lists and a dict of node id -> (lat, lng)
+# done in two passes, so that only the coordinates of highway nodes have to be kept in memory
+def read_osm_xml(path):
+	ways = []
+	for _, element in ElementTree.iterparse(path):
+		if element.tag == "way":
+			tags = {x.get("k"): x.get("v") for x in element.iter("tag")}
+			if HIGHWAY_TYPES.match(tags.get("highway", "")):
+				ways.append([int(x.get("ref")) for x in element.iter("nd")])
+		# the elements aren't needed anymore once they are read, and big extracts don't fit in memory otherwise
+		if element.tag in ("node", "way", "relation"):
+			element.clear()
+	needed_nodes = {x for way in ways for x in way}
+	node_coords = {}
+	for _, element in ElementTree.iterparse(path):
+		if element.tag == "node":
+			node_id = int(element.get("id"))
+			if node_id in needed_nodes:
+				node_coords[node_id] = (float(element.get("lat")), float(element.get("lon")))
+		if element.tag in ("node", "way", "relation"):
+			element.clear()
+	return ways, node_coords
+
+# same as read_osm_xml, but for osm pbf files
+def read_osm_pbf(path):
+	if osmium is None:
+		raise ImportError("reading .pbf extracts requires pyosmium (pip install osmium), or convert the extract to .osm first")
+	ways = []
+	node_coords = {}
+
+	class HighwayHandler(osmium.SimpleHandler):
+		def way(self, way):
+			if HIGHWAY_TYPES.match(way.tags.get("highway", "")):
+				ways.append([x.ref for x in way.nodes])
+				for x in way.nodes:
+					if x.location.valid():
+						node_coords[x.ref] = (x.location.lat, x.location.lon)
+
+	HighwayHandler().apply_file(path, locations = True)
+	return ways, node_coords
+
+# intersections of a road network, with a grid index of road segments for finding the roads near a location
+# an intersection is a node that is shared by at least two distinct roads, same as in the overpass query
+class IntersectionIndex:
+	# ways is a list of node id lists, node_coords a dict of node id -> (lat, lng)
+	# cell_size is the size of a grid cell in degrees, it works best if it is around the size of the search distance
+	def __init__(self, ways, node_coords, cell_size = 0.01):
+		self.cell_size = cell_size
+		# pairs of (node, way), with every node only counted once per way
+		pairs = np.array(
+			[(node_id, way_index) for way_index, way in enumerate(ways) for node_id in way if node_id in node_coords],
+			dtype = np.int64
+		).reshape(-1, 2)
+		pairs = np.unique(pairs, axis = 0)
+		node_ids, way_counts = np.unique(pairs[:, 0], return_counts = True)
+		junctions = node_ids[way_counts >= 2]
+		junction_pairs = pairs[np.isin(pairs[:, 0], junctions)]
+		# ways without any intersections can't change any count, so they are left out entirely
+		relevant_ways = np.unique(junction_pairs[:, 1])
+		way_numbers = {x: i for i, x in enumerate(relevant_ways.tolist())}
+		# intersections of every way, stored as a compressed list: way i has the junctions junction_nodes[way_starts[i] : way_starts[i + 1]]
+		junction_pairs = junction_pairs[np.argsort(junction_pairs[:, 1], kind = "stable")]
+		self.junction_nodes = junction_pairs[:, 0]
+		# the same junctions numbered from 0, so that they can be combined with other numbers into a single key
+		self.junction_numbers = np.unique(self.junction_nodes, return_inverse = True)[1].astype(np.int64)
+		self.way_starts = np.searchsorted(junction_pairs[:, 1], np.append(relevant_ways, np.iinfo(np.int64).max))
+		# every segment of every relevant way, since a road counts as nearby if any part of it is close enough
+		segments = []
+		for way_index in relevant_ways.tolist():
+			coords = [node_coords[x] for x in ways[way_index] if x in node_coords]
+			for start, end in zip(coords, coords[1:]):
+				segments.append((start[0], start[1], end[0], end[1], way_numbers[way_index]))
+		segments = np.array(segments, dtype = np.float64).reshape(-1, 5)
+		self.segment_coords = segments[:, :4]
+		self.segment_ways = segments[:, 4].astype(np.int64)
+		self.build_grid()
+
+	# puts every segment into every grid cell that its bounding box touches
+	def build_grid(self):
+		lat_min = np.minimum(self.segment_coords[:, 0], self.segment_coords[:, 2])
+		lat_max = np.maximum(self.segment_coords[:, 0], self.segment_coords[:, 2])
+		lng_min = np.minimum(self.segment_coords[:, 1], self.segment_coords[:, 3])
+		lng_max = np.maximum(self.segment_coords[:, 1], self.segment_coords[:, 3])
+		row_min = np.floor(lat_min / self.cell_size).astype(np.int64)
+		row_max = np.floor(lat_max / self.cell_size).astype(np.int64)
+		col_min = np.floor(lng_min / self.cell_size).astype(np.int64)
+		col_max = np.floor(lng_max / self.cell_size).astype(np.int64)
+		# almost all segments are within a single cell, so only the others need a slow loop
+		single = (row_min == row_max) & (col_min == col_max)
+		cell_keys = [cell_key(row_min[single], col_min[single])]
+		segment_ids = [np.nonzero(single)[0]]
+		for i in np.nonzero(~single)[0].tolist():
+			rows, cols = np.meshgrid(np.arange(row_min[i], row_max[i] + 1), np.arange(col_min[i], col_max[i] + 1))
+			cell_keys.append(cell_key(rows.ravel(), cols.ravel()))
+			segment_ids.append(np.full(rows.size, i))
+		cell_keys = np.concatenate(cell_keys)
+		segment_ids = np.concatenate(segment_ids)
+		order = np.argsort(cell_keys, kind = "stable")
+		self.cell_keys = cell_keys[order]
+		self.cell_segments = segment_ids[order]
+
+	# gets (location, segment id) pairs for the segments in the cells around every location, with locations as indices into lats and lngs
+	def candidate_segments(self, lats, lngs, distance):
+		lat_range = distance / METRES_PER_DEGREE
+		lng_range = distance / (METRES_PER_DEGREE * np.maximum(np.cos(np.radians(lats)), 1e-6))
+		row_min = np.floor((lats - lat_range) / self.cell_size).astype(np.int64)
+		row_counts = np.floor((lats + lat_range) / self.cell_size).astype(np.int64) - row_min + 1
+		col_min = np.floor((lngs - lng_range) / self.cell_size).astype(np.int64)
+		col_counts = np.floor((lngs + lng_range) / self.cell_size).astype(np.int64) - col_min + 1
+		# every cell of every location's block of cells, one after another
+		cell_counts = row_counts * col_counts
+		cell_locations = np.repeat(np.arange(len(lats)), cell_counts)
+		cell_numbers = ragged_ranges(np.zeros(len(lats), dtype = np.int64), cell_counts)
+		keys = cell_key(
+			row_min[cell_locations] + cell_numbers // col_counts[cell_locations],
+			col_min[cell_locations] + cell_numbers % col_counts[cell_locations]
+		)
+		starts = np.searchsorted(self.cell_keys, keys, side = "left")
+		ends = np.searchsorted(self.cell_keys, keys, side = "right")
+		# a segment that is in several of a location's cells comes up more than once, which nearby_ways sorts out
+		return np.repeat(cell_locations, ends - starts), self.cell_segments[ragged_ranges(starts, ends - starts)]
+
+	# gets (location, way index) pairs for all ways that are within distance metres of every location
+	def nearby_ways(self, lats, lngs, distance):
+		locations, segment_ids = self.candidate_segments(lats, lngs, distance)
+		coords = self.segment_coords[segment_ids]
+		lat = lats[locations]
+		lng = lngs[locations]
+		# the distances are small enough that a flat projection around the location is accurate
+		lng_scale = np.cos(np.radians(lat)) * METRES_PER_DEGREE
+		ax = (coords[:, 1] - lng) * lng_scale
+		ay = (coords[:, 0] - lat) * METRES_PER_DEGREE
+		bx = (coords[:, 3] - lng) * lng_scale
+		by = (coords[:, 2] - lat) * METRES_PER_DEGREE
+		dx = bx - ax
+		dy = by - ay
+		length_squared = dx * dx + dy * dy
+		# position of the point nearest to the location along each segment, 0 being the start and 1 the end
+		t = np.clip(-(ax * dx + ay * dy) / np.where(length_squared > 0, length_squared, 1), 0, 1)
+		nearby = np.hypot(ax + t * dx, ay + t * dy) <= distance
+		way_count = len(self.way_starts) - 1
+		pairs = np.unique(locations[nearby] * way_count + self.segment_ways[segment_ids[nearby]])
+		return pairs // way_count, pairs % way_count
+
+	# same as nearby_intersections.get_intersection_count
+	# overpass outputs every intersection once for every nearby road that it is on, so that's what is counted here too
+	def get_intersection_count(self, lat, lng, distance = 500):
+		return int(self.get_intersection_counts([lat], [lng], distance)[0])
+
+	# gets the intersection counts of arrays of locations
+	# the cell lookups, segment distances and junction counts of batch_size locations are done together in single array operations
+	def get_intersection_counts(self, lats, lngs, distance = 500, batch_size = 1000):
+		lats = np.asarray(lats, dtype = np.float64)
+		lngs = np.asarray(lngs, dtype = np.float64)
+		counts = np.zeros(len(lats), dtype = np.int64)
+		if len(self.segment_ways) == 0:
+			return counts
+		junction_count = int(self.junction_numbers.max()) + 1
+		for start in range(0, len(lats), batch_size):
+			batch = slice(start, start + batch_size)
+			locations, ways = self.nearby_ways(lats[batch], lngs[batch], distance)
+			# every junction of every nearby way, keyed by location and junction
+			lengths = self.way_starts[ways + 1] - self.way_starts[ways]
+			keys = np.repeat(locations, lengths) * junction_count + self.junction_numbers[ragged_ranges(self.way_starts[ways], lengths)]
+			keys, way_counts = np.unique(keys, return_counts = True)
+			# a junction is on every way at most once, so a count of 2 or more means that it is an intersection of nearby roads
+			shared = way_counts >= 2
+			counts[batch] = np.bincount(keys[shared] // junction_count, weights = way_counts[shared], minlength = len(lats[batch]))
+		return counts
+
+# builds an index from an osm extract, the format is picked based on the file extension
+def load_intersection_index(path, cell_size = 0.01):
+	if path.endswith(".pbf"):
+		ways, node_coords = read_osm_pbf(path)
+	else:
+		ways, node_coords = read_osm_xml(path)
+	return IntersectionIndex(ways, node_coords, cell_size)
\ No newline at end of file
@@ -0,0 +1,465 @@
+###############################################################################
+# Runs the whole pipeline in one process, instead of running setup_database,  #
+# get_games, coverage_count, nearby_intersections and                         #
+# calculate_coverage_density by hand one after another. Enrichment stages     #
+# start right away and pick up new locations as games are ingested. All       #
+# writes go through a single writer thread, so stages never lock each other.  #
+###############################################################################
+
+import aiohttp
+
+import argparse
+import asyncio
+from concurrent.futures import Future, ProcessPoolExecutor
+import json
+import queue
+import sqlite3
+import threading
+import time
+
+from calculate_coverage_density import init_worker, invalidate_changed_tiles, score_chunk, spatial_chunks
+from coverage_count import COVERAGE_URL, coverage_count_with_retries
+from get_games import DUELS_URL, BulkWriter, classify_failure, get_games_concurrently, get_pending_game_ids, use_ingest_profile
+from locations import get_locations_without, update_locations
+from map_stats import refresh_map_stats
+from metrics import add_metrics_arguments, metrics, start_metrics
+from nearby_intersections import OVERPASS_ENDPOINTS, OverpassScheduler, parse_endpoints
+from reconstruct_ratings import refresh_ratings
+from response_archive import ResponseArchive
+from setup_database import create_tables, migrate_locations
+
+# owns the only connection that writes to the database, and does all writing in its own thread
+# games go through a BulkWriter, and location updates are buffered per set of columns and written write_batch_size rows at a time
+# both are also written every flush_seconds, so that new games reach the enrichment stages quickly
+class PipelineWriter:
+	def __init__(self, db_path = "data.db", batch_games = 100, write_batch_size = 1000, flush_seconds = 5):
+		self.queue = queue.Queue()
+		self.error = None
+		self.thread = threading.Thread(target = self.run, args = (db_path, batch_games, write_batch_size, flush_seconds), daemon = True)
+		self.thread.start()
+
+	def put(self, kind, value = None):
+		if self.error is not None:
+			raise self.error
+		self.queue.put((kind, value))
+
+	# adds a game as returned by get_game
+	def add_game(self, game):
+		self.put("game", game)
+
+	def add_failure(self, game_id, reason, detail):
+		self.put("failure", (game_id, reason, detail))
+
+	# same as locations.update_locations, but buffered
+	def update_locations(self, columns, rows):
+		self.put("locations", (tuple(columns), rows))
+
+	# runs fn(con) in the writer thread, returning a future of its result
+	# everything that was added before is written first, so fn sees the same database as after a flush
+	def call(self, fn):
+		future = Future()
+		self.put("call", (fn, future))
+		return future
+
+	# writes everything that was added so far, returning a future that is done once it is committed
+	def flush(self):
+		future = Future()
+		self.put("flush", future)
+		return future
+
+	def close(self):
+		self.queue.put(("close", None))
+		self.thread.join()
+		if self.error is not None:
+			raise self.error
+
+	def run(self, db_path, batch_games, write_batch_size, flush_seconds):
+		con = sqlite3.connect(db_path)
+		# readers don't block the writer in wal mode, which the enrichment stages rely on
+		use_ingest_profile(con)
+		games = BulkWriter(con, batch_games, flush_seconds)
+		pending_locations = {}
+		locations_flushed_at = time.monotonic()
+
+		def flush_locations():
+			for columns, rows in pending_locations.items():
+				update_locations(con, list(columns), rows)
+			pending_locations.clear()
+			return time.monotonic()
+
+		while True:
+			try:
+				kind, value = self.queue.get(timeout = flush_seconds)
+			except queue.Empty:
+				kind, value = "tick", None
+			# a waiter that has given up (such as a stage that was cancelled) has cancelled its future, so there is nobody left to tell
+			if kind in ("call", "flush") and not (value[1] if kind == "call" else value).set_running_or_notify_cancel():
+				continue
+			if self.error is not None:
+				# nothing gets written after an error, but whoever is waiting on a future still needs to hear about it
+				if kind in ("call", "flush"):
+					(value[1] if kind == "call" else value).set_exception(self.error)
+				if kind == "close":
+					con.close()
+					return
+				continue
+			try:
+				if kind == "game":
+					games.add_game(*value)
+				elif kind == "failure":
+					games.add_failure(*value)
+				elif kind == "locations":
+					rows = pending_locations.setdefault(value[0], [])
+					rows.extend(value[1])
+					if len(rows) >= write_batch_size:
+						update_locations(con, list(value[0]), rows)
+						del pending_locations[value[0]]
+				elif kind == "call":
+					# the setup call comes before there are any tables to write to
+					if len(games.games) + len(games.failures) > 0:
+						games.flush()
+					locations_flushed_at = flush_locations()
+					value[1].set_result(value[0](con))
+				elif kind in ("flush", "close"):
+					games.flush()
+					locations_flushed_at = flush_locations()
+					if kind == "close":
+						con.close()
+						return
+					value.set_result(None)
+				else:
+					games.flush_if_due()
+				if time.monotonic() - locations_flushed_at >= flush_seconds:
+					locations_flushed_at = flush_locations()
+			except Exception as e:
+				self.error = e
+				if kind in ("call", "flush"):
+					(value[1] if kind == "call" else value).set_exception(e)
+				if kind == "close":
+					con.close()
+					return
+
+# yields new (location_id, lat, lng) rows that have no value for column yet, as they show up
+# keeps going until upstream_done() is true and there is nothing new left, checking again every poll_seconds
+# every location is only yielded once per run, so the ones that failed are left for the next run
+async def poll_locations(db_path, column, upstream_done, poll_seconds = 5):
+	con = sqlite3.connect(db_path)
+	last_id = 0
+	try:
+		while True:
+			# checked before reading, so that whatever upstream wrote before finishing is always seen
+			finished = upstream_done()
+			rows = get_locations_without(con, column, last_id)
+			if len(rows) > 0:
+				last_id = rows[-1][0]
+				yield rows
+			elif finished:
+				return
+			else:
+				await asyncio.sleep(poll_seconds)
+	finally:
+		con.close()
+
+# creates the tables and migrates old databases, see setup_database.py
+async def run_setup(writer, upstream_done):
+	def setup(con):
+		create_tables(con)
+		migrate_locations(con)
+
+	await asyncio.wrap_future(writer.call(setup))
+
+# fetches all new games, see get_games.get_all_games
+async def run_games(
+	writer,
+	upstream_done,
+	db_path = "data.db",
+	cookies_path = "cookies.json",
+	game_ids_path = "game_ids.txt",
+	max_concurrency = 8,
+	requests_per_second = 10,
+	retries = 5,
+	base_url = DUELS_URL,
+	retry_failures = "none",
+	archive = None
+):
+	with open(cookies_path) as f:
+		cookies = json.load(f)
+	with open(game_ids_path) as f:
+		game_ids = [x.strip() for x in f.read().split(", ") if x.strip()]
+	con = sqlite3.connect(db_path)
+	game_ids = get_pending_game_ids(con, game_ids, retry_failures)
+	con.close()
+	print(f"Collecting data from {len(game_ids)} games")
+
+	def fetch_all():
+		for game_id, result in get_games_concurrently(game_ids, cookies, max_concurrency, requests_per_second, retries, base_url, archive):
+			metrics.count("games.fetched")
+			if isinstance(result, Exception):
+				writer.add_failure(game_id, *classify_failure(result))
+				metrics.count("games.failed")
+			else:
+				writer.add_game(result)
+
+	# get_games_concurrently is thread based, so it gets a thread of its own instead of blocking the event loop
+	await asyncio.to_thread(fetch_all)
+	# only done once everything is committed, so that the enrichment stages see all of it
+	await asyncio.wrap_future(writer.flush())
+
+# gets coverage counts for new locations, see coverage_count.get_all_coverage
+async def run_coverage(
+	writer,
+	upstream_done,
+	db_path = "data.db",
+	concurrency = 100,
+	radius = 10,
+	retries = 3,
+	timeout = 30,
+	backoff = 1,
+	url = COVERAGE_URL,
+	archive = None,
+	poll_seconds = 5
+):
+	location_queue = asyncio.Queue(maxsize = 2 * concurrency)
+
+	async def work(session):
+		while True:
+			location = await location_queue.get()
+			if location is None:
+				return
+			result = await coverage_count_with_retries(session, location, radius, url, retries, timeout, backoff, archive)
+			metrics.count("coverage.count")
+			if result is None:
+				metrics.count("coverage.failed")
+			else:
+				writer.update_locations(["coverage_dates", "date_range"], [(result["location_id"], result["count"], result["date_range"])])
+
+	connector = aiohttp.TCPConnector(limit = concurrency)
+	async with aiohttp.ClientSession(connector = connector) as session:
+		workers = [asyncio.create_task(work(session)) for i in range(concurrency)]
+		async for rows in poll_locations(db_path, "date_range", upstream_done, poll_seconds):
+			for x in rows:
+				await location_queue.put({"location_id": x[0], "lat": x[1], "lng": x[2]})
+		for worker in workers:
+			await location_queue.put(None)
+		await asyncio.gather(*workers)
+
+# gets intersection counts for new locations, up to limit of them, see nearby_intersections.get_all_intersection_counts
+async def run_intersections(
+	writer,
+	upstream_done,
+	db_path = "data.db",
+	endpoints = OVERPASS_ENDPOINTS,
+	batch_size = 25,
+	limit = 10000,
+	archive = None,
+	poll_seconds = 5
+):
+	# kept for the whole run, so that what it learns about the mirrors carries over between rounds of new locations
+	scheduler = OverpassScheduler(endpoints, batch_size, archive = archive)
+	remaining = limit
+
+	def on_results(rows):
+		metrics.count("intersections.count", len(rows))
+		writer.update_locations(["nearby_intersections"], rows)
+
+	try:
+		async for rows in poll_locations(db_path, "nearby_intersections", upstream_done, poll_seconds):
+			rows = rows[: remaining]
+			await asyncio.to_thread(scheduler.run, rows, on_results)
+			remaining -= len(rows)
+			if remaining <= 0:
+				break
+	finally:
+		scheduler.close()
+	for endpoint in scheduler.summary():
+		print(endpoint)
+
+# calculates the coverage density of new locations on a process pool, see calculate_coverage_density.calculate_all_scores
+async def run_density(
+	writer,
+	upstream_done,
+	db_path = "data.db",
+	workers = None,
+	chunk_size = 2000,
+	calculator_options = {},
+	poll_seconds = 5,
+	manifest_path = None
+):
+	loop = asyncio.get_running_loop()
+	# locations near tiles that changed lose their score, so that they get picked up below like new ones
+	if manifest_path:
+		changed_count, invalidated_count = await asyncio.wrap_future(writer.call(lambda con: invalidate_changed_tiles(con, manifest_path)))
+		print(f"{changed_count} tiles changed, affecting {invalidated_count} locations")
+	with ProcessPoolExecutor(workers, initializer = init_worker, initargs = (calculator_options,)) as pool:
+		async for rows in poll_locations(db_path, "streetview_coverage", upstream_done, poll_seconds):
+			futures = [loop.run_in_executor(pool, score_chunk, chunk) for chunk in spatial_chunks(rows, chunk_size)]
+			for future in asyncio.as_completed(futures):
+				scores, wall_seconds, cpu_seconds = await future
+				metrics.add_time("density.score", wall_seconds, cpu_seconds)
+				metrics.count("density.score", len(scores))
+				writer.update_locations(["streetview_coverage"], scores)
+
+# adds everything from this run to the per map summaries, see map_stats.py
+async def run_map_stats(writer, upstream_done):
+	game_count, round_count = await asyncio.wrap_future(writer.call(refresh_map_stats))
+	print(f"Added {game_count} games and {round_count} rounds to the map summaries")
+
+async def run_ratings(writer, upstream_done):
+	game_count = await asyncio.wrap_future(writer.call(refresh_ratings))
+	print(f"Rated {game_count} games")
+
+# a stage of the pipeline
+# requires are stages that have to finish before this one starts
+# follows are stages that this one runs alongside, taking new work from them until they have finished
+class Stage:
+	def __init__(self, name, run, requires = [], follows = []):
+		self.name = name
+		self.run = run
+		self.requires = requires
+		self.follows = follows
+
+# runs stages as soon as the stages that they require are done
+# dependencies on stages that aren't part of the run are ignored, so any subset of stages can be run
+async def run_stages(stages, writer):
+	names = {x.name for x in stages}
+	done = {x.name: asyncio.Event() for x in stages}
+
+	async def run_stage(stage):
+		for name in stage.requires:
+			if name in names:
+				await done[name].wait()
+		upstream_done = lambda: all(done[x].is_set() for x in stage.follows if x in names)
+		print(f"Starting {stage.name}")
+		start_time = time.monotonic()
+		try:
+			await stage.run(writer, upstream_done)
+		finally:
+			# set even if the stage failed, so that the stages that follow it don't wait forever
+			done[stage.name].set()
+		print(f"Finished {stage.name} in {round(time.monotonic() - start_time, 2)} seconds")
+
+	await asyncio.gather(*[run_stage(x) for x in stages])
+	await asyncio.wrap_future(writer.flush())
+
+# prints the progress of all stages on a single line, every few seconds
+async def print_progress(every_seconds = 5):
+	while True:
+		await asyncio.sleep(every_seconds)
+		stages = metrics.snapshot()["stages"]
+		progress = [
+			f"{name} {stages[stage]['items']}"
+			for name, stage in [
+				("games", "games.fetched"),
+				("coverage", "coverage.count"),
+				("intersections", "intersections.count"),
+				("density", "density.score")
+			]
+			if stage in stages
+		]
+		print(" | ".join(progress), sep = "", end = "\r", flush = True)
+
+# the stages of the pipeline and how they depend on each other
+def build_stages(options):
+	archive = options["archive"]
+	enrichment = {"requires": ["setup"], "follows": ["games"]}
+	return [
+		Stage("setup", run_setup),
+		Stage(
+			"games",
+			lambda writer, upstream_done: run_games(writer, upstream_done, archive = archive, **options["games"]),
+			requires = ["setup"]
+		),
+		Stage(
+			"coverage",
+			lambda writer, upstream_done: run_coverage(writer, upstream_done, archive = archive, **options["coverage"]),
+			**enrichment
+		),
+		Stage(
+			"intersections",
+			lambda writer, upstream_done: run_intersections(writer, upstream_done, archive = archive, **options["intersections"]),
+			**enrichment
+		),
+		Stage("density", lambda writer, upstream_done: run_density(writer, upstream_done, **options["density"]), **enrichment),
+		Stage("map_stats", run_map_stats, requires = ["setup", "games", "coverage", "intersections", "density"]),
+		Stage("ratings", run_ratings, requires = ["setup", "games"])
+	]
+
+# runs the selected stages against one database
+def run_pipeline(options, skip = [], db_path = "data.db", batch_games = 100, write_batch_size = 1000, flush_seconds = 5):
+	stages = [x for x in build_stages(options) if x.name not in skip]
+	writer = PipelineWriter(db_path, batch_games, write_batch_size, flush_seconds)
+
+	async def run():
+		progress = asyncio.create_task(print_progress())
+		try:
+			await run_stages(stages, writer)
+		finally:
+			progress.cancel()
+
+	try:
+		asyncio.run(run())
+	finally:
+		writer.close()
+		if options["archive"] is not None:
+			options["archive"].close()
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description = "Runs all stages of the pipeline, enriching new locations as games come in")
+	stage_names = ["setup", "games", "coverage", "intersections", "density", "map_stats", "ratings"]
+	parser.add_argument("--skip", nargs = "+", choices = stage_names, default = [], help = "stages to leave out")
+	parser.add_argument("--db", default = "data.db", help = "database to use")
+	parser.add_argument("--poll-seconds", type = float, default = 5, help = "how often enrichment stages check for new locations")
+	parser.add_argument("--flush-seconds", type = float, default = 5, help = "longest time between two writes")
+	parser.add_argument("--archive", default = None, help = "response archive to keep raw responses in")
+	# games
+	parser.add_argument("--max-concurrency", type = int, default = 8, help = "number of games fetched at once")
+	parser.add_argument("--requests-per-second", type = float, default = 10, help = "overall duels request rate limit")
+	parser.add_argument("--base-url", default = DUELS_URL, help = "duels api url, game ids are appended to it")
+	parser.add_argument("--retry-failures", choices = ["none", "transient", "all"], default = "none", help = "which failed games to try again")
+	# coverage
+	parser.add_argument("--concurrency", type = int, default = 100, help = "most coverage requests in flight at once")
+	parser.add_argument("--coverage-url", default = COVERAGE_URL, help = "SingleImageSearch endpoint")
+	# intersections
+	parser.add_argument("--limit", type = int, default = 10000, help = "most locations to query overpass for in one run")
+	parser.add_argument("--batch-size", type = int, default = 25, help = "locations per overpass query")
+	parser.add_argument("--endpoint", action = "append", default = None, help = "overpass mirror as url,weight,max_in_flight")
+	# density
+	parser.add_argument("--workers", type = int, default = None, help = "number of density processes")
+	parser.add_argument("--chunk-size", type = int, default = 2000, help = "number of locations sent to a density process at once")
+	parser.add_argument("--raster", default = None, help = "score raster made by build_score_raster")
+	parser.add_argument("--pack", default = None, help = "tile pack made by tile_pack.py")
+	parser.add_argument("--tile-store", default = None, help = "persistent tile score store")
+	parser.add_argument("--tile-manifest", default = None, help = "tile manifest from download_tiles.py, to rescore locations near changed tiles")
+	add_metrics_arguments(parser)
+	args = parser.parse_args()
+	options = {
+		"archive": ResponseArchive(args.archive) if args.archive else None,
+		"games": {
+			"db_path": args.db,
+			"max_concurrency": args.max_concurrency,
+			"requests_per_second": args.requests_per_second,
+			"base_url": args.base_url,
+			"retry_failures": args.retry_failures
+		},
+		"coverage": {"db_path": args.db, "concurrency": args.concurrency, "url": args.coverage_url, "poll_seconds": args.poll_seconds},
+		"intersections": {
+			"db_path": args.db,
+			"endpoints": parse_endpoints(args.endpoint) if args.endpoint else OVERPASS_ENDPOINTS,
+			"batch_size": args.batch_size,
+			"limit": args.limit,
+			"poll_seconds": args.poll_seconds
+		},
+		"density": {
+			"db_path": args.db,
+			"workers": args.workers,
+			"chunk_size": args.chunk_size,
+			"calculator_options": {"raster_path": args.raster, "pack_path": args.pack, "tile_store_path": args.tile_store},
+			"poll_seconds": args.poll_seconds,
+			"manifest_path": args.tile_manifest
+		}
+	}
+	start_metrics("pipeline", args)
+	try:
+		run_pipeline(options, args.skip, args.db, flush_seconds = args.flush_seconds)
+	finally:
+		metrics.stop()
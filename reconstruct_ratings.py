@@ -0,0 +1,239 @@
+###############################################################################
+# Reconstructs ELO ratings from the results of team duels, filling in         #
+# rating_before and rating_after of player_ratings. Games are rated in the    #
+# order that they were played, with every player's current rating kept in    #
+# player_elo, so that later runs only have to rate the games since then.      #
+# Games that arrive late are rated again from player_elo_settled, the ratings #
+# after the games that started more than SETTLE_SECONDS before the last one.  #
+###############################################################################
+
+import numpy as np
+
+import argparse
+import sqlite3
+
+from metrics import add_metrics_arguments, metrics, start_metrics
+from setup_database import bump_watermark, create_tables, get_watermark, set_watermark
+
+# rating of a player whose first game has no in-game rating to start from
+DEFAULT_RATING = 1000
+# most points that a player can win or lose in a single game
+K_FACTOR = 32
+# a team that is this many points ahead is expected to win 10 out of 11 games
+RATING_SCALE = 400
+
+# how long after a game started later games may still arrive before it, without everything having to be rated again
+SETTLE_SECONDS = 7 * 24 * 3600
+
+# the order that games are rated in, games from before started_at was ingested have none and come first
+GAME_ORDER = "IFNULL(started_at, 0), games.rowid"
+
+# the player columns of games, team 1 first
+PLAYER_COLUMNS = ["team1_player1", "team1_player2", "team2_player1", "team2_player2"]
+
+def create_rating_tables(con):
+	# every player's rating after the last game that was rated
+	con.execute("""CREATE TABLE IF NOT EXISTS player_elo(
+		player_id TEXT PRIMARY KEY NOT NULL,
+		rating REAL,
+		game_count INTEGER
+	)""")
+	# every player's rating after the settled games, the ones that started before ratings.settled_before
+	con.execute("""CREATE TABLE IF NOT EXISTS player_elo_settled(
+		player_id TEXT PRIMARY KEY NOT NULL,
+		rating REAL,
+		game_count INTEGER
+	)""")
+
+# ratings of all players, in arrays indexed by interned player ids
+class RatingState:
+	def __init__(self, player_ids = [], ratings = [], game_counts = []):
+		self.player_ids = list(player_ids)
+		self.index = {x: i for i, x in enumerate(self.player_ids)}
+		self.ratings = list(ratings)
+		self.game_counts = list(game_counts)
+		self.loaded_count = len(self.player_ids)
+
+	@classmethod
+	def load(cls, con, table = "player_elo"):
+		rows = con.execute(f"SELECT player_id, rating, game_count FROM {table}").fetchall()
+		return cls(*zip(*rows)) if len(rows) > 0 else cls()
+
+	# gets the index of a player, adding players that haven't been seen yet with the given rating
+	def intern(self, player_id, initial_rating):
+		i = self.index.get(player_id)
+		if i is None:
+			i = self.index[player_id] = len(self.player_ids)
+			self.player_ids.append(player_id)
+			self.ratings.append(DEFAULT_RATING if initial_rating is None else initial_rating)
+			self.game_counts.append(0)
+		return i
+
+	# switches from lists, which are cheap to add players to, to arrays, which are cheap to do maths on
+	def to_arrays(self):
+		self.ratings = np.array(self.ratings, dtype = np.float64)
+		self.game_counts = np.array(self.game_counts, dtype = np.int64)
+		# players that were added since loading had no games yet
+		self.loaded_counts = np.zeros(len(self.player_ids), dtype = np.int64)
+		self.loaded_counts[:self.loaded_count] = self.game_counts[:self.loaded_count]
+
+	# writes the players that were in a game since the state was loaded
+	def save(self, con, table = "player_elo"):
+		con.executemany(f"INSERT OR REPLACE INTO {table} VALUES (?, ?, ?)", (
+			(self.player_ids[i], float(self.ratings[i]), int(self.game_counts[i]))
+			for i in np.flatnonzero(self.game_counts != self.loaded_counts)
+		))
+
+# loads the games matching where, in the order that they are rated, and interns their players
+# returns the game rows, an (n, 4) array of player indexes in PLAYER_COLUMNS order and whether team 1 won every game
+def load_games(con, state, where, params):
+	# the in-game rating of a player's first game is where their reconstructed rating starts from
+	games = con.execute(f"""SELECT games.rowid, IFNULL(started_at, 0), winning_team,
+		{", ".join(f"games.{x}, ratings{i}.rowid, ratings{i}.ingame_rating" for i, x in enumerate(PLAYER_COLUMNS))}
+		FROM games
+		{" ".join(f"LEFT JOIN player_ratings AS ratings{i} ON ratings{i}.player_id = games.{x} AND ratings{i}.game_id = games.game_id" for i, x in enumerate(PLAYER_COLUMNS))}
+		WHERE {where} ORDER BY {GAME_ORDER}""", params).fetchall()
+	players = np.array([[state.intern(x[3 + 3 * i], x[5 + 3 * i]) for i in range(4)] for x in games], dtype = np.int64).reshape(-1, 4)
+	team1_won = np.array([x[2] == 1 for x in games], dtype = np.float64)
+	state.to_arrays()
+	return games, players, team1_won
+
+# splits games into waves, where a game's wave comes after the waves of all earlier games of its players
+# no player is in two games of the same wave, so a whole wave can be rated at once, and a player's games still happen in order
+def schedule_waves(players, player_count):
+	last_wave = np.full(player_count, -1, dtype = np.int64)
+	waves = np.empty(len(players), dtype = np.int64)
+	for i, game_players in enumerate(players.tolist()):
+		wave = max(last_wave[x] for x in game_players) + 1
+		for x in game_players:
+			last_wave[x] = wave
+		waves[i] = wave
+	return waves
+
+# rates games, updating the state's ratings, players is an (n, 4) array of player indexes in PLAYER_COLUMNS order
+# returns the ratings of every player before and after every game, as two (n, 4) arrays
+def rate_games(state, players, team1_won):
+	with metrics.stage("ratings.schedule"):
+		waves = schedule_waves(players, len(state.ratings))
+		order = np.argsort(waves, kind = "stable")
+		boundaries = np.flatnonzero(np.diff(waves[order])) + 1
+	before = np.empty(players.shape, dtype = np.float64)
+	after = np.empty(players.shape, dtype = np.float64)
+	with metrics.stage("ratings.rate"):
+		for games in np.split(order, boundaries):
+			wave_players = players[games]
+			ratings = state.ratings[wave_players]
+			team1 = ratings[:, :2].mean(axis = 1)
+			team2 = ratings[:, 2:].mean(axis = 1)
+			expected = 1 / (1 + 10 ** ((team2 - team1) / RATING_SCALE))
+			change = K_FACTOR * (team1_won[games] - expected)
+			new_ratings = ratings + np.column_stack([change, change, -change, -change])
+			state.ratings[wave_players] = new_ratings
+			state.game_counts[wave_players] += 1
+			before[games] = ratings
+			after[games] = new_ratings
+	metrics.count("ratings.rate", len(players))
+	return before, after
+
+# writes rating_before and rating_after for many player_ratings rows at once, same as locations.update_locations
+# rows are (player_ratings rowid, rating_before, rating_after) tuples
+# bumps ratings.generation, so that columnar_export.py knows that rows it already exported have changed
+def update_player_ratings(con, rows):
+	with metrics.stage("ratings.write"):
+		con.execute("DROP TABLE IF EXISTS temp.staged_ratings")
+		con.execute("CREATE TEMP TABLE staged_ratings(rating_rowid INTEGER PRIMARY KEY, rating_before INTEGER, rating_after INTEGER)")
+		con.executemany("INSERT INTO staged_ratings VALUES (?, ?, ?)", rows)
+		# the IN makes sqlite go through the staged rows by rowid, instead of through all of player_ratings in index order
+		con.execute("""UPDATE player_ratings SET rating_before = staged_ratings.rating_before, rating_after = staged_ratings.rating_after
+			FROM staged_ratings
+			WHERE player_ratings.rowid IN (SELECT rating_rowid FROM staged_ratings) AND player_ratings.rowid = staged_ratings.rating_rowid""")
+		con.execute("DROP TABLE temp.staged_ratings")
+		bump_watermark(con, "ratings.generation")
+
+# throws away the state of all players, so that the next refresh starts from the first game
+# the ratings in player_ratings are left alone, since every game gets rated again anyway
+# ratings.generation is kept, it has to keep going up for as long as the ratings are exported
+def clear_ratings(con):
+	con.execute("DELETE FROM player_elo")
+	con.execute("DELETE FROM player_elo_settled")
+	con.execute("DELETE FROM watermarks WHERE name LIKE 'ratings.%' AND name != 'ratings.generation'")
+
+# moves player_elo_settled on to the games that started before settled_before, rating the ones since the last time again
+# every game is settled once, so this costs about as much as rating it did
+def settle_ratings(con, settled_before):
+	previous = get_watermark(con, "ratings.settled_before")
+	if settled_before <= previous:
+		return
+	with metrics.stage("ratings.settle"):
+		state = RatingState.load(con, "player_elo_settled")
+		games, players, team1_won = load_games(
+			con, state, "IFNULL(started_at, 0) >= ? AND IFNULL(started_at, 0) < ?", (previous, settled_before)
+		)
+		rate_games(state, players, team1_won)
+		state.save(con, "player_elo_settled")
+		set_watermark(con, "ratings.settled_before", settled_before)
+
+# rates all games since the last refresh, in a single transaction
+# a game that started before the last rated game changes every later rating, so then all games since the settled ones are rated again
+# a game that was replaced (see BulkWriter) or that started before the settled games means that everything is rated again
+# returns the number of games that were rated
+def refresh_ratings(con, rebuild = False, settle_seconds = SETTLE_SECONDS):
+	create_rating_tables(con)
+	with con:
+		rowid_watermark = get_watermark(con, "ratings.games")
+		started_watermark = get_watermark(con, "ratings.started_at")
+		rated_count = get_watermark(con, "ratings.game_count")
+		settled_before = get_watermark(con, "ratings.settled_before")
+		counted, earliest = con.execute(
+			"SELECT (SELECT COUNT(*) FROM games WHERE rowid <= :rowid), (SELECT MIN(IFNULL(started_at, 0)) FROM games WHERE rowid > :rowid)",
+			{"rowid": rowid_watermark}
+		).fetchone()
+		if rebuild or counted != rated_count or (earliest is not None and earliest < settled_before):
+			clear_ratings(con)
+			rowid_watermark = started_watermark = rated_count = settled_before = 0
+		with metrics.stage("ratings.load"):
+			if earliest is not None and earliest < started_watermark:
+				state = RatingState.load(con, "player_elo_settled")
+				games, players, team1_won = load_games(
+					con, state, "IFNULL(started_at, 0) >= ? OR games.rowid > ?", (settled_before, rowid_watermark)
+				)
+			else:
+				state = RatingState.load(con)
+				games, players, team1_won = load_games(con, state, "games.rowid > ?", (rowid_watermark,))
+		if len(games) == 0:
+			return 0
+		before, after = rate_games(state, players, team1_won)
+		before = np.rint(before).astype(np.int64).tolist()
+		after = np.rint(after).astype(np.int64).tolist()
+		update_player_ratings(con, sorted(
+			(game[4 + 3 * i], before[j][i], after[j][i])
+			for j, game in enumerate(games)
+			for i in range(4)
+			if game[4 + 3 * i] is not None
+		))
+		state.save(con)
+		started_watermark = max(started_watermark, games[-1][1])
+		set_watermark(con, "ratings.games", max(x[0] for x in games))
+		set_watermark(con, "ratings.started_at", started_watermark)
+		set_watermark(con, "ratings.game_count", rated_count + sum(x[0] > rowid_watermark for x in games))
+		settle_ratings(con, started_watermark - settle_seconds)
+	return len(games)
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description = "Rates all games since the last run, filling in rating_before and rating_after. "
+		"Games that arrive out of order are rated again along with every game since the settled ones, "
+		"and a game that started more than --settle-days before the latest rated one makes every game be rated again.")
+	parser.add_argument("--rebuild", action = "store_true", help = "throw the ratings away and rate every game again")
+	parser.add_argument("--settle-days", type = float, default = SETTLE_SECONDS / 86400, help = "how late games may arrive, compared to when they started, before everything is rated again")
+	add_metrics_arguments(parser)
+	args = parser.parse_args()
+	start_metrics("reconstruct_ratings", args)
+	con = sqlite3.connect("data.db")
+	# older databases don't have the watermarks table yet
+	create_tables(con)
+	try:
+		game_count = refresh_ratings(con, args.rebuild, round(args.settle_days * 86400))
+		print(f"Rated {game_count} games")
+	finally:
+		con.close()
+		metrics.stop()
@@ -0,0 +1,79 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import zlib
+
+# gets the hash that a response is stored under, based on what was requested
+# kind is the kind of request (such as "duel"), and params is anything json serialisable that identifies the request
+request_hash = lambda kind, params: hashlib.sha256(f"{kind}\n{json.dumps(params)}".encode()).hexdigest()
+
+# stores raw api responses, so that columns can be re-derived later without hitting the network again
+# responses are kept as zlib compressed json in a single sqlite table, keyed by the hash of the request
+# safe to use from several threads, and writes are buffered and committed flush_every responses at a time
+class ResponseArchive:
+	def __init__(self, path = "responses.db", flush_every = 1000):
+		self.con = sqlite3.connect(path, check_same_thread = False)
+		self.con.execute("""CREATE TABLE IF NOT EXISTS responses(
+			request_hash TEXT PRIMARY KEY NOT NULL,
+			kind TEXT,
+			params TEXT,
+			fetched_at INTEGER,
+			body BLOB
+		)""")
+		self.con.execute("CREATE INDEX IF NOT EXISTS response_kind ON responses(kind)")
+		self.flush_every = flush_every
+		self.pending = []
+		self.lock = threading.Lock()
+
+	# stores a response, replacing any older response to the same request
+	def put(self, kind, params, response):
+		body = zlib.compress(json.dumps(response, separators = (",", ":")).encode())
+		with self.lock:
+			self.pending.append((request_hash(kind, params), kind, json.dumps(params), int(time.time()), body))
+			if len(self.pending) >= self.flush_every:
+				self.flush_locked()
+
+	# gets a stored response, or None if the request was never archived
+	def get(self, kind, params):
+		with self.lock:
+			self.flush_locked()
+			row = self.con.execute("SELECT body FROM responses WHERE request_hash = ?", (request_hash(kind, params),)).fetchone()
+		return None if row is None else json.loads(zlib.decompress(row[0]))
+
+	# yields (params, response) for every stored response of a kind, without loading them all into memory
+	def iterate(self, kind, batch_size = 1000):
+		self.flush()
+		last_rowid = 0
+		while True:
+			with self.lock:
+				rows = self.con.execute(
+					"SELECT rowid, params, body FROM responses WHERE kind = ? AND rowid > ? ORDER BY rowid LIMIT ?",
+					(kind, last_rowid, batch_size)
+				).fetchall()
+			if len(rows) == 0:
+				return
+			for (rowid, params, body) in rows:
+				yield json.loads(params), json.loads(zlib.decompress(body))
+			last_rowid = rows[-1][0]
+
+	def count(self, kind):
+		self.flush()
+		with self.lock:
+			return self.con.execute("SELECT COUNT(*) FROM responses WHERE kind = ?", (kind,)).fetchone()[0]
+
+	def flush_locked(self):
+		if len(self.pending) == 0:
+			return
+		with self.con:
+			self.con.executemany("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)", self.pending)
+		self.pending = []
+
+	def flush(self):
+		with self.lock:
+			self.flush_locked()
+
+	def close(self):
+		self.flush()
+		self.con.close()
\ No newline at end of file
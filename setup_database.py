@@ -1,56 +1,140 @@
 import sqlite3
 
-con = sqlite3.connect("data.db")
-cur = con.cursor()
-
-cur.execute("""CREATE TABLE IF NOT EXISTS player_ratings(
-	player_id TEXT,
-	game_id TEXT,
-	ingame_rating INTEGER,
-	rating_before INTEGER,
-	rating_after INTEGER
-)""")
-cur.execute("CREATE INDEX rating_at_game ON player_ratings(player_id, game_id)")
-
-cur.execute("""CREATE TABLE IF NOT EXISTS games(
-	game_id TEXT PRIMARY KEY NOT NULL,
-	map_id TEXT,
-	map_name TEXT,
-	map_error_distance REAL,
-	nmpz INTEGER,
-	round_count INTEGER,
-	winning_team INTEGER,
-	team1_player1 TEXT,
-	team1_player2 TEXT,
-	team2_player1 TEXT,
-	team2_player2 TEXT,
-	started_at INTEGER,
-	ended_at INTEGER
-)""")
-
-cur.execute("""CREATE TABLE IF NOT EXISTS rounds(
-	game_id TEXT,
-	round_id INTEGER,
-	lat REAL,
-	lng REAL,
-	country_code TEXT,
-	heading REAL,
-	pitch REAL,
-	zoom REAL,
-	pano_id TEXT,
-	damage INTEGER,
-	team1_lat REAL,
-	team1_lng REAL,
-	team1_distance REAL,
-	team1_score INTEGER,
-	team2_lat REAL,
-	team2_lng REAL,
-	team2_distance REAL,
-	team2_score INTEGER,
-	nearby_intersections INTEGER,
-	streetview_coverage INTEGER,
-	coverage_dates INTEGER,
-	date_range INTEGER
-)""")
-cur.execute("CREATE INDEX round_in_game ON rounds(game_id, round_id)")
-cur.execute("CREATE INDEX round_coordinates ON rounds(lat, lng)")
\ No newline at end of file
+from locations import link_locations
+
+# per-location columns, these used to be stored on every round
+LOCATION_COLUMNS = ["nearby_intersections", "streetview_coverage", "coverage_dates", "date_range"]
+
+# creates all tables and indexes, safe to run on an existing database
+def create_tables(con):
+	cur = con.cursor()
+
+	cur.execute("""CREATE TABLE IF NOT EXISTS player_ratings(
+		player_id TEXT,
+		game_id TEXT,
+		ingame_rating INTEGER,
+		rating_before INTEGER,
+		rating_after INTEGER
+	)""")
+	cur.execute("CREATE INDEX IF NOT EXISTS rating_at_game ON player_ratings(player_id, game_id)")
+
+	cur.execute("""CREATE TABLE IF NOT EXISTS games(
+		game_id TEXT PRIMARY KEY NOT NULL,
+		map_id TEXT,
+		map_name TEXT,
+		map_error_distance REAL,
+		nmpz INTEGER,
+		round_count INTEGER,
+		winning_team INTEGER,
+		team1_player1 TEXT,
+		team1_player2 TEXT,
+		team2_player1 TEXT,
+		team2_player2 TEXT,
+		started_at INTEGER,
+		ended_at INTEGER
+	)""")
+	cur.execute("CREATE INDEX IF NOT EXISTS game_map ON games(map_id, nmpz)")
+
+	cur.execute("""CREATE TABLE IF NOT EXISTS rounds(
+		game_id TEXT,
+		round_id INTEGER,
+		lat REAL,
+		lng REAL,
+		country_code TEXT,
+		heading REAL,
+		pitch REAL,
+		zoom REAL,
+		pano_id TEXT,
+		damage INTEGER,
+		team1_lat REAL,
+		team1_lng REAL,
+		team1_distance REAL,
+		team1_score INTEGER,
+		team2_lat REAL,
+		team2_lng REAL,
+		team2_distance REAL,
+		team2_score INTEGER,
+		location_id INTEGER REFERENCES locations(location_id)
+	)""")
+	cur.execute("CREATE INDEX IF NOT EXISTS round_in_game ON rounds(game_id, round_id)")
+	cur.execute("CREATE INDEX IF NOT EXISTS round_coordinates ON rounds(lat, lng)")
+
+	# games that couldn't be ingested, and why, see get_games.classify_failure
+	cur.execute("""CREATE TABLE IF NOT EXISTS failed_games(
+		game_id TEXT PRIMARY KEY NOT NULL,
+		reason TEXT,
+		detail TEXT,
+		failed_at INTEGER
+	)""")
+
+	# every distinct round location is enriched once, instead of once for every round played there
+	cur.execute("""CREATE TABLE IF NOT EXISTS locations(
+		location_id INTEGER PRIMARY KEY,
+		lat REAL NOT NULL,
+		lng REAL NOT NULL,
+		nearby_intersections INTEGER,
+		streetview_coverage INTEGER,
+		coverage_dates INTEGER,
+		date_range INTEGER,
+		tile_x INTEGER,
+		tile_y INTEGER,
+		generation INTEGER,
+		UNIQUE(lat, lng)
+	)""")
+
+	# how far incremental jobs (such as map_stats.py) have got, usually as a rowid
+	cur.execute("""CREATE TABLE IF NOT EXISTS watermarks(
+		name TEXT PRIMARY KEY NOT NULL,
+		value INTEGER
+	)""")
+
+# gets how far an incremental job has got, 0 if it has never run
+def get_watermark(con, name):
+	row = con.execute("SELECT value FROM watermarks WHERE name = ?", (name,)).fetchone()
+	return 0 if row is None else row[0]
+
+# does not commit, so that the watermark is only moved together with the work that it stands for
+def set_watermark(con, name, value):
+	con.execute("INSERT OR REPLACE INTO watermarks VALUES (?, ?)", (name, value))
+
+# moves a watermark on by one, for generations that only have to change whenever a table is updated in place
+# does not commit either, see set_watermark
+def bump_watermark(con, name):
+	con.execute("INSERT INTO watermarks VALUES (?, 1) ON CONFLICT(name) DO UPDATE SET value = value + 1", (name,))
+
+# moves a database from the old schema, where the enrichment columns were on rounds, to the locations table
+# does nothing on a database that is already up to date
+def migrate_locations(con):
+	cur = con.cursor()
+	round_columns = [x[1] for x in cur.execute("PRAGMA table_info(rounds)")]
+	if "location_id" not in round_columns:
+		cur.execute("ALTER TABLE rounds ADD COLUMN location_id INTEGER REFERENCES locations(location_id)")
+	cur.execute("CREATE INDEX IF NOT EXISTS round_location ON rounds(location_id)")
+	# the tile of every location, for proximity queries, see locations.get_nearby_locations
+	location_columns = [x[1] for x in cur.execute("PRAGMA table_info(locations)")]
+	# the locations.generation that a location was last written in, see locations.update_locations
+	for column in ["tile_x", "tile_y", "generation"]:
+		if column not in location_columns:
+			cur.execute(f"ALTER TABLE locations ADD COLUMN {column} INTEGER")
+	cur.execute("CREATE INDEX IF NOT EXISTS location_tile ON locations(tile_x, tile_y)")
+	cur.execute("CREATE INDEX IF NOT EXISTS location_generation ON locations(generation)")
+	old_columns = [x for x in LOCATION_COLUMNS if x in round_columns]
+	if len(old_columns) > 0:
+		# all rounds at the same location were given the same values, so any of them can be kept
+		selected = ", ".join(f"MAX({x})" for x in old_columns)
+		cur.execute(f"""INSERT OR IGNORE INTO locations(lat, lng, {", ".join(old_columns)})
+			SELECT lat, lng, {selected} FROM rounds GROUP BY lat, lng""")
+		for column in old_columns:
+			cur.execute(f"ALTER TABLE rounds DROP COLUMN {column}")
+	link_locations(con)
+	# rounds together with the features of their location, for analysis
+	cur.execute(f"""CREATE VIEW IF NOT EXISTS round_details AS
+		SELECT rounds.*, {", ".join("locations." + x for x in LOCATION_COLUMNS)}
+		FROM rounds LEFT JOIN locations USING (location_id)""")
+	con.commit()
+
+if __name__ == "__main__":
+	con = sqlite3.connect("data.db")
+	create_tables(con)
+	migrate_locations(con)
+	con.close()
\ No newline at end of file
@@ -0,0 +1,75 @@
+import numpy as np
+from PIL import Image
+
+import os
+import re
+
+from calculate_coverage_density import ScoreCalculator
+
+# a pack is a single .npy file of (key, score) records sorted by key, so that it can be memory mapped and binary searched
+# only the per-tile scores are stored: the decoded palette arrays would take 64KB per tile, which is far larger than the pngs themselves
+PACK_DTYPE = np.dtype([("key", "<u8"), ("score", "<u4")])
+
+# combines a tile into a single sortable key, works up to zoom level 28
+pack_key = lambda z, x, y: (z << 56) | (x << 28) | y
+
+# converts a directory of z{z}x{x}y{y}.png tiles into a single pack file
+def pack_tiles(tile_path = "./tiles", pack_path = "./tiles.pack.npy"):
+	tile_name = re.compile(r"z(\d+)x(\d+)y(\d+)\.png")
+	score_calculator = ScoreCalculator(cache_tile_scores = False)
+	records = []
+	file_names = os.listdir(tile_path)
+	tile_count = len(file_names)
+	packed_count = 0
+	for file_name in file_names:
+		packed_count += 1
+		match = tile_name.fullmatch(file_name)
+		if not match:
+			continue
+		(z, x, y) = (int(match.group(1)), int(match.group(2)), int(match.group(3)))
+		with Image.open(f"{tile_path}/{file_name}") as image:
+			records.append((pack_key(z, x, y), score_calculator.score_image(image)))
+		print(
+			f"Packed {packed_count} files out of {tile_count}",
+			sep = "",
+			end = "\r",
+			flush = True
+		)
+	pack = np.array(records, dtype = PACK_DTYPE)
+	pack.sort(order = "key")
+	np.save(pack_path, pack)
+	return len(pack)
+
+# reads a pack made by pack_tiles without loading it into memory
+# a missing tile is just a failed index lookup, no filesystem access is needed
+class TilePack:
+	def __init__(self, pack_path = "./tiles.pack.npy"):
+		pack = np.load(pack_path, mmap_mode = "r")
+		self.keys = pack["key"]
+		self.scores = pack["score"]
+
+	# gets the score of a single tile, or None if the tile isn't in the pack
+	def tile_score(self, z, x, y):
+		if x < 0 or y < 0 or x >= (1 << z) or y >= (1 << z):
+			return None
+		key = np.uint64(pack_key(z, x, y))
+		i = np.searchsorted(self.keys, key)
+		if i < len(self.keys) and self.keys[i] == key:
+			return int(self.scores[i])
+		return None
+
+	# gets the scores of arrays of tiles at once, missing tiles get a score of 0
+	def tile_scores(self, z, x, y):
+		x = np.asarray(x, dtype = np.int64)
+		y = np.asarray(y, dtype = np.int64)
+		valid = (x >= 0) & (y >= 0) & (x < (1 << z)) & (y < (1 << z))
+		keys = (np.uint64(z) << np.uint64(56)) | (x.clip(0).astype(np.uint64) << np.uint64(28)) | y.clip(0).astype(np.uint64)
+		if len(self.keys) == 0:
+			return np.zeros(x.shape, dtype = np.int64)
+		i = np.searchsorted(self.keys, keys).clip(max = len(self.keys) - 1)
+		found = valid & (self.keys[i] == keys)
+		return np.where(found, self.scores[i], 0).astype(np.int64)
+
+if __name__ == "__main__":
+	tile_count = pack_tiles()
+	print(f"\nPacked {tile_count} tiles")
\ No newline at end of file